@@ -0,0 +1,93 @@
+"""
+Run the same images through each search engine and compare them, e.g.
+
+    python benchmark_search.py --engines mcts beam best_first --output-dir bench -- --iteration-limit 10
+
+Every engine runs ``run.py`` once, with the arguments after ``--`` shared by
+all of them, into ``<output dir>/<engine>/``. The report gives, per engine,
+the mean model calls, tokens and search seconds per image, the recall of the
+best leaf and the total wall time of the run, relative to the first engine.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from compare_runs import load_run, summarize
+from search import SEARCH_ENGINES
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", nargs="+", default=list(SEARCH_ENGINES),
+                        help="engines to run; the first is the baseline")
+    parser.add_argument("--output-dir", default="bench", help="each engine writes into <dir>/<engine>")
+    parser.add_argument("--reuse", action="store_true",
+                        help="do not rerun engines whose raw results already exist")
+    parser.add_argument("run_args", nargs=argparse.REMAINDER, help="arguments passed on to run.py, after --")
+    return parser.parse_args()
+
+
+def run_engine(engine, output_dir, run_args):
+    """Run run.py with ``engine`` into ``output_dir``; returns its wall time in seconds."""
+    os.makedirs(output_dir, exist_ok=True)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py"),
+               "--search-engine", engine, "--output-dir", output_dir,
+               "--call-summary", os.path.join(output_dir, "llm_calls.json"),
+               "--log-file", os.path.join(output_dir, "run.log"),
+               # Cost estimates of earlier runs would reorder the images differently per engine
+               "--cost-history", *run_args]
+    logger.info(f"Running {engine}: {' '.join(command)}")
+    start = time.time()
+    subprocess.run(command, check=True)
+    return time.time() - start
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    run_args = args.run_args[1:] if args.run_args[:1] == ["--"] else args.run_args
+
+    runs, wall_times = {}, {}
+    for engine in args.engines:
+        output_dir = os.path.join(args.output_dir, engine)
+        raw_path = os.path.join(output_dir, "raw_sft_data.jsonl")
+        if args.reuse and os.path.exists(raw_path):
+            wall_times[engine] = None
+        else:
+            if os.path.exists(raw_path):
+                # run.py appends; a benchmark starts from an empty output
+                os.remove(raw_path)
+            wall_times[engine] = run_engine(engine, output_dir, run_args)
+        runs[engine] = load_run(raw_path, "image_id")
+
+    common = set.intersection(*(set(records) for records in runs.values()))
+    report = {engine: summarize([records[image] for image in sorted(common)], "recall", 0.0)
+              for engine, records in runs.items()}
+    for engine, summary in report.items():
+        summary['wall_seconds'] = wall_times[engine]
+
+    baseline = report[args.engines[0]]
+    print(f"{len(common)} images searched by all {len(runs)} engines")
+    print(f"{'engine':<12} {'calls':>7} {'saved':>7} {'tokens':>9} {'secs':>7} {'wall':>8} {'R':>6} {'dR':>7} {'F1':>6}")
+    for engine, summary in report.items():
+        if not summary['images']:
+            print(f"{engine:<12} (no images)")
+            continue
+        saved = 1 - summary['calls'] / baseline['calls'] if baseline.get('calls') else 0.0
+        wall = f"{summary['wall_seconds']:8.1f}" if summary['wall_seconds'] is not None else f"{'-':>8}"
+        print(f"{engine:<12} {summary['calls']:7.1f} {saved:7.1%} {summary['tokens']:9.0f} "
+              f"{summary['search_seconds']:7.2f} {wall} {summary['recall']:6.3f} "
+              f"{summary['recall'] - baseline['recall']:+7.3f} {summary['f1']:6.3f}")
+
+    with open(os.path.join(args.output_dir, "benchmark.json"), 'w') as f:
+        json.dump({'images': len(common), 'run_args': run_args, 'engines': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
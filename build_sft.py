@@ -0,0 +1,140 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+
+from utils.result_writer import ResultWriter, iter_records
+from utils.sft import DEFAULT_TEMPLATE, build_sft_record
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rebuild SFT datasets from raw Tree-of-Causal-Thought outputs "
+                                                 "without calling the model")
+    parser.add_argument("--inputs", nargs="+", default=["ToCT/raw_sft_data.jsonl"],
+                        help="raw search outputs (plain jsonl, sharded output prefixes or single shards)")
+    parser.add_argument("--output", default="ToCT/sft_data.jsonl")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace an existing output; without it an existing output is an error, since "
+                             "the writer appends (run.py writes the default output too)")
+    parser.add_argument("--rule", choices=["recall", "f1", "mcts"], default="recall",
+                        help="how to choose between the vanilla answer and the search trajectory")
+    parser.add_argument("--min-score", type=float, default=0.0,
+                        help="drop images whose chosen trajectory scores below this")
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE,
+                        help="format of search trajectories, with {trajectory} and {causal_pairs} fields")
+    parser.add_argument("--dedupe-key", default="image_id",
+                        help="keep only the first record per value of this field ('none' keeps all)")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=256, help="records per task sent to a process")
+    parser.add_argument("--stats", default=None, help="where to write the stats (defaults to <output>.stats.json)")
+    parser.add_argument("--shard-size-mb", type=float, default=None,
+                        help="rotate the output into shards of about this many MB of uncompressed JSON")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--fsync", choices=["never", "close", "always"], default="close")
+    args = parser.parse_args()
+    if existing_outputs(args.output) and not args.overwrite:
+        parser.error(f"{args.output} already exists; pass --overwrite to replace it")
+    return args
+
+
+def existing_outputs(path):
+    """Files of an output written to ``path``: the plain file, and the manifests and shards of a sharded one."""
+    stem = path[:-len('.jsonl')] if path.endswith('.jsonl') else path
+    paths = [path] if os.path.exists(path) else []
+    for manifest_path in sorted(glob.glob(f"{glob.escape(stem)}-*.manifest.json")):
+        with open(manifest_path, 'r') as f:
+            shards = json.load(f)['shards']
+        paths.extend(os.path.join(os.path.dirname(manifest_path), shard['path']) for shard in shards)
+        paths.append(manifest_path)
+    return [p for p in paths if os.path.exists(p)]
+
+
+def iter_raw(paths, dedupe_key, stats):
+    seen = set()
+    for path in paths:
+        for record in iter_records(path):
+            stats['raw'] += 1
+            if dedupe_key is not None:
+                key = record.get(dedupe_key)
+                if key in seen:
+                    stats['duplicates'] += 1
+                    continue
+                seen.add(key)
+            yield record
+
+
+def build_chunk(records, rule, min_score, template):
+    results = []
+    for record in records:
+        try:
+            results.append(build_sft_record(record, rule, min_score, template))
+        except (KeyError, TypeError) as e:
+            logging.error(f"Skipping malformed record {record.get('image_id')}: {str(e)}")
+            results.append((None, 'error'))
+    return results
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def collect(results, writer, stats):
+    for sft, source in results:
+        if source == 'error':
+            stats['errors'] += 1
+        elif sft is None:
+            stats['dropped'] += 1
+        else:
+            stats[source] += 1
+            stats['written'] += 1
+            writer.write(sft)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    dedupe_key = None if args.dedupe_key == 'none' else args.dedupe_key
+    stats = {'raw': 0, 'duplicates': 0, 'written': 0, 'dropped': 0, 'errors': 0, 'vanilla': 0, 'mcts': 0}
+    start = time.time()
+
+    for path in existing_outputs(args.output):
+        logging.info(f"Removing the previous output {path}")
+        os.remove(path)
+    shard_size = int(args.shard_size_mb * 2**20) if args.shard_size_mb is not None else None
+    writer = ResultWriter(args.output, shard_size=shard_size, compression=args.compression, fsync=args.fsync)
+    worker = partial(build_chunk, rule=args.rule, min_score=args.min_score, template=args.template)
+    chunks = chunked(iter_raw(args.inputs, dedupe_key, stats), args.chunk_size)
+    with Pool(args.processes) as pool:
+        # Pool.imap would read the whole input ahead, so keep a bounded window of chunks
+        # in flight and collect them in input order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(worker, (chunk,)))
+            if len(pending) >= 2 * args.processes:
+                collect(pending.popleft().get(), writer, stats)
+        while pending:
+            collect(pending.popleft().get(), writer, stats)
+    writer.close()
+
+    stats['rule'] = args.rule
+    stats['min_score'] = args.min_score
+    stats['seconds'] = round(time.time() - start, 2)
+    stats_path = args.stats or f"{args.output}.stats.json"
+    with open(stats_path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    logging.info(f"SFT stats: {stats}")
+
+
+if __name__ == "__main__":
+    main()
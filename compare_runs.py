@@ -0,0 +1,95 @@
+"""
+Compare the raw outputs of runs made with different search settings, e.g.
+
+    python compare_runs.py rollout=out/rollout/raw_sft_data.jsonl reward=out/reward/raw_sft_data.jsonl
+
+Only the images present in every run are compared. For each run the report
+gives the mean model calls, tokens and search time per image, the mean causal
+precision/recall/F1 of the search, how many images build_sft.py would keep and
+how many of those use the search trajectory, and the calls saved and recall
+lost relative to the first run.
+"""
+import argparse
+import json
+
+from utils.result_writer import iter_records
+from utils.sft import build_sft_record, f1_score
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("runs", nargs="+",
+                        help="label=path of raw search outputs; the first run is the baseline")
+    parser.add_argument("--rule", choices=["recall", "f1", "mcts"], default="recall",
+                        help="SFT selection rule, as in build_sft.py")
+    parser.add_argument("--min-score", type=float, default=0.0)
+    parser.add_argument("--key", default="image_id", help="field identifying an image across runs")
+    parser.add_argument("--output", default=None, help="also write the report as JSON here")
+    return parser.parse_args()
+
+
+def load_run(path, key):
+    records = {}
+    for record in iter_records(path):
+        records.setdefault(record[key], record)
+    return records
+
+
+def summarize(records, rule, min_score):
+    count = len(records)
+    summary = {'images': count}
+    if count == 0:
+        return summary
+    usage = [record.get('llm_usage') or {} for record in records]
+    summary['calls'] = sum(u.get('calls', 0) for u in usage) / count
+    summary['tokens'] = sum(u.get('total_tokens', 0) for u in usage) / count
+    summary['search_seconds'] = sum(record.get('search_metric', 0) for record in records) / count
+    summary['precision'] = sum(record['precision'] for record in records) / count
+    summary['recall'] = sum(record['recall'] for record in records) / count
+    summary['f1'] = sum(f1_score(record['precision'], record['recall']) for record in records) / count
+    sources = [build_sft_record(record, rule, min_score)[1] for record in records]
+    summary['sft_kept'] = sum(source is not None for source in sources)
+    summary['sft_from_search'] = sum(source == 'mcts' for source in sources)
+    simulations = sorted({record.get('simulation', 'rollout') for record in records})
+    summary['simulation'] = ','.join(simulations)
+    summary['engine'] = ','.join(sorted({record.get('search_engine', 'mcts') for record in records}))
+    return summary
+
+
+def main():
+    args = parse_args()
+    runs = {}
+    for item in args.runs:
+        label, path = item.split('=', 1) if '=' in item else (item, item)
+        runs[label] = load_run(path, args.key)
+
+    common = set.intersection(*(set(records) for records in runs.values()))
+    report = {label: summarize([records[image] for image in sorted(common)], args.rule, args.min_score)
+              for label, records in runs.items()}
+
+    baseline = report[next(iter(report))]
+    for summary in report.values():
+        if summary['images'] and baseline.get('calls'):
+            summary['calls_saved'] = 1 - summary['calls'] / baseline['calls']
+            summary['recall_delta'] = summary['recall'] - baseline['recall']
+
+    print(f"{len(common)} images in all {len(runs)} runs")
+    header = f"{'run':<16} {'engine':<10} {'simulation':<14} {'calls':>7} {'saved':>7} {'tokens':>9} {'secs':>7} " \
+             f"{'P':>6} {'R':>6} {'dR':>7} {'F1':>6} {'sft':>5} {'search':>6}"
+    print(header)
+    for label, summary in report.items():
+        if not summary['images']:
+            print(f"{label:<16} (no images)")
+            continue
+        print(f"{label:<16} {summary['engine']:<10} {summary['simulation']:<14} {summary['calls']:7.1f} "
+              f"{summary.get('calls_saved', 0):7.1%} {summary['tokens']:9.0f} {summary['search_seconds']:7.1f} "
+              f"{summary['precision']:6.3f} {summary['recall']:6.3f} {summary.get('recall_delta', 0):+7.3f} "
+              f"{summary['f1']:6.3f} {summary['sft_kept']:5d} {summary['sft_from_search']:6d}")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'images': len(common), 'runs': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
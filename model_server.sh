@@ -1,7 +1,25 @@
-vllm serve ./model/  \
---port 8000 \
---trust-remote-code \
---disable-log-requests \
---max-model-len 32768 \
---gpu-memory-utilization 0.8 \
---tensor-parallel-size 8
+# NUM_REPLICAS>1 starts data-parallel replicas on consecutive ports, each on its own
+# group of NUM_GPUS/NUM_REPLICAS GPUs. Point the client at all of them with
+# VLLM_API_BASES=http://localhost:8000/v1,http://localhost:8001/v1,...
+NUM_REPLICAS=${NUM_REPLICAS:-1}
+NUM_GPUS=${NUM_GPUS:-8}
+BASE_PORT=${BASE_PORT:-8000}
+
+if ((NUM_REPLICAS < 1 || NUM_REPLICAS > NUM_GPUS || NUM_GPUS % NUM_REPLICAS != 0)); then
+    echo "NUM_REPLICAS=$NUM_REPLICAS must be between 1 and NUM_GPUS=$NUM_GPUS and divide it" >&2
+    exit 1
+fi
+TP_SIZE=$((NUM_GPUS / NUM_REPLICAS))
+
+for ((i = 0; i < NUM_REPLICAS; i++)); do
+    FIRST_GPU=$((i * TP_SIZE))
+    GPUS=$(seq -s, $FIRST_GPU $((FIRST_GPU + TP_SIZE - 1)))
+    CUDA_VISIBLE_DEVICES=$GPUS vllm serve ./model/  \
+    --port $((BASE_PORT + i)) \
+    --trust-remote-code \
+    --disable-log-requests \
+    --max-model-len 32768 \
+    --gpu-memory-utilization 0.8 \
+    --tensor-parallel-size $TP_SIZE &
+done
+wait
@@ -1,23 +1,52 @@
-from utils.utils import extract_content, restore_bbox
+from utils.utils import extract_content, map_bbox_text, model_bbox_to_original, restore_bbox
 import ast
+import gzip
 import json
 import logging
 import copy
+import os
+
+import numpy as np
+
+# Initial length of a node's child statistics arrays; they double when full.
+CHILD_STATS_CAPACITY = 4
+# Approximate size of a node without its state: the object, its attributes and stats slots
+NODE_OVERHEAD_BYTES = 600
 
 class TreeNode:
+    """
+    Search tree node. The visit counts and values of a node's children live in
+    the node's ``child_visits``/``child_values`` arrays, indexed like
+    ``children``, so selection can score all children at once. A node's own
+    ``visit_count``/``value`` read and write its slot in the parent's arrays;
+    a node without a parent keeps them as plain attributes.
+    """
+
     def __init__(self):
         self.action = 'SelectRegion'
         self.state = {}
         self.parent = None
         self.children = []
-        self.visit_count = 0
-        self.value = 0
+        self.child_visits = None
+        self.child_values = None
+        self._index = None
+        self._visit_count = 0
+        self._value = 0
         self.depth = 0
         self.is_fully_expanded = False
         self.is_terminal = False
+        # Set when pruning dropped the node's subtree and trajectory text
+        self.is_pruned = False
+        # Set when the node is terminal only because the image's deadline or a
+        # budget ran out; checkpoints store such nodes as open, so a resumed
+        # search with more time or budget expands them
+        self.budget_stopped = False
         self.crop_info = None
+        self._approx_bytes = None
 
-    def initialize_state(self, last_node, result, crop_info):
+    def initialize_state(self, last_node, result, crop_info, image_transform=None):
+        # Region bboxes come from the (possibly resized) full image the model saw;
+        # like the restored pairs, they are stored in original-image coordinates.
         if last_node.parent is None: # root node
             try:
                 description = extract_content('description', result) or ""
@@ -32,10 +61,12 @@ class TreeNode:
             except Exception as e:
                 logging.error(f"Error extracting content: {str(e)}")
                 raise
+            bbox = map_bbox_text(bbox, model_bbox_to_original, image_transform)
             self.state = {
                 'trajectory': f"{description}\n{think}\nSo I need to focus on the \"{region}\" region, and the bounding box is {bbox}.\n\n",
                 'explored_regions': [{'region_name': region, 'bounding_box': bbox}],
-                'current_region': (region, bbox),
+                # A list, as it comes back from a JSON checkpoint, so states compare equal
+                'current_region': [region, bbox],
                 'causal_pairs': [],
                 'candidate_pairs': [],
             }
@@ -57,10 +88,11 @@ class TreeNode:
                     except Exception as e:
                         logging.error(f"Error extracting content: {str(e)}")
                         raise
+                    bbox = map_bbox_text(bbox, model_bbox_to_original, image_transform)
                     self.state['trajectory'] += f"{think}\nSo I need to focus on the \"{region}\" region, and the bounding box is {bbox}.\n\n"
                     if (region, bbox) not in self.state['explored_regions']:
                         self.state['explored_regions'].append({'region_name': region, 'bounding_box': bbox})
-                    self.state['current_region'] = (region, bbox)
+                    self.state['current_region'] = [region, bbox]
                 case 'ProposePair':
                     try:
                         pairs = extract_content('entity pairs', result)
@@ -139,9 +171,50 @@ class TreeNode:
                 case _:
                     raise ValueError(f"Invalid action: {last_node.action}")
 
-    def append_children(self, node):
+    @property
+    def visit_count(self):
+        if self.parent is None:
+            return self._visit_count
+        return int(self.parent.child_visits[self._index])
+
+    @visit_count.setter
+    def visit_count(self, visit_count):
+        if self.parent is None:
+            self._visit_count = visit_count
+        else:
+            self.parent.child_visits[self._index] = visit_count
+
+    @property
+    def value(self):
+        if self.parent is None:
+            return self._value
+        return float(self.parent.child_values[self._index])
+
+    @value.setter
+    def value(self, value):
+        if self.parent is None:
+            self._value = value
+        else:
+            self.parent.child_values[self._index] = value
+
+    def attach_child(self, node):
+        """Link ``node`` under this node and move its statistics into this node's arrays."""
+        index = len(self.children)
+        if self.child_visits is None:
+            self.child_visits = np.zeros(CHILD_STATS_CAPACITY, dtype=np.int64)
+            self.child_values = np.zeros(CHILD_STATS_CAPACITY, dtype=np.float64)
+        elif index == len(self.child_visits):
+            self.child_visits = np.concatenate([self.child_visits, np.zeros_like(self.child_visits)])
+            self.child_values = np.concatenate([self.child_values, np.zeros_like(self.child_values)])
+        self.child_visits[index] = node._visit_count
+        self.child_values[index] = node._value
         node.parent = self
+        node._index = index
+        node.depth = self.depth + 1
         self.children.append(node)
+
+    def append_children(self, node):
+        self.attach_child(node)
         match self.action:
             case 'SelectRegion':
                 node.action = 'ProposePair'
@@ -151,7 +224,140 @@ class TreeNode:
                 node.action = 'SelectRegion'
             case _:
                 raise ValueError(f"Invalid action when appending children: {self.action}")
-        node.depth = self.depth + 1
 
     def update_value(self, value):
-        self.value = value
\ No newline at end of file
+        self.value = value
+
+    def approx_bytes(self):
+        """Rough memory held by the node: its state as JSON plus a fixed per-node overhead."""
+        if self._approx_bytes is None:
+            self._approx_bytes = NODE_OVERHEAD_BYTES + len(json.dumps(self.state, default=str))
+        return self._approx_bytes
+
+    def drop_children(self):
+        """Detach the node's subtree; returns the number of nodes removed."""
+        removed = 0
+        stack = list(self.children)
+        while stack:
+            node = stack.pop()
+            removed += 1
+            stack.extend(node.children)
+        self.children = []
+        self.child_visits = None
+        self.child_values = None
+        return removed
+
+    def drop_text(self):
+        """Keep only what the reward needs of the state, and stop the node from being expanded."""
+        self.state = {key: self.state[key] for key in ('causal_pairs', 'explored_regions') if key in self.state}
+        self.is_terminal = True
+        self.is_pruned = True
+        self._approx_bytes = None
+
+
+TREE_FORMAT_VERSION = 1
+
+
+def _state_delta(parent_state, state):
+    """
+    Encode ``state`` relative to ``parent_state``. Trajectories and pair lists only
+    grow along a path, so most keys are stored as an appended suffix ("+"); keys
+    that changed otherwise are stored whole ("="), removed keys as "-".
+    """
+    delta = {}
+    for key, value in state.items():
+        if key in parent_state:
+            parent_value = parent_state[key]
+            if value == parent_value:
+                continue
+            if isinstance(value, str) and isinstance(parent_value, str) and value.startswith(parent_value):
+                delta[key] = {'+': value[len(parent_value):]}
+                continue
+            if isinstance(value, list) and isinstance(parent_value, list) \
+                    and value[:len(parent_value)] == parent_value:
+                delta[key] = {'+': value[len(parent_value):]}
+                continue
+        delta[key] = {'=': value}
+    for key in parent_state:
+        if key not in state:
+            delta[key] = {'-': True}
+    return delta
+
+
+def _apply_state_delta(parent_state, delta):
+    state = copy.deepcopy(parent_state)
+    for key, change in delta.items():
+        if '-' in change:
+            state.pop(key, None)
+        elif '+' in change:
+            state[key] = state[key] + change['+']
+        else:
+            state[key] = change['=']
+    return state
+
+
+def serialize_tree(root_node):
+    """
+    Flatten a search tree into a node table. Nodes are stored breadth-first so
+    every parent precedes its children; ``parent`` holds the parent's row index.
+    """
+    columns = {
+        'parent': [], 'action': [], 'visit_count': [], 'value': [],
+        'is_fully_expanded': [], 'is_terminal': [], 'is_pruned': [], 'crop_info': [], 'state': [],
+    }
+    queue = [(root_node, -1)]
+    states = []
+    for index, (node, parent_index) in enumerate(queue):
+        parent_state = states[parent_index] if parent_index >= 0 else {}
+        states.append(node.state)
+        columns['parent'].append(parent_index)
+        columns['action'].append(node.action)
+        columns['visit_count'].append(node.visit_count)
+        columns['value'].append(node.value)
+        columns['is_fully_expanded'].append(node.is_fully_expanded)
+        columns['is_terminal'].append(node.is_terminal and not node.budget_stopped)
+        columns['is_pruned'].append(node.is_pruned)
+        columns['crop_info'].append(node.crop_info)
+        columns['state'].append(_state_delta(parent_state, node.state))
+        queue.extend((child, index) for child in node.children)
+    return {'version': TREE_FORMAT_VERSION, 'nodes': columns}
+
+
+def deserialize_tree(payload):
+    """Rebuild the tree written by ``serialize_tree`` and return its root."""
+    if payload.get('version') != TREE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported tree format version: {payload.get('version')}")
+    columns = payload['nodes']
+    nodes = []
+    for index, parent_index in enumerate(columns['parent']):
+        node = TreeNode()
+        parent = nodes[parent_index] if parent_index >= 0 else None
+        if parent is not None:
+            parent.attach_child(node)
+        node.action = columns['action'][index]
+        node.visit_count = columns['visit_count'][index]
+        node.value = columns['value'][index]
+        node.is_fully_expanded = columns['is_fully_expanded'][index]
+        node.is_terminal = columns['is_terminal'][index]
+        node.is_pruned = columns['is_pruned'][index]
+        node.crop_info = columns['crop_info'][index]
+        node.state = _apply_state_delta(parent.state if parent is not None else {}, columns['state'][index])
+        nodes.append(node)
+    return nodes[0]
+
+
+def save_tree(root_node, path, **metadata):
+    """Write a gzip-compressed tree checkpoint, atomically replacing ``path``."""
+    payload = serialize_tree(root_node)
+    payload['metadata'] = metadata
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def load_tree(path):
+    """Load a checkpoint written by ``save_tree``; returns (root_node, metadata)."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        payload = json.load(f)
+    return deserialize_tree(payload), payload.get('metadata', {})
@@ -1,16 +1,30 @@
+import argparse
+import contextlib
+import copy
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import shutil
 
 import numpy as np
 from tqdm import tqdm   
 
+from search import SEARCH_ENGINES, SIMULATIONS, VALUE_ESTIMATORS
 from task import MCTSTask
 from utils.img_server import ImageServer
-from utils.utils import get_gt_pairs
+from utils.log import image_context, parse_module_levels, run_in_image_context, setup_logging
+from utils.image_cache import ImageCache
+from utils.result_writer import ResultWriter
+from utils.scheduler import load_cost_history, shared_schedule
+from utils.work_queue import WorkQueue
+from utils.sft import build_sft_record
+from utils.annotation_store import open_store
 from utils.evaluate import evaluate, vanilla_inference
+from utils.vllm_infer import get_endpoint_stats, ledger
+from utils.call_ledger import start_metrics_server
+from utils.profiling import PROFILE_MODES, ImageProfiler
 
 def get_data():
     with open("VCG-32K/COCO/annotations/train.jsonl", "r") as f:
@@ -18,79 +32,327 @@ def get_data():
         all_data = all_data[0:100]
     return all_data
 
-def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler("debug.log_gpu0"),
-            logging.StreamHandler(),
-        ],
-    )
+def get_items(all_data):
+    """(data, image id, image path) for every record whose image path can be found."""
+    items = []
+    for data in all_data:
+        try:
+            image_path = data['images'][0]['image']
+            id = image_path.split('train/')[-1].split('.')[0]
+            image_path = f"VCG-32K/{image_path}"
+        except:
+            logging.error("error in finding image path")
+            continue
+        items.append((data, id, image_path))
+    return items
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthesize SFT trajectories with Tree-of-Causal-Thought")
+    parser.add_argument("--iteration-limit", type=int, default=20,
+                        help="total number of MCTS rounds per image")
+    parser.add_argument("--call-timeout", type=float, default=None,
+                        help="timeout in seconds for each model request attempt")
+    parser.add_argument("--image-deadline", type=float, default=None,
+                        help="wall-clock limit in seconds for one image's search")
+    parser.add_argument("--stable-rounds", type=int, default=None,
+                        help="stop once the best leaf's value is unchanged for this many rounds")
+    parser.add_argument("--call-budget", type=int, default=None,
+                        help="maximum number of model calls per image")
+    parser.add_argument("--token-budget", type=int, default=None,
+                        help="maximum number of tokens per image")
+    parser.add_argument("--output-dir", default="ToCT", help="where the raw search results and SFT data are written")
+    parser.add_argument("--tree-dir", default=None,
+                        help="save each image's search tree here and resume from trees already saved "
+                             "(raise --iteration-limit to extend finished searches)")
+    parser.add_argument("--checkpoint-every", type=int, default=1,
+                        help="rounds between tree checkpoints when --tree-dir is set")
+    parser.add_argument("--annotation-store", default=None,
+                        help="read the ground truth from a store compiled with "
+                             "`python -m utils.annotation_store compile` instead of parsing it per image")
+    parser.add_argument("--max-pixels", type=int, default=None,
+                        help="resize images and crops to at most this many pixels before sending them to the model")
+    parser.add_argument("--image-cache-dir", default="cache/images",
+                        help="where resized images are cached when --max-pixels is set")
+    parser.add_argument("--jpeg-quality", type=int, default=95, help="JPEG quality of resized images")
+    parser.add_argument("--crop-jpeg-quality", type=int, default=None,
+                        help="JPEG quality of cropped regions (defaults to --jpeg-quality)")
+    parser.add_argument("--shard-size-mb", type=float, default=None,
+                        help="rotate output files into shards of about this many MB of uncompressed JSON")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None,
+                        help="compress output shards")
+    parser.add_argument("--fsync", choices=["never", "close", "always"], default="close",
+                        help="when output files are fsynced")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics of the model calls at http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--call-log", default=None, help="append a jsonl record of every model call here")
+    parser.add_argument("--call-summary", default=None,
+                        help="where to write the per-action summary of the model calls at the end of the run "
+                             "(default: <output-dir>/llm_calls.json)")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="split the images across this many workers, balancing their estimated cost")
+    parser.add_argument("--worker-id", type=int, default=0, help="which of the --num-workers shares to process")
+    parser.add_argument("--queue-dir", default=None,
+                        help="lease batches of images from a work queue in this shared directory instead of "
+                             "processing every image (replaces --num-workers); merge the results with "
+                             "`python -m utils.work_queue merge <dir>`")
+    parser.add_argument("--queue-batch-size", type=int, default=8,
+                        help="images per batch when this worker creates the queue")
+    parser.add_argument("--lease-seconds", type=float, default=600,
+                        help="a batch whose worker has not renewed its lease for this long is reclaimed")
+    parser.add_argument("--assignment", default="ToCT/assignment.json",
+                        help="with --num-workers, the partition of the images shared by all workers; the first "
+                             "worker writes it and the others read it (delete it to re-plan)")
+    parser.add_argument("--cost-history", nargs="*", default=[],
+                        help="outputs of earlier runs whose search times calibrate the cost estimates; "
+                             "pass finished outputs, not files that running workers append to")
+    parser.add_argument("--vanilla-prefetch", type=int, default=2,
+                        help="number of images whose vanilla baseline runs concurrently with the search "
+                             "(the current one plus those ahead of it); 0 runs it after the search")
+    parser.add_argument("--speculate-k", type=int, default=0,
+                        help="run the model calls of up to this many likely next expansions in the background")
+    parser.add_argument("--speculate-max-waste", type=int, default=None,
+                        help="stop speculating once this many speculative calls went unused (default 4 * k)")
+    parser.add_argument("--root-prefetch", type=int, default=1,
+                        help="number of upcoming images whose first model calls run while the current image is searched")
+    parser.add_argument("--root-prefetch-depth", type=int, default=1,
+                        help="how many of an upcoming image's first calls to prefetch: the root caption, "
+                             "then the calls below its first result")
+    parser.add_argument("--search-engine", default="mcts",
+                        help=f"search engine: one of {', '.join(SEARCH_ENGINES)} or module:function")
+    parser.add_argument("--beam-width", type=int, default=3,
+                        help="nodes expanded together per round by beam and best-first search")
+    parser.add_argument("--branching", type=int, default=2,
+                        help="sampled completions per expanded node in beam and best-first search")
+    parser.add_argument("--branch-temperature", type=float, default=0.7,
+                        help="sampling temperature of beam and best-first expansions")
+    parser.add_argument("--simulation", choices=SIMULATIONS, default="rollout",
+                        help="how newly expanded nodes are valued: a full model rollout, a rollout of at most "
+                             "--rollout-depth steps, the reward of the partial state, or --value-estimator")
+    parser.add_argument("--rollout-depth", type=int, default=3, help="model steps of a depth_limited rollout")
+    parser.add_argument("--value-estimator", default="extrapolated",
+                        help=f"estimator for --simulation estimator: one of {', '.join(VALUE_ESTIMATORS)} "
+                             "or module:function")
+    parser.add_argument("--rollouts", type=int, default=1,
+                        help="rollouts run at once from each expanded node by mcts; their first steps are one "
+                             "request with n=rollouts and later steps are sent to the server together")
+    parser.add_argument("--rollout-reduce", choices=["mean", "max"], default="mean",
+                        help="how the rewards of parallel rollouts are combined")
+    parser.add_argument("--rollout-temperature", type=float, default=0.7,
+                        help="sampling temperature of parallel rollouts (single rollouts stay greedy)")
+    parser.add_argument("--max-tree-nodes", type=int, default=None,
+                        help="prune each search tree back once it holds more nodes than this")
+    parser.add_argument("--max-tree-mb", type=float, default=None,
+                        help="prune each search tree back once its states take about this many MB")
+    parser.add_argument("--prune-tail-visits", type=int, default=1,
+                        help="rollout tails visited at most this many times are pruned first")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="profile the CPU side of each image with cProfile (the image's own thread) or a "
+                             "sampler (every thread), saving <profile dir>/images/<image>.pstats and a report "
+                             "of the hottest functions per stage")
+    parser.add_argument("--profile-dir", default="profile", help="where --profile writes its files")
+    parser.add_argument("--profile-interval-ms", type=float, default=5, help="sampling interval of --profile sample")
+    parser.add_argument("--log-file", default="debug.log_gpu0")
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--log-levels", default=None,
+                        help="per-module levels, e.g. search=DEBUG,utils.vllm_infer=WARNING")
+    parser.add_argument("--image-log-dir", default=None,
+                        help="also write each image's log records to <dir>/<image id>.log")
+    args = parser.parse_args()
+    if args.rollouts > 1 and args.search_engine in ('beam', 'best_first'):
+        # Beam and best-first search value every new child with one simulation of its own
+        parser.error(f"--rollouts {args.rollouts} only applies to --search-engine mcts")
+    return args
 
 def main():
-    setup_logging()
+    args = parse_args()
+    setup_logging(args.log_file, level=args.log_level, module_levels=parse_module_levels(args.log_levels),
+                  image_log_dir=args.image_log_dir)
     logging.info("Starting the program")
 
     #start image server
     image_server = ImageServer()
     image_server.start()
+    if args.metrics_port is not None:
+        start_metrics_server(ledger, args.metrics_port)
+    if args.call_log is not None:
+        ledger.open_log(args.call_log)
 
-    all_data = get_data()
+    items = get_items(get_data())
+    if args.num_workers > 1 and args.queue_dir is None:
+        history = load_cost_history(args.cost_history, key='image_path', cost_field='search_metric')
+        items = shared_schedule(items, args.num_workers, args.assignment, history)[args.worker_id]
+        logging.info(f"Worker {args.worker_id}/{args.num_workers} got {len(items)} images")
+    image_cache = None
+    if args.max_pixels is not None:
+        image_cache = ImageCache(args.image_cache_dir, max_pixels=args.max_pixels,
+                                 jpeg_quality=args.jpeg_quality, crop_jpeg_quality=args.crop_jpeg_quality)
+    if args.tree_dir is not None:
+        os.makedirs(args.tree_dir, exist_ok=True)
+    store = open_store(args.annotation_store) if args.annotation_store is not None else None
+    profiler = ImageProfiler(args.profile_dir, args.profile, args.profile_interval_ms / 1000) \
+        if args.profile is not None else None
 
-    for data in all_data:
-        try:
-            image_path = data['images'][0]['image']
-            id = image_path.split('train/')[-1].split('.')[0]
-            image_path = f"VCG-32K/{image_path}"
-        except:
-            logging.error("error in finding image path")
-            continue
+    shard_size = int(args.shard_size_mb * 2**20) if args.shard_size_mb is not None else None
+
+    # The vanilla baseline does not depend on the search, so it is submitted ahead
+    # and only joined when the SFT record is assembled.
+    vanilla_executor = ThreadPoolExecutor(max_workers=args.vanilla_prefetch) if args.vanilla_prefetch > 0 else None
 
+    def create_task(data, id, image_path):
         os.makedirs(f"temp/{id}", exist_ok=True)
-        task = MCTSTask(data=data, data_idx=id, image_path=image_path, image_server=image_server)
+        checkpoint_path = os.path.join(args.tree_dir, f"{id}.json.gz") if args.tree_dir is not None else None
+        return MCTSTask(data=data, data_idx=id, image_path=image_path, image_server=image_server,
+                        iteration_limit=args.iteration_limit,
+                        checkpoint_path=checkpoint_path, checkpoint_every=args.checkpoint_every,
+                        image_cache=image_cache,
+                        call_timeout=args.call_timeout, image_deadline=args.image_deadline,
+                        stable_rounds=args.stable_rounds, call_budget=args.call_budget,
+                        token_budget=args.token_budget,
+                        speculate_k=args.speculate_k, speculate_max_waste=args.speculate_max_waste,
+                        simulation=args.simulation, rollout_depth=args.rollout_depth,
+                        value_estimator=args.value_estimator,
+                        max_tree_nodes=args.max_tree_nodes,
+                        max_tree_bytes=int(args.max_tree_mb * 2**20) if args.max_tree_mb is not None else None,
+                        prune_tail_visits=args.prune_tail_visits,
+                        gt=store.lookup(data) if store is not None else None,
+                        rollouts=args.rollouts, rollout_reduce=args.rollout_reduce,
+                        rollout_temperature=args.rollout_temperature,
+                        search_engine=args.search_engine, beam_width=args.beam_width,
+                        branching=args.branching, branch_temperature=args.branch_temperature)
+
+    # The first calls of a search (the root caption) need nothing from earlier
+    # images, so the tasks of the next --root-prefetch images are created and
+    # start them while the current search runs.
+    root_executor = ThreadPoolExecutor(max_workers=args.root_prefetch) if args.root_prefetch > 0 else None
+
+    def process(items, raw_writer, sft_writer):
+        vanilla_futures = {}
+        prefetched_tasks = {}
+        for index, (data, id, image_path) in enumerate(items):
+            if vanilla_executor is not None:
+                for ahead in range(index, min(index + args.vanilla_prefetch, len(items))):
+                    if ahead not in vanilla_futures:
+                        ahead_data, _, ahead_image_path = items[ahead]
+                        vanilla_futures[ahead] = vanilla_executor.submit(
+                            run_in_image_context, items[ahead][1], vanilla_inference,
+                            ahead_image_path, image_server, copy.deepcopy(ahead_data), image_cache,
+                            gt=store.lookup(ahead_data) if store is not None else None
+                        )
+            if root_executor is not None:
+                for ahead in range(index + 1, min(index + 1 + args.root_prefetch, len(items))):
+                    if ahead not in prefetched_tasks:
+                        ahead_data, ahead_id, ahead_image_path = items[ahead]
+                        with image_context(ahead_id):
+                            ahead_task = create_task(ahead_data, ahead_id, ahead_image_path)
+                        future = None
+                        if ahead_task.checkpoint_path is None or not os.path.exists(ahead_task.checkpoint_path):
+                            # Prefetched calls count toward the image's usage, so also toward its deadline
+                            ahead_task.start_deadline()
+                            future = root_executor.submit(run_in_image_context, ahead_id, ahead_task.prefetch,
+                                                          args.root_prefetch_depth)
+                        prefetched_tasks[ahead] = (ahead_task, future)
 
-        root_node, search_metric = task.run()
-        best_leaf_node = task.get_best_path(root_node)
+            with image_context(id), profiler.image(id) if profiler is not None else contextlib.nullcontext():
+                if index in prefetched_tasks:
+                    task, future = prefetched_tasks.pop(index)
+                    if future is not None:
+                        try:
+                            future.result()
+                        except Exception as e:
+                            # The search makes the calls the prefetch did not
+                            logging.error(f"Root prefetch failed: {str(e)}")
+                else:
+                    task = create_task(data, id, image_path)
+
+                root_node, search_metric = task.run()
+                best_leaf_node = task.get_best_path(root_node)
         
-        gt_entities, gt_pairs = get_gt_pairs(data)
-        predicted_pairs = best_leaf_node.state['causal_pairs']
-        causal_P, causal_R, _, _, _, _, _ = evaluate(gt_entities, gt_pairs, predicted_pairs)
-
-        v_causal_P, v_causal_R, _, _, _, _, _, v_result = vanilla_inference(image_path, image_server, data)
-
-        best_leaf_node.state['precision'] = causal_P
-        best_leaf_node.state['recall'] = causal_R
-        best_leaf_node.state['vanilla_precision'] = v_causal_P
-        best_leaf_node.state['vanilla_recall'] = v_causal_R
-        best_leaf_node.state['vanilla_result'] = v_result
-
-        best_leaf_node.state['image_id'] = id
-        best_leaf_node.state['image_path'] = image_path
-        best_leaf_node.state["search_metric"] = search_metric
-
-        with open(f"ToCT/raw_sft_data.jsonl", "a") as f:
-            json.dump(best_leaf_node.state, f)
-            f.write("\n")
-
-        if causal_R != 0 or v_causal_R != 0:
-            if v_causal_R >= causal_R:
-                sft = {
-                    "image_id": id,
-                    "image_path": image_path,
-                    "trajectory": v_result
-                }
-            else:
-                sft = {
-                    "image_id": id,
-                    "image_path": image_path,
-                    "trajectory": f"{best_leaf_node.state['trajectory']}<'causal pairs'>\n{str(best_leaf_node.state['causal_pairs'])}\n</causal pairs>"
-                }
-            with open(f"ToCT/sft_data.jsonl", "a") as f:
-                json.dump(sft, f)
-                f.write("\n")
-
-        shutil.rmtree(f"temp/{id}")
+                gt_entities, gt_pairs = task.get_gt()
+                predicted_pairs = best_leaf_node.state['causal_pairs']
+                causal_P, causal_R, _, _, _, _, _ = evaluate(gt_entities, gt_pairs, predicted_pairs)
+
+                if vanilla_executor is not None:
+                    v_causal_P, v_causal_R, _, _, _, _, _, v_result = vanilla_futures.pop(index).result()
+                else:
+                    v_causal_P, v_causal_R, _, _, _, _, _, v_result = vanilla_inference(image_path, image_server, data, image_cache, gt=task.get_gt())
+
+                best_leaf_node.state['precision'] = causal_P
+                best_leaf_node.state['recall'] = causal_R
+                best_leaf_node.state['vanilla_precision'] = v_causal_P
+                best_leaf_node.state['vanilla_recall'] = v_causal_R
+                best_leaf_node.state['vanilla_result'] = v_result
+
+                best_leaf_node.state['image_id'] = id
+                best_leaf_node.state['image_path'] = image_path
+                best_leaf_node.state["search_metric"] = search_metric
+                best_leaf_node.state["stop_reason"] = task.stop_reason
+                best_leaf_node.state["search_rounds"] = task.rounds
+                best_leaf_node.state["llm_usage"] = task.usage
+                best_leaf_node.state["search_engine"] = task.search_engine
+                best_leaf_node.state["simulation"] = task.simulation
+                best_leaf_node.state["rollouts"] = task.rollouts
+                best_leaf_node.state["tree_stats"] = task.tree_stats
+                if task.speculation_stats is not None:
+                    best_leaf_node.state["speculation"] = task.speculation_stats
+
+                raw_writer.write(best_leaf_node.state)
+
+                # The same rule as build_sft.py, which can rebuild sft_data from raw_sft_data
+                sft, _ = build_sft_record(best_leaf_node.state)
+                if sft is not None:
+                    sft_writer.write(sft)
+
+                shutil.rmtree(f"temp/{id}")
+
+    def open_writers(directory):
+        return tuple(ResultWriter(os.path.join(directory, name), shard_size=shard_size,
+                                  compression=args.compression, fsync=args.fsync)
+                     for name in ("raw_sft_data.jsonl", "sft_data.jsonl"))
+
+    if args.queue_dir is None:
+        raw_writer, sft_writer = open_writers(args.output_dir)
+        # Closing flushes the writers' buffers, so records survive an exception in the loop
+        with raw_writer, sft_writer:
+            process(items, raw_writer, sft_writer)
+    else:
+        # Batches of images are leased from the shared queue until all are done;
+        # each batch's outputs are committed as a whole, and
+        # `python -m utils.work_queue merge` assembles them into ToCT/.
+        work_queue = WorkQueue(args.queue_dir, lease_seconds=args.lease_seconds)
+        work_queue.initialize([id for _, id, _ in items], batch_size=args.queue_batch_size)
+        items_by_id = {item[1]: item for item in items}
+        while (lease := work_queue.acquire()) is not None:
+            with lease:
+                batch_items = [items_by_id[id] for id in lease.image_ids if id in items_by_id]
+                if len(batch_items) < len(lease.image_ids):
+                    logging.warning(f"{len(lease.image_ids) - len(batch_items)} images of batch {lease.batch_id} "
+                                    "are not in this worker's dataset")
+                logging.info(f"Processing batch {lease.batch_id} ({len(batch_items)} images)")
+                raw_writer, sft_writer = open_writers(lease.staging_dir)
+                with raw_writer, sft_writer:
+                    process(batch_items, raw_writer, sft_writer)
+                lease.commit()
+        logging.info(f"Work queue {args.queue_dir} is done")
+
+    if vanilla_executor is not None:
+        vanilla_executor.shutdown()
+    if root_executor is not None:
+        root_executor.shutdown()
+
+    for endpoint_stats in get_endpoint_stats():
+        logging.info(f"vLLM endpoint stats: {endpoint_stats}")
+    ledger.close()
+    call_summary = args.call_summary or os.path.join(args.output_dir, "llm_calls.json")
+    if args.queue_dir is not None:
+        stem, ext = os.path.splitext(call_summary)
+        call_summary = f"{stem}-{work_queue.worker}{ext}"
+    elif args.num_workers > 1:
+        stem, ext = os.path.splitext(call_summary)
+        call_summary = f"{stem}-worker{args.worker_id}{ext}"
+    ledger.save_summary(call_summary)
+    logging.info(f"Model call totals: {ledger.summary()['total']}")
+    if profiler is not None:
+        logging.info(f"Profile report of {profiler.profile_dir}:\n{profiler.report()}")
 
     image_server.stop()
 
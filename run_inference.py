@@ -1,56 +1,278 @@
 from utils.prompt import *
 from utils.evaluate import *
 from utils.img_server import ImageServer
-from utils.evaluate import evaluate, vanilla_inference
+from utils.image_cache import ImageCache
+from utils.result_writer import ResultWriter, iter_records
+from utils.metrics import MetricAggregator, merge_aggregators
+from utils.scheduler import load_cost_history, shared_schedule
+from utils.vllm_infer import ledger, new_usage
+from utils.call_ledger import start_metrics_server
+from utils.annotation_store import open_store
+from utils.profiling import PROFILE_MODES, ImageProfiler
+from utils.log import setup_logging
+from utils.evaluate import evaluate, vanilla_inference, score_vanilla_result
+from utils.batch_infer import IMAGE_MODES, RUNNERS, batch_line, image_payload_url, iter_batch_results, run_batch_file
 
+import argparse
+import contextlib
 import logging
 import json
-import numpy as np
+import os
+import shlex
+import time
 
-def get_data():
-    with open("VCG-32K/COCO/annotations/test.jsonl", "r") as f:
-        all_data = [json.loads(line) for line in f]
+logger = logging.getLogger(__name__)
+
+METRIC_NAMES = ["causal_P", "causal_R", "detection_P", "detection_R", "mean_giou", "f1", "ideal_P", "ideal_R"]
+
+def get_data(annotation_paths):
+    all_data = []
+    for annotation_path in annotation_paths:
+        with open(annotation_path, "r") as f:
+            all_data.extend(json.loads(line) for line in f)
     return all_data
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate the model on VCG-32K with the general prompt")
+    parser.add_argument("--annotations", nargs="+", default=["VCG-32K/COCO/annotations/test.jsonl"],
+                        help="annotation files to evaluate on, e.g. the COCO and 365 test splits")
+    parser.add_argument("--annotation-store", default=None,
+                        help="read the ground truth from a store compiled with "
+                             "`python -m utils.annotation_store compile` instead of parsing it per image")
+    parser.add_argument("--max-pixels", type=int, default=None,
+                        help="resize images to at most this many pixels before sending them to the model")
+    parser.add_argument("--image-cache-dir", default="cache/images",
+                        help="where resized images are cached when --max-pixels is set")
+    parser.add_argument("--jpeg-quality", type=int, default=95, help="JPEG quality of resized images")
+    parser.add_argument("--shard-size-mb", type=float, default=None,
+                        help="rotate the results file into shards of about this many MB of uncompressed JSON")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None,
+                        help="compress result shards")
+    parser.add_argument("--fsync", choices=["never", "close", "always"], default="close",
+                        help="when the results file is fsynced")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics of the model calls at http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--call-log", default=None, help="append a jsonl record of every model call here")
+    parser.add_argument("--call-summary", default="output/llm_calls.json",
+                        help="where to write the per-action summary of the model calls at the end of the run")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="split the images across this many workers, balancing their estimated cost")
+    parser.add_argument("--worker-id", type=int, default=0, help="which of the --num-workers shares to process")
+    parser.add_argument("--assignment", default="output/assignment.json",
+                        help="with --num-workers, the partition of the images shared by all workers; the first "
+                             "worker writes it and the others read it (delete it to re-plan)")
+    parser.add_argument("--cost-history", nargs="*", default=[],
+                        help="outputs of earlier runs whose per-image latencies calibrate the cost estimates; "
+                             "pass finished outputs, not files that running workers append to")
+    parser.add_argument("--progress-every", type=float, default=30,
+                        help="seconds between progress reports")
+    parser.add_argument("--metrics-state", default="output/metrics_state.json",
+                        help="running metrics are saved here (with the worker id appended when "
+                             "--num-workers > 1)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from --metrics-state and the images already in output/results.jsonl "
+                             "instead of starting a fresh evaluation")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="profile the CPU side of each image with cProfile (the image's own thread) or a "
+                             "sampler (every thread), saving <profile dir>/images/<image>.pstats and a report "
+                             "of the hottest functions per stage")
+    parser.add_argument("--profile-dir", default="profile", help="where --profile writes its files")
+    parser.add_argument("--profile-interval-ms", type=float, default=5, help="sampling interval of --profile sample")
+    parser.add_argument("--batch-dir", default=None,
+                        help="instead of one request per image, write all requests to <dir>/requests.jsonl in the "
+                             "OpenAI batch format, run them offline with --batch-runner and evaluate "
+                             "<dir>/results.jsonl (a results file already there is evaluated without rerunning)")
+    parser.add_argument("--batch-runner", default="vllm",
+                        help=f"{' or '.join(RUNNERS)}, or a command taking vLLM run_batch's -i/-o/--model arguments")
+    parser.add_argument("--batch-runner-args", default="--trust-remote-code --max-model-len 32768",
+                        help="extra arguments of the batch runner")
+    parser.add_argument("--batch-images", choices=IMAGE_MODES, default="inline",
+                        help="put the images into the batch file as base64, or reference them as file:// URLs")
+    parser.add_argument("--model", default="./model/", help="model the batch runner loads")
+    parser.add_argument("--merge", action="store_true",
+                        help="instead of evaluating, merge the --metrics-state files of all --num-workers workers "
+                             "into --metrics-state and report the combined metrics")
+    args = parser.parse_args()
+    if args.merge and args.num_workers < 2:
+        parser.error("--merge needs the --num-workers of the run to merge")
+    if args.num_workers > 1 and not args.merge:
+        args.metrics_state = worker_state_paths(args.metrics_state, args.num_workers)[args.worker_id]
+        stem, ext = os.path.splitext(args.call_summary)
+        args.call_summary = f"{stem}-worker{args.worker_id}{ext}"
+    return args
+
+def run_batch(args, pending, image_cache, store, record, profile_image=contextlib.nullcontext):
+    """
+    Evaluate ``pending`` images through one offline batch file. Requests are keyed
+    by image path, so results come back in any order and are scored as they are read.
+    """
+    os.makedirs(args.batch_dir, exist_ok=True)
+    input_path = os.path.join(args.batch_dir, "requests.jsonl")
+    output_path = os.path.join(args.batch_dir, "results.jsonl")
+    pending = {image_path: data for data, image_path in pending}
+    # (path sent to the model, coordinate transform) of each image, as in vanilla_inference
+    prepared = {image_path: image_cache.prepare(image_path) if image_cache is not None else (image_path, None)
+                for image_path in pending}
+
+    if not os.path.exists(output_path):
+        with open(input_path, "w") as f:
+            for image_path, (model_image_path, _) in prepared.items():
+                image_url = image_payload_url(model_image_path, args.batch_images)
+                f.write(json.dumps(batch_line(image_path, image_url, args.model, General_prompt)) + "\n")
+        extra_args = shlex.split(args.batch_runner_args)
+        if args.batch_images == "file" and args.batch_runner == "vllm":
+            extra_args += ["--allowed-local-media-path", os.getcwd()]
+        elapsed = run_batch_file(input_path, output_path, args.model, args.batch_runner, extra_args)
+        logger.info(f"Batch of {len(pending)} images ran in {elapsed:.1f} seconds")
+    else:
+        logger.info(f"Evaluating the existing batch results {output_path}")
+
+    for image_path, completions, usage, error in iter_batch_results(output_path):
+        data = pending.pop(image_path, None)
+        if data is None:
+            # Evaluated before this run resumed, or not part of this run
+            continue
+        with profile_image(image_path):
+            gt = store.lookup(data) if store is not None else None
+            if not completions:
+                logger.warning(f"No batch result for {image_path}: {error}")
+                scores = (0, 0, 0, 0, 0, 0, 0, "No result generated")
+            else:
+                scores = score_vanilla_result(completions[0], data, prepared[image_path][1], gt)
+            # Per-image latency is not measured in a batch
+            record(image_path, scores, (usage or {}).get("total_tokens", 0), None)
+    if pending:
+        logger.warning(f"{len(pending)} images have no line in {output_path}; "
+                        f"remove it to run them again")
+
+def worker_state_paths(metrics_state, num_workers):
+    stem, ext = os.path.splitext(metrics_state)
+    return [f"{stem}-worker{worker_id}{ext}" for worker_id in range(num_workers)]
+
+def report(aggregator):
+    """Print the overall and per-subset metrics."""
+    mean, std = aggregator.mean, aggregator.std
+    print(f"causal_P: {mean('causal_P')}, causal_R: {mean('causal_R')}, detection_P: {mean('detection_P')}, detection_R: {mean('detection_R')}, mean_giou: {mean('mean_giou')}, f1: {mean('f1')}, ideal_P: {mean('ideal_P')}, ideal_R: {mean('ideal_R')}, causal_P_std: {std('causal_P')}, causal_R_std: {std('causal_R')}, detection_P_std: {std('detection_P')}, detection_R_std: {std('detection_R')}, mean_giou_std: {std('mean_giou')}, f1_std: {std('f1')}, ideal_P_std: {std('ideal_P')}, ideal_R_std: {std('ideal_R')}")
+    for subset, stats in aggregator.summary().items():
+        if subset != 'all':
+            print(f"[{subset}] " + ", ".join(f"{name}: {value['mean']} (std {value['std']})" for name, value in stats.items()))
+
+def merge_workers(args):
+    """Combine the saved metrics of every worker of a --num-workers run."""
+    paths = worker_state_paths(args.metrics_state, args.num_workers)
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"No metrics state of workers {', '.join(missing)}")
+    aggregator = merge_aggregators(paths)
+    aggregator.save(args.metrics_state)
+    logger.info(f"Merged {len(paths)} workers ({aggregator.images} images) into {args.metrics_state}")
+    report(aggregator)
+
 def main():
+    args = parse_args()
+    setup_logging()
+    if args.merge:
+        merge_workers(args)
+        return
 
     image_server = ImageServer()
     image_server.start()
+    if args.metrics_port is not None:
+        start_metrics_server(ledger, args.metrics_port)
+    if args.call_log is not None:
+        ledger.open_log(args.call_log)
+
+    image_cache = None
+    if args.max_pixels is not None:
+        image_cache = ImageCache(args.image_cache_dir, max_pixels=args.max_pixels, jpeg_quality=args.jpeg_quality)
 
-    all_data = get_data()
-    causal_P_list = []
-    causal_R_list = []
-    detection_P_list = []
-    detection_R_list = []
-    mean_giou_list = []
-    f1_list = []
-    ideal_P_list = []
-    ideal_R_list = []
-
-    for data in all_data:
+    items = []
+    for data in get_data(args.annotations):
         try:
-            image_path = data['images'][0]['image']
-            image_path = f"VCG-32K/{image_path}"
+            image_path = f"VCG-32K/{data['images'][0]['image']}"
         except:
-            logging.error("error in finding image path")
+            logger.error("error in finding image path")
             continue
+        items.append((data, image_path))
+    store = open_store(args.annotation_store) if args.annotation_store is not None else None
+    if args.num_workers > 1:
+        history = load_cost_history(args.cost_history, key='image_path', cost_field='latency')
+        items = shared_schedule(items, args.num_workers, args.assignment, history)[args.worker_id]
+    shard_size = int(args.shard_size_mb * 2**20) if args.shard_size_mb is not None else None
+    results_writer = ResultWriter("output/results.jsonl", shard_size=shard_size,
+                                  compression=args.compression, fsync=args.fsync)
+
+    if args.resume and os.path.exists(args.metrics_state):
+        aggregator = MetricAggregator.load(args.metrics_state, total=len(items))
+    else:
+        if os.path.exists(args.metrics_state) and not args.resume:
+            logger.info(f"Starting a fresh evaluation; {args.metrics_state} will be overwritten "
+                         "(pass --resume to continue it)")
+        aggregator = MetricAggregator(METRIC_NAMES, total=len(items))
+        # Saved at once, so a resume after a crash knows which results are this run's
+        aggregator.save(args.metrics_state)
+    if args.resume:
+        # Results written after the last state save are in the output already; count them instead of redoing them.
+        # The output also holds earlier runs' results, so only this run's records of this dataset count.
+        paths = {image_path for _, image_path in items}
+        recovered = 0
+        for result in iter_records(results_writer.path, include_open=args.compression is None):
+            image_path = result.get("image_path")
+            if result.get("run_id") == aggregator.run_id and image_path in paths and image_path not in aggregator.done:
+                metrics = {name: result[name] for name in METRIC_NAMES}
+                aggregator.update(metrics, subset=image_path.split('/')[1], tokens=result.get("tokens", 0),
+                                  key=image_path)
+                recovered += 1
+        logger.info(f"Resuming with {aggregator.images} images already evaluated "
+                    f"({recovered} recovered from the results)")
+    last_report = time.time()
 
-        causal_P, causal_R, detection_P, detection_R, mean_giou, ideal_P, ideal_R, result = vanilla_inference(image_path, image_server, data)
+    def record(image_path, scores, tokens, latency):
+        nonlocal last_report
+        causal_P, causal_R, detection_P, detection_R, mean_giou, ideal_P, ideal_R, result = scores
         f1 = 2 * causal_P * causal_R / (causal_P + causal_R + 1e-10)
 
-        causal_P_list.append(causal_P)
-        causal_R_list.append(causal_R)
-        detection_P_list.append(detection_P)
-        detection_R_list.append(detection_R)
-        mean_giou_list.append(mean_giou)
-        f1_list.append(f1)
-        ideal_P_list.append(ideal_P)
-        ideal_R_list.append(ideal_R)
-        with open("output/results.jsonl", "a") as f:
-            f.write(json.dumps({"causal_P": causal_P, "causal_R": causal_R, "detection_P": detection_P, "detection_R": detection_R, "mean_giou": mean_giou, "f1": f1, "ideal_P": ideal_P, "ideal_R": ideal_R, "result": result}) + "\n")
+        metrics = {"causal_P": causal_P, "causal_R": causal_R, "detection_P": detection_P, "detection_R": detection_R, "mean_giou": mean_giou, "f1": f1, "ideal_P": ideal_P, "ideal_R": ideal_R}
+        results_writer.write({**metrics, "result": result, "image_path": image_path, "latency": latency,
+                              "tokens": tokens, "run_id": aggregator.run_id})
+        aggregator.update(metrics, subset=image_path.split('/')[1], tokens=tokens, key=image_path)
+
+        if time.time() - last_report >= args.progress_every:
+            logger.info(aggregator.progress())
+            # The state must not cover images whose results are still buffered
+            results_writer.flush()
+            aggregator.save(args.metrics_state)
+            last_report = time.time()
+
+    profiler = ImageProfiler(args.profile_dir, args.profile, args.profile_interval_ms / 1000) \
+        if args.profile is not None else None
 
-    print(f"causal_P: {np.mean(causal_P_list)}, causal_R: {np.mean(causal_R_list)}, detection_P: {np.mean(detection_P_list)}, detection_R: {np.mean(detection_R_list)}, mean_giou: {np.mean(mean_giou_list)}, f1: {np.mean(f1_list)}, ideal_P: {np.mean(ideal_P_list)}, ideal_R: {np.mean(ideal_R_list)}, causal_P_std: {np.std(causal_P_list)}, causal_R_std: {np.std(causal_R_list)}, detection_P_std: {np.std(detection_P_list)}, detection_R_std: {np.std(detection_R_list)}, mean_giou_std: {np.std(mean_giou_list)}, f1_std: {np.std(f1_list)}, ideal_P_std: {np.std(ideal_P_list)}, ideal_R_std: {np.std(ideal_R_list)}")
+    def profile_image(image_path):
+        return profiler.image(image_path) if profiler is not None else contextlib.nullcontext()
+
+    pending = [(data, image_path) for data, image_path in items if image_path not in aggregator.done]
+    try:
+        if args.batch_dir is None:
+            for data, image_path in pending:
+                with profile_image(image_path):
+                    start_time = time.time()
+                    usage = new_usage()
+                    gt = store.lookup(data) if store is not None else None
+                    scores = vanilla_inference(image_path, image_server, data, image_cache, usage, gt)
+                    record(image_path, scores, usage["total_tokens"], time.time() - start_time)
+        else:
+            run_batch(args, pending, image_cache, store, record, profile_image)
+    finally:
+        # Even if the loop fails, buffered results reach the file and the state matches them
+        results_writer.close()
+        aggregator.save(args.metrics_state)
+
+    ledger.close()
+    ledger.save_summary(args.call_summary)
+    if profiler is not None:
+        logger.info(f"Profile report of {profiler.profile_dir}:\n{profiler.report()}")
+
+    report(aggregator)
 
 if __name__ == "__main__":
     main()
-
@@ -1,3 +1,5 @@
+import importlib
+import logging
 import math
 import random
 import time
@@ -6,34 +8,387 @@ import numpy
 
 from node import TreeNode
 
+logger = logging.getLogger(__name__)
 
-def mcts_entrance(mcts_task):
-    root_node = TreeNode()
+
+def mcts_entrance(mcts_task, root_node=None):
+    """
+    Run up to ``iteration_limit`` rounds, stopping early when the tree is fully
+    explored, the best leaf's value has converged, or a per-image budget runs
+    out. The reason is recorded in ``mcts_task.stop_reason``.
+
+    When ``root_node`` is a previously searched tree, the search continues from
+    it and only the rounds beyond ``mcts_task.rounds`` are run.
+    """
+    if root_node is None:
+        root_node = TreeNode()
+        mcts_task.rounds = 0
 
     search_start_time = time.time()
-    for iteration_count in range(mcts_task.iteration_limit):
-        print(f"<Begin search round {iteration_count + 1}/{mcts_task.iteration_limit}>")
+    mcts_task.stop_reason = 'iteration_limit'
+    last_best_value = None
+    stable_count = 0
+    for iteration_count in range(mcts_task.rounds, mcts_task.iteration_limit):
+        stop_reason = mcts_task.budget_exhausted()
+        if stop_reason is None and iteration_count > 0 and is_exhausted(root_node):
+            stop_reason = 'all_terminal'
+        if stop_reason is not None:
+            mcts_task.stop_reason = stop_reason
+            break
+
+        logger.debug("<Begin search round %d/%d>", iteration_count + 1, mcts_task.iteration_limit)
         root_node = execute_round(root_node, mcts_task)
+        mcts_task.rounds = iteration_count + 1
+        if mcts_task.max_tree_nodes is not None or mcts_task.max_tree_bytes is not None:
+            prune_tree(root_node, mcts_task)
+        if mcts_task.checkpoint_path is not None and mcts_task.rounds % mcts_task.checkpoint_every == 0:
+            mcts_task.save_checkpoint(root_node)
+
+        if mcts_task.stable_rounds is not None:
+            best_value = get_best_leaf_value(root_node)
+            if last_best_value is not None and abs(best_value - last_best_value) < 1e-10:
+                stable_count += 1
+            else:
+                stable_count = 0
+            last_best_value = best_value
+            if stable_count >= mcts_task.stable_rounds:
+                mcts_task.stop_reason = 'converged'
+                break
     
     search_metric = time.time() - search_start_time
 
     return root_node, search_metric
 
 
+def open_leaves(root_node):
+    """Nodes under ``root_node`` that are neither terminal nor expanded, e.g. the frontier of a resumed search."""
+    leaves = []
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        if node.children:
+            stack.extend(node.children)
+        elif not node.is_terminal:
+            leaves.append(node)
+    return leaves
+
+
+def expand_batch(nodes, mcts_task):
+    """
+    Expand ``nodes`` with one batched round of model calls (``branching``
+    sampled completions each) and value the new children together with
+    ``simulate_batch``. Nodes without children are marked terminal. Returns the
+    new children.
+    """
+    proposed = mcts_task.step_many(nodes, num_completions=mcts_task.branching,
+                                   temperature=mcts_task.branch_temperature)
+    new_children = []
+    for node, proposed_sub_nodes in zip(nodes, proposed):
+        node.is_fully_expanded = True
+        if proposed_sub_nodes is None:
+            node.is_terminal = True
+            continue
+        existing_states = []
+        for sub_node in proposed_sub_nodes:
+            if sub_node.state in existing_states:
+                continue
+            existing_states.append(sub_node.state)
+            node.append_children(sub_node)
+            sub_node.visit_count = 1
+            new_children.append(sub_node)
+        if not node.children:
+            node.is_terminal = True
+    simulate_batch(new_children, mcts_task)
+    return new_children
+
+
+def simulate_batch(nodes, mcts_task):
+    """
+    Value ``nodes`` as ``simulate_node`` would under ``mcts_task.simulation``,
+    for the frontier engines. The rollouts of all nodes advance in lockstep,
+    each round of steps sent to the server together, and are dropped once
+    scored, so the tree only holds expanded nodes and their children. Stepping
+    a JudgeCausality node clears its candidate pairs, so they are put back for
+    the node's own expansion.
+    """
+    simulation = mcts_task.simulation
+    if simulation not in SIMULATIONS:
+        raise ValueError(f"Unknown simulation strategy: {simulation}")
+    if simulation == 'estimator':
+        estimator = get_value_estimator(mcts_task.value_estimator)
+        for node in nodes:
+            node.update_value(estimator(node, mcts_task))
+        return
+
+    max_steps = {'rollout': None, 'depth_limited': mcts_task.rollout_depth, 'reward': 0}[simulation]
+    candidate_pairs = [node.state.get('candidate_pairs') for node in nodes]
+    ends = list(nodes)
+    steps = 0
+    while max_steps is None or steps < max_steps:
+        active = [i for i, node in enumerate(ends) if not node.is_terminal]
+        if not active:
+            break
+        proposed = mcts_task.step_many([ends[i] for i in active])
+        for i, proposed_sub_nodes in zip(active, proposed):
+            if proposed_sub_nodes is None:
+                ends[i].is_terminal = True
+                continue
+            proposed_node = random.choice(proposed_sub_nodes)
+            ends[i].append_children(proposed_node)
+            ends[i] = proposed_node
+        steps += 1
+    rewards = [mcts_task.reward(end) for end in ends]
+    for node, reward, pairs in zip(nodes, rewards, candidate_pairs):
+        node.drop_children()
+        if pairs is not None:
+            node.state['candidate_pairs'] = pairs
+        node.update_value(reward)
+
+
+def check_frontier_state():
+    """
+    Simulate and then expand a JudgeCausality node, as beam search does, with a
+    stand-in task answering without a model; checks that the expansion is still
+    asked about the node's candidate pairs. Returns them.
+    """
+    from task import MCTSTask
+
+    class StandInTask:
+        simulation = 'depth_limited'
+        rollout_depth = 1
+        branching = 1
+        branch_temperature = 0.0
+        image_transform = None
+        answers = {
+            'JudgeCausality': "<think>t</think><causal pairs>[{'a': [0, 0, 10, 10], 'b': [5, 5, 20, 20]}]</causal pairs>",
+            'SelectRegion': "<think>t</think><region name>a</region name><bounding box>[0, 0, 50, 50]</bounding box>",
+        }
+
+        def __init__(self):
+            self.asked = []
+
+        def step_many(self, nodes, num_completions=1, temperature=0.0):
+            proposed = []
+            for node in nodes:
+                self.asked.append((node, list(node.state['candidate_pairs'])))
+                proposed.append(MCTSTask.build_children(self, node, (node.action, None, None, None),
+                                                        [self.answers[node.action]]))
+            return proposed
+
+        def reward(self, node):
+            return 0.0
+
+    pairs = [{'a': [0, 0, 10, 10], 'b': [5, 5, 20, 20]}]
+    parent = TreeNode()
+    parent.action = 'ProposePair'
+    node = TreeNode()
+    parent.append_children(node)
+    node.crop_info = {'crop_bbox': [0, 0, 100, 100], 'original_size': (100, 100)}
+    node.state = {'trajectory': "", 'explored_regions': [], 'current_region': ['a', '[0, 0, 100, 100]'],
+                  'causal_pairs': [], 'candidate_pairs': list(pairs)}
+    task = StandInTask()
+    simulate_batch([node], task)
+    expand_batch([node], task)
+    asked = [asked_pairs for asked_node, asked_pairs in task.asked if asked_node is node]
+    assert asked == [pairs, pairs], f"Expansion lost the candidate pairs: {asked}"
+    return pairs
+
+
+def back_up_max(root_node):
+    """Set every expanded node's value to the best value below it, so get_best_path ends on the best leaf."""
+    order = []
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(node.children)
+    for node in reversed(order):
+        if node.children:
+            node.value = float(node.child_values[:len(node.children)].max())
+            node.visit_count = int(node.child_visits[:len(node.children)].sum())
+
+
+def _frontier_search(mcts_task, root_node, select, resume_frontier=open_leaves):
+    """
+    Shared loop of beam and best-first search. Each round ``select(frontier)``
+    splits the frontier into the nodes to expand now and the nodes kept for
+    later; the chosen nodes are expanded together with ``expand_batch``.
+    ``resume_frontier(root_node)`` rebuilds the frontier of a resumed search.
+    """
+    if root_node is None:
+        root_node = TreeNode()
+        mcts_task.rounds = 0
+    frontier = resume_frontier(root_node)
+
+    search_start_time = time.time()
+    mcts_task.stop_reason = 'iteration_limit'
+    for iteration_count in range(mcts_task.rounds, mcts_task.iteration_limit):
+        stop_reason = mcts_task.budget_exhausted()
+        if stop_reason is None and not frontier:
+            stop_reason = 'all_terminal'
+        if stop_reason is not None:
+            mcts_task.stop_reason = stop_reason
+            break
+
+        batch, frontier = select(frontier)
+        logger.debug("<Begin search round %d/%d> expanding %d nodes", iteration_count + 1,
+                     mcts_task.iteration_limit, len(batch))
+        new_children = expand_batch(batch, mcts_task)
+        frontier.extend(child for child in new_children if not child.is_terminal)
+        mcts_task.rounds = iteration_count + 1
+        if mcts_task.max_tree_nodes is not None or mcts_task.max_tree_bytes is not None:
+            prune_tree(root_node, mcts_task)
+            frontier = [node for node in frontier if not node.is_pruned]
+        back_up_max(root_node)
+        if mcts_task.checkpoint_path is not None and mcts_task.rounds % mcts_task.checkpoint_every == 0:
+            mcts_task.save_checkpoint(root_node)
+
+    back_up_max(root_node)
+    search_metric = time.time() - search_start_time
+    return root_node, search_metric
+
+
+def beam_entrance(mcts_task, root_node=None):
+    """
+    Beam search: every round expands the whole beam at once and keeps the
+    ``beam_width`` best of the new children. One round per level of the tree.
+    """
+    def select(frontier):
+        ranked = sorted(frontier, key=lambda node: node.value, reverse=True)
+        # Children of the nodes expanded now form the next beam; the rest is dropped
+        return ranked[:mcts_task.beam_width], []
+
+    def resume_frontier(root_node):
+        # Round r creates the nodes at depth r; open leaves above them were dropped from the beam
+        return [node for node in open_leaves(root_node) if node.depth == mcts_task.rounds]
+
+    return _frontier_search(mcts_task, root_node, select, resume_frontier)
+
+
+def best_first_entrance(mcts_task, root_node=None):
+    """
+    Best-first search: every round expands the ``beam_width`` highest-valued
+    open nodes anywhere in the tree; the other open nodes stay in the frontier.
+    """
+    def select(frontier):
+        ranked = sorted(frontier, key=lambda node: node.value, reverse=True)
+        return ranked[:mcts_task.beam_width], ranked[mcts_task.beam_width:]
+
+    return _frontier_search(mcts_task, root_node, select)
+
+
+def is_exhausted(node):
+    """True when no selection from ``node`` can reach a node that still needs expanding."""
+    if node.is_terminal:
+        return True
+    if not node.is_fully_expanded:
+        return False
+    return all(is_exhausted(child) for child in node.children)
+
+
+def tree_stats(root_node):
+    """(node count, approximate bytes) of the tree under ``root_node``."""
+    nodes, size = 0, 0
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        size += node.approx_bytes()
+        stack.extend(node.children)
+    return nodes, size
+
+
+def get_greedy_path(node):
+    """Nodes from ``node`` down the highest-valued unpruned children, as get_best_path follows them."""
+    path = [node]
+    while not node.is_terminal:
+        children = [child for child in node.children if not child.is_pruned]
+        if not children:
+            break
+        node = max(children, key=lambda child: child.value)
+        path.append(node)
+    return path
+
+
+def prune_tree(root_node, mcts_task):
+    """
+    Keep the tree within ``max_tree_nodes`` nodes and ``max_tree_bytes`` bytes.
+
+    Once the tree is over a limit, first the rollout tails off the greedy best
+    path that were visited at most ``prune_tail_visits`` times are dropped:
+    their reward was already backed up, and the node they hang from stays
+    unexpanded, so selection can still expand it later. With several rollouts
+    per leaf, the visits are compared per tail. If that is not enough,
+    the siblings along the best path whose UCB upper bound is below the value of
+    the best path's child are pruned: their subtrees are dropped and they keep
+    only their statistics and causal pairs, as terminal nodes. A parent always
+    keeps its best child, so the best path never runs into a pruned node.
+    Returns the number of nodes removed or reduced to such stubs.
+    """
+    def over_limit():
+        nodes, size = tree_stats(root_node)
+        mcts_task.note_tree_size(nodes, size)
+        return (mcts_task.max_tree_nodes is not None and nodes > mcts_task.max_tree_nodes) or \
+            (mcts_task.max_tree_bytes is not None and size > mcts_task.max_tree_bytes)
+
+    if not over_limit():
+        return 0
+    best_path = get_greedy_path(root_node)
+    on_best_path = {id(node) for node in best_path}
+    removed = 0
+
+    # Nodes with children that were never expanded themselves only carry rollout
+    # tails, one per rollout (``--rollouts``); they go once none of them is on the
+    # best path and each was visited at most ``prune_tail_visits`` times
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        if node.children and not node.is_fully_expanded and \
+                not any(id(child) in on_best_path for child in node.children):
+            tail_visits = node.child_visits[:len(node.children)]
+            if (tail_visits <= mcts_task.prune_tail_visits).all():
+                removed += node.drop_children()
+                continue
+        stack.extend(node.children)
+
+    if removed == 0 or over_limit():
+        for parent, best_child in zip(best_path, best_path[1:]):
+            if not parent.is_fully_expanded:
+                continue
+            ucb_values = get_ucb_values(parent, mcts_task) if parent.children else []
+            for child, ucb_value in zip(parent.children, ucb_values):
+                if child is best_child or child.is_pruned or child.visit_count == 0:
+                    continue
+                if ucb_value < best_child.value:
+                    # The stub itself counts as pruned, besides its dropped subtree
+                    removed += child.drop_children() + 1
+                    child.drop_text()
+
+    mcts_task.pruned_nodes += removed
+    if removed:
+        logger.debug("Pruned %d nodes", removed)
+    return removed
+
+
+def get_best_leaf_value(node):
+    """Value of the leaf reached by greedily following the highest-valued unpruned child."""
+    return get_greedy_path(node)[-1].value
+
+
 def execute_round(root_node, mcts_task):
     # 维护selection path以便backpropagation
     selection_path = []
     
-    print("*" * 30, "phase selection", "*" * 30, "\n")
+    logger.debug("phase selection")
     selected_node = select_node(root_node, mcts_task, selection_path)
-    print(f"Selected node: {selected_node.action}, depth: {selected_node.depth}\n")
+    logger.debug("Selected node: %s, depth: %d", selected_node.action, selected_node.depth)
 
-    print("*" * 30, "phase expansion", "*" * 30, "\n")
+    logger.debug("phase expansion")
     simulation_start_node = selected_node
     outcome_reward = None
     
     if selected_node.is_terminal:
-        print("This is a terminal node, no further expansion required.\n")
+        logger.debug("This is a terminal node, no further expansion required.")
         outcome_reward = mcts_task.reward(selected_node)
     else:
         # 扩展节点并选择一个子节点进行simulation
@@ -41,24 +396,29 @@ def execute_round(root_node, mcts_task):
         if expanded_child != selected_node:  # 如果成功扩展了新节点
             simulation_start_node = expanded_child
             selection_path.append(expanded_child)  # 将新节点添加到selection path
-            print(f"Complete expansion!, expanded node count: {len(selected_node.children)}")
-            print(f"Selected child for simulation: {expanded_child.action}")
+            logger.debug("Complete expansion!, expanded node count: %d", len(selected_node.children))
+            logger.debug("Selected child for simulation: %s", expanded_child.action)
         else:
-            print("Node marked as terminal during expansion.\n")
+            logger.debug("Node marked as terminal during expansion.")
             outcome_reward = mcts_task.reward(selected_node)
 
-    print("*" * 30, "phase simulation", "*" * 30, "\n")
+    logger.debug("phase simulation")
+    speculator = getattr(mcts_task, 'speculator', None)
+    if speculator is not None:
+        # The rollout below waits on the model; meanwhile run the calls of the
+        # nodes the next rounds are likely to expand.
+        speculator.speculate(get_likely_frontier(root_node, mcts_task, speculator.k, exclude=simulation_start_node))
     if outcome_reward is None:
         if simulation_start_node.is_terminal:
             outcome_reward = mcts_task.reward(simulation_start_node)
-            print("Simulation start node is terminal, using terminal reward.\n")
+            logger.debug("Simulation start node is terminal, using terminal reward.")
         else:
             # 从新扩展的子节点开始rollout，并跟踪rollout路径
             outcome_reward, rollout_path = simulate_node(simulation_start_node, mcts_task)
             # 将rollout路径添加到selection_path
             selection_path.extend(rollout_path)
 
-    print("*" * 30, "phase backpropagation", "*" * 30, "\n")
+    logger.debug("phase backpropagation")
     # 将outcome_reward沿完整的selection_path传播
     back_propagate(selection_path, outcome_reward, mcts_task)
 
@@ -73,54 +433,50 @@ def select_node(current_node, mcts_task, selection_path):
     return current_node
 
 
+def get_ucb_values(parent_node, mcts_task):
+    """UCB1 scores of all children of ``parent_node``, in ``children`` order."""
+    child_count = len(parent_node.children)
+    visits = parent_node.child_visits[:child_count]
+    values = parent_node.child_values[:child_count]
+    # UCB1 formula for node selection
+    exploration_term = mcts_task.exploration_constant * numpy.sqrt(
+        2 * math.log(max(parent_node.visit_count, 1)) / numpy.maximum(visits, 1)
+    )
+    # 确保未访问的节点会被选中
+    return numpy.where(visits > 0, values + exploration_term, values + 1.0)
+
+
+def get_likely_frontier(root_node, mcts_task, k, exclude=None):
+    """
+    Up to ``k`` nodes that selection is most likely to reach and expand next,
+    most likely first: a depth-first walk of the tree in descending UCB order
+    that stops at not yet expanded nodes.
+    """
+    frontier = []
+    stack = [root_node]
+    while stack and len(frontier) < k:
+        node = stack.pop()
+        if node.is_terminal or node is exclude:
+            continue
+        if not node.is_fully_expanded:
+            frontier.append(node)
+        elif node.children:
+            # Ascending order, so the child with the highest UCB is popped first
+            order = numpy.argsort(get_ucb_values(node, mcts_task), kind='stable')
+            stack.extend(node.children[i] for i in order)
+    return frontier
+
+
 def get_best_child(parent_node, mcts_task):
     # 如果没有子节点，将父节点标记为终端节点
     if not parent_node.children:
         parent_node.is_terminal = True
         return parent_node
-    
-    best_value = mcts_task.low_value
-    best_child_nodes = []
-    
-    for child_node in parent_node.children:
-        # UCB1 formula for node selection
-        if child_node.visit_count > 0:
-            exploitation_term = child_node.value
-            exploration_term = mcts_task.exploration_constant * math.sqrt(
-                2 * math.log(parent_node.visit_count) / child_node.visit_count
-            )
-            ucb_value = exploitation_term + exploration_term
-        else:
-            ucb_value = child_node.value + 1.0  # 确保未访问的节点会被选中
 
-        if ucb_value > best_value:
-            best_value = ucb_value
-            best_child_nodes = [child_node]
-        elif ucb_value == best_value:
-            best_child_nodes.append(child_node)
-    
-    # 如果没有找到最佳子节点（所有UCB值都小于等于low_value），
-    # 选择UCB值最高的节点
-    if not best_child_nodes:
-        # 重新计算，这次找到实际的最佳值
-        ucb_values = []
-        for child_node in parent_node.children:
-            if child_node.visit_count > 0:
-                exploitation_term = child_node.value
-                exploration_term = mcts_task.exploration_constant * math.sqrt(
-                    2 * math.log(parent_node.visit_count) / child_node.visit_count
-                )
-                ucb_value = exploitation_term + exploration_term
-            else:
-                ucb_value = child_node.value + 1.0
-            ucb_values.append(ucb_value)
-        
-        # 找到最高的UCB值
-        best_ucb_value = max(ucb_values)
-        best_child_nodes = [child_node for i, child_node in enumerate(parent_node.children) 
-                           if ucb_values[i] == best_ucb_value]
-    
-    return random.choice(best_child_nodes)
+    # Highest UCB value wins, ties are broken at random
+    ucb_values = get_ucb_values(parent_node, mcts_task)
+    best_indices = numpy.flatnonzero(ucb_values == ucb_values.max())
+    return parent_node.children[random.choice(best_indices)]
 
 
 def expand_node(current_node, mcts_task):
@@ -154,12 +510,87 @@ def expand_node(current_node, mcts_task):
             current_node.is_terminal = True
             return current_node
 
+def reward_value(node, mcts_task):
+    """The reward of the node's partial state, as if the trace ended here."""
+    return mcts_task.reward(node)
+
+
+def extrapolated_value(node, mcts_task):
+    """
+    The reward of the node's partial state with recall and pair count scaled up
+    to ``max_regions`` regions, as if every region still to be explored yields
+    as much as the explored ones did. Terminal nodes get their plain reward.
+    """
+    causal_P, causal_R, length_reward, region_reward = mcts_task.reward_terms(node)
+    if not node.is_terminal and 0 < region_reward < mcts_task.max_regions:
+        scale = mcts_task.max_regions / region_reward
+        causal_R = min(1.0, causal_R * scale)
+        length_reward *= scale
+        region_reward = mcts_task.max_regions
+    return mcts_task.combine_reward(causal_P, causal_R, length_reward, region_reward)
+
+
+# Value estimators for simulation='estimator', by name
+VALUE_ESTIMATORS = {
+    'reward': reward_value,
+    'extrapolated': extrapolated_value,
+}
+
+SIMULATIONS = ('rollout', 'depth_limited', 'reward', 'estimator')
+
+# Search engines by name, each called as engine(mcts_task, root_node=None) -> (root_node, seconds)
+SEARCH_ENGINES = {
+    'mcts': mcts_entrance,
+    'beam': beam_entrance,
+    'best_first': best_first_entrance,
+}
+
+
+def get_search_engine(engine):
+    """A search engine from a callable, a SEARCH_ENGINES name or "module:function"."""
+    if callable(engine):
+        return engine
+    if engine in SEARCH_ENGINES:
+        return SEARCH_ENGINES[engine]
+    if isinstance(engine, str) and ':' in engine:
+        module_name, function_name = engine.split(':', 1)
+        return getattr(importlib.import_module(module_name), function_name)
+    raise ValueError(f"Unknown search engine: {engine}")
+
+
+def get_value_estimator(estimator):
+    """A callable (node, mcts_task) -> value from a callable, a VALUE_ESTIMATORS name or "module:function"."""
+    if callable(estimator):
+        return estimator
+    if estimator in VALUE_ESTIMATORS:
+        return VALUE_ESTIMATORS[estimator]
+    if isinstance(estimator, str) and ':' in estimator:
+        module_name, function_name = estimator.split(':', 1)
+        return getattr(importlib.import_module(module_name), function_name)
+    raise ValueError(f"Unknown value estimator: {estimator}")
+
+
 def simulate_node(current_node, mcts_task):
     """
-    执行rollout并跟踪路径中的所有节点
+    执行simulation并跟踪rollout路径中的所有节点
+
+    ``mcts_task.simulation`` picks how the node is valued:
+    'rollout' steps to a terminal node with the model, 'depth_limited' takes at
+    most ``mcts_task.rollout_depth`` such steps and scores the state reached,
+    'reward' scores the node's partial state without any model call, and
+    'estimator' values it with ``mcts_task.value_estimator``.
     """
+    simulation = getattr(mcts_task, 'simulation', 'rollout')
+    if simulation not in SIMULATIONS:
+        raise ValueError(f"Unknown simulation strategy: {simulation}")
+    max_steps = mcts_task.rollout_depth if simulation == 'depth_limited' else None
+    if simulation in ('reward', 'estimator'):
+        max_steps = 0
+    if max_steps != 0 and getattr(mcts_task, 'rollouts', 1) > 1:
+        return simulate_parallel(current_node, mcts_task, max_steps)
+
     rollout_path = []
-    while not current_node.is_terminal:
+    while not current_node.is_terminal and (max_steps is None or len(rollout_path) < max_steps):
         proposed_sub_nodes = mcts_task.step(current_node)
         if proposed_sub_nodes is None:
             current_node.is_terminal = True
@@ -170,19 +601,87 @@ def simulate_node(current_node, mcts_task):
         rollout_path.append(proposed_node)  # 跟踪rollout路径
         current_node = proposed_node
     
-    outcome_reward = mcts_task.reward(current_node)
+    if simulation == 'estimator':
+        outcome_reward = get_value_estimator(mcts_task.value_estimator)(current_node, mcts_task)
+    else:
+        outcome_reward = mcts_task.reward(current_node)
     current_node.update_value(outcome_reward)
     return outcome_reward, rollout_path
 
 
+def simulate_parallel(start_node, mcts_task, max_steps=None):
+    """
+    Run ``mcts_task.rollouts`` rollouts from ``start_node`` at once. Their first
+    steps come from one request with n=rollouts; after that the rollouts
+    advance in lockstep, each round of steps sent to the server together. Every
+    rollout path is backed up with its own reward; the returned reward, backed
+    up through ``start_node`` and its ancestors, is their mean or max
+    (``mcts_task.rollout_reduce``). The returned rollout path is empty.
+    """
+    first_nodes = mcts_task.step(start_node, num_completions=mcts_task.rollouts,
+                                 temperature=mcts_task.rollout_temperature)
+    if first_nodes is None:
+        start_node.is_terminal = True
+        outcome_reward = mcts_task.reward(start_node)
+        start_node.update_value(outcome_reward)
+        return outcome_reward, []
+
+    paths = []
+    for sub_node in first_nodes[:mcts_task.rollouts]:
+        start_node.append_children(sub_node)
+        paths.append([sub_node])
+    steps = 1
+    while max_steps is None or steps < max_steps:
+        active = [path for path in paths if not path[-1].is_terminal]
+        if not active:
+            break
+        proposed = mcts_task.step_many([path[-1] for path in active], temperature=mcts_task.rollout_temperature)
+        for path, proposed_sub_nodes in zip(active, proposed):
+            if proposed_sub_nodes is None:
+                path[-1].is_terminal = True
+                continue
+            proposed_node = random.choice(proposed_sub_nodes)
+            path[-1].append_children(proposed_node)
+            path.append(proposed_node)
+        steps += 1
+
+    rewards = []
+    for path in paths:
+        reward = mcts_task.reward(path[-1])
+        path[-1].update_value(reward)
+        back_propagate(path, reward, mcts_task)
+        rewards.append(reward)
+    if mcts_task.rollout_reduce == 'max':
+        outcome_reward = max(rewards)
+    else:
+        outcome_reward = sum(rewards) / len(rewards)
+    logger.debug("%d parallel rollouts, rewards %s", len(rewards), rewards)
+    return outcome_reward, []
+
+
 def back_propagate(selection_path, outcome_reward, mcts_task):
     for node in reversed(selection_path):
-        node.visit_count += 1
+        if node.parent is None:
+            visits, values, index = None, None, None
+            node.visit_count += 1
+            visit_count, value = node.visit_count, node.value
+        else:
+            # Update the node's slot in its parent's statistics arrays in place
+            visits, values, index = node.parent.child_visits, node.parent.child_values, node._index
+            visits[index] += 1
+            visit_count, value = visits[index], values[index]
         # 使用指数移动平均更新节点值
         if hasattr(mcts_task, 'alpha'):
-            node.value = (
-                node.value * (1 - mcts_task.alpha) + outcome_reward * mcts_task.alpha
-            )
+            value = value * (1 - mcts_task.alpha) + outcome_reward * mcts_task.alpha
         else:
             # 或者使用简单平均
-            node.value = ((node.value * (node.visit_count - 1)) + outcome_reward) / node.visit_count
\ No newline at end of file
+            value = ((value * (visit_count - 1)) + outcome_reward) / visit_count
+        if values is None:
+            node.value = value
+        else:
+            values[index] = value
+
+
+if __name__ == '__main__':
+    # python search.py checks that beam search expands nodes with the state they were simulated from
+    print(f"Candidate pairs kept through simulate -> expand: {check_frontier_state()}")
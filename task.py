@@ -1,25 +1,31 @@
-import pandas as pd
-import matplotlib.pyplot as plt
 from PIL import Image
 import random
 import string
 import os
 import uuid
 import tempfile
+import time
+import json
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.img_server import process_image_path
-from utils.vllm_infer import generate
+from utils.vllm_infer import generate, new_usage
 from utils.prompt import *
 from utils.utils import zoom_in, get_gt_pairs, extract_content, match_detections_to_gt
+from utils.utils import map_bbox_text, original_bbox_to_model, map_pair_bboxes
 from utils.evaluate import evaluate
+from utils.speculation import Speculator
 
-from node import TreeNode
-from search import mcts_entrance, execute_round
+from node import TreeNode, load_tree, save_tree
+from search import get_search_engine, tree_stats
 
 import logging
 
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 
 class MCTSTask:
     def __init__(
@@ -33,123 +39,374 @@ class MCTSTask:
         data_idx=None,
         alpha=0.3,
         max_regions=4,
-        max_pairs=20
+        max_pairs=20,
+        call_timeout=None,
+        image_deadline=None,
+        stable_rounds=None,
+        call_budget=None,
+        token_budget=None,
+        checkpoint_path=None,
+        checkpoint_every=1,
+        image_cache=None,
+        speculate_k=0,
+        speculate_max_waste=None,
+        simulation='rollout',
+        rollout_depth=3,
+        value_estimator='extrapolated',
+        max_tree_nodes=None,
+        max_tree_bytes=None,
+        prune_tail_visits=1,
+        gt=None,
+        rollouts=1,
+        rollout_reduce='mean',
+        rollout_temperature=0.7,
+        search_engine='mcts',
+        beam_width=3,
+        branching=2,
+        branch_temperature=0.7
     ):
         # Task parameters
         self.alpha = alpha
         self.iteration_limit = iteration_limit
         self.data = data
+        # (entities, gt_pairs), e.g. from an annotation store; see get_gt
+        self.gt = gt
         self.data_idx = data_idx
         self.image_path = image_path
         self.image_server = image_server
         self.low_value = low_value
         self.exploration_constant = exploration_constant
-        self.image_url = process_image_path(self.image_server, self.image_path)
+        # With an image cache the model sees a resized copy; image_transform maps its
+        # bboxes back to original coordinates, in which crops and causal pairs are kept.
+        self.image_cache = image_cache
+        self.image_transform = None
+        model_image_path = self.image_path
+        if image_cache is not None:
+            model_image_path, self.image_transform = image_cache.prepare(self.image_path)
+        self.image_url = process_image_path(self.image_server, model_image_path)
         self.temp_image_path = None
         self.temp_image_url = None
+        self.temp_crop_bbox = None
+        # Served crops by crop bbox, so a node can find its crop after others were made
+        self.crop_urls = {}
         self.root_node = None
         self.max_regions = max_regions
         self.max_pairs = max_pairs
+        # Per-call timeout and per-image wall-clock limit (seconds); the image
+        # deadline becomes an absolute time when the search or its prefetch starts.
+        self.call_timeout = call_timeout
+        self.image_deadline = image_deadline
+        self.deadline = None
+        # Early stopping: stop once the best leaf's value is unchanged for
+        # stable_rounds rounds, or once the image has used call_budget model
+        # calls or token_budget tokens. None disables a criterion.
+        self.stable_rounds = stable_rounds
+        self.call_budget = call_budget
+        self.token_budget = token_budget
+        self.usage = new_usage()
+        self.stop_reason = None
+        self.rounds = 0
+        # Tree checkpoint written every checkpoint_every rounds and at the end of
+        # the search; an existing checkpoint is resumed instead of starting over.
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        # Speculative calls for up to speculate_k likely next expansions, run while
+        # the rollout waits on the model; at most speculate_max_waste go unused.
+        self.speculate_k = speculate_k
+        self.speculate_max_waste = speculate_max_waste if speculate_max_waste is not None else 4 * speculate_k
+        self.speculator = None
+        self.speculation_stats = None
+        # (query, results) of the calls run by prefetch before the search started
+        self.prefetched = {}
+        # How a newly expanded node is valued (see search.simulate_node): a full
+        # rollout, a rollout of at most rollout_depth steps, the reward of its
+        # partial state, or value_estimator (a name in search.VALUE_ESTIMATORS,
+        # "module:function" or a callable taking (node, task)).
+        self.simulation = simulation
+        self.rollout_depth = rollout_depth
+        self.value_estimator = value_estimator
+        # Tree size limits enforced by search.prune_tree after every round (None
+        # disables a limit); the size is reported per image in tree_stats.
+        self.max_tree_nodes = max_tree_nodes
+        self.max_tree_bytes = max_tree_bytes
+        self.prune_tail_visits = prune_tail_visits
+        self.pruned_nodes = 0
+        self.peak_tree_nodes = 0
+        self.peak_tree_bytes = 0
+        self.tree_stats = None
+        # Number of rollouts run at once from each expanded node (their first steps
+        # in one request with n=rollouts, sampled at rollout_temperature), and how
+        # their rewards are combined: 'mean' or 'max'.
+        self.rollouts = rollouts
+        self.rollout_reduce = rollout_reduce
+        self.rollout_temperature = rollout_temperature
+        self._rollout_executor = None
+        # Which search.SEARCH_ENGINES entry runs the search. Beam and best-first
+        # search expand up to beam_width nodes per round, asking for branching
+        # sampled completions per node, and value new nodes by simulation.
+        self.search_engine = search_engine
+        self.beam_width = beam_width
+        self.branching = branching
+        self.branch_temperature = branch_temperature
 
-    def step(self, current_node):
+    def step(self, current_node, num_completions=1, temperature=0.0):
         """
         MCTS step.
         """
-        crop_info = None
+        claimed = self._claim_query(current_node)
+        if claimed is None:
+            current_node.is_terminal = True
+            return None
+        query, results = claimed
+        if results is None or len(results) < num_completions:
+            action, image_url, prompt, _ = query
+            more = self.generate(image_url, prompt, action, num_completions - len(results or []), temperature)
+            if more is not None:
+                results = (results or []) + more
+        return self.build_children(current_node, query, results)
 
-        if current_node.parent is None: # root node
-            prompt = Caption_prompt
-            results = generate(image_url=self.image_url, prompt=prompt)
+    def step_many(self, nodes, num_completions=1, temperature=0.0):
+        """
+        ``step`` for several nodes at once: the queries are prepared one after
+        another (cropping changes the task's current crop), then all model calls
+        are sent together so the server batches them.
+        """
+        if len(nodes) == 1:
+            return [self.step(nodes[0], num_completions, temperature)]
+        claimed = [self._claim_query(node) for node in nodes]
+        futures = {}
+        for i, entry in enumerate(claimed):
+            if entry is not None and (entry[1] is None or len(entry[1]) < num_completions):
+                action, image_url, prompt, _ = entry[0]
+                # Keep the caller's log context (image id) in the worker thread
+                futures[i] = self._get_rollout_executor().submit(
+                    contextvars.copy_context().run, self.generate, image_url, prompt, action,
+                    num_completions - len(entry[1] or []), temperature)
+        proposed = []
+        for i, (node, entry) in enumerate(zip(nodes, claimed)):
+            if entry is None:
+                node.is_terminal = True
+                proposed.append(None)
+                continue
+            query, results = entry
+            if i in futures:
+                more = futures[i].result()
+                if more is not None:
+                    results = (results or []) + more
+            proposed.append(self.build_children(node, query, results))
+        return proposed
+
+    def _claim_query(self, current_node):
+        """
+        (query, results) for expanding ``current_node``: results of a speculative
+        or prefetched call if one was made for it, else None with a fresh query.
+        None if the node is terminal, or the image's deadline or call or token
+        budget is used up, so a rollout stops at once rather than at the end of
+        the round.
+        """
+        stop_reason = self.budget_exhausted()
+        if stop_reason is not None:
+            logger.warning(f"Image {stop_reason} reached, marking {current_node.action} node as terminal")
+            current_node.budget_stopped = True
+            return None
+
+        speculated = self.speculator.take(current_node) if self.speculator is not None else None
+        if speculated is None and self.prefetched:
+            speculated = self.prefetched.pop(self._prefetch_key(current_node), None)
+        if speculated is not None:
+            return speculated
+        query = self.prepare_query(current_node)
+        if query is None:
+            return None
+        return query, None
+
+    def _get_rollout_executor(self):
+        if self._rollout_executor is None:
+            self._rollout_executor = ThreadPoolExecutor(max_workers=max(self.rollouts, self.beam_width, 2),
+                                                        thread_name_prefix="rollout")
+        return self._rollout_executor
+
+    def prefetch(self, depth=1):
+        """
+        Run the first ``depth`` model calls of the search before it starts: the
+        root caption, then the calls below its first result. ``step`` uses their
+        results when the search reaches the same nodes.
+        """
+        node = TreeNode()
+        for _ in range(depth):
+            query = self.prepare_query(node)
+            if query is None:
+                return
+            key = self._prefetch_key(node)
+            action, image_url, prompt, _ = query
+            results = self.generate(image_url, prompt, action)
             if results is None:
-                logging.error("Failed to generate results for root node")
-                return None
-            proposed_sub_nodes = []
-            for result in results:
+                return
+            self.prefetched[key] = (query, results)
+            # Only used to find the next call; the search rebuilds these nodes
+            children = self.build_children(node, query, results)
+            if not children:
+                return
+            node.append_children(children[0])
+            node = children[0]
+
+    @staticmethod
+    def _prefetch_key(node):
+        return node.depth, node.action, json.dumps(node.state, sort_keys=True, default=str)
+
+    def prepare_query(self, current_node):
+        """
+        (action, image url, prompt, crop info) of the model call that expands
+        ``current_node``, or None when the node is terminal without one. Only the
+        crop the call needs is created; the node itself is left untouched, so this
+        can run ahead of the search for speculative calls.
+        """
+        crop_info = None
+        if current_node.parent is None: # root node
+            return 'Caption', self.image_url, Caption_prompt, crop_info
+
+        explored_regions = current_node.state['explored_regions']
+        causal_pairs = current_node.state['causal_pairs']
+        candidate_pairs = current_node.state['candidate_pairs']
+
+        match current_node.action:
+            case 'SelectRegion':
+                if len(explored_regions) >= self.max_regions or len(causal_pairs) >= self.max_pairs:
+                    return None
+                
+                # The state is in original-image coordinates; the model sees the resized image
+                causal_pairs = map_pair_bboxes(causal_pairs, original_bbox_to_model, self.image_transform)
+                explored_regions = [
+                    {**region, 'bounding_box': map_bbox_text(region['bounding_box'], original_bbox_to_model,
+                                                             self.image_transform)}
+                    for region in explored_regions
+                ]
+                prompt = SelectRegion_prompt.format(explored_regions=explored_regions, causal_pairs=causal_pairs)
+                image_url = self.image_url
+            case 'ProposePair':
+                prompt = ProposePair_prompt
+                current_region = current_node.state['current_region']
                 try:
-                    sub_node = TreeNode()
-                    sub_node.initialize_state(current_node, result, crop_info)
-                    proposed_sub_nodes.append(sub_node)
+                    crop_info = self.crop(current_region[1])
                 except Exception as e:
-                    logging.error(f"Failed to initialize root sub_node: {str(e)}")
-                    continue
-            
-            # 如果没有成功创建任何子节点，将当前节点标记为终端节点
-            if not proposed_sub_nodes:
-                current_node.is_terminal = True
-                return None
-                
-            return proposed_sub_nodes
-        else:
-            explored_regions = current_node.state['explored_regions']
-            causal_pairs = current_node.state['causal_pairs']
-            candidate_pairs = current_node.state['candidate_pairs']
-
-            match current_node.action:
-                case 'SelectRegion':
-                    if len(explored_regions) >= self.max_regions or len(causal_pairs) >= self.max_pairs:
-                        current_node.is_terminal = True
-                        return None
-                    
-                    prompt = SelectRegion_prompt.format(explored_regions=explored_regions, causal_pairs=causal_pairs)
-                    results = generate(image_url=self.image_url, prompt=prompt)
-                case 'ProposePair':
-                    prompt = ProposePair_prompt
-                    current_region = current_node.state['current_region']
-                    bbox = current_region[1]
+                    logger.error(f"Failed to crop image: {str(e)}")
+                    return None
+                image_url = self.temp_image_url
+            case 'JudgeCausality':
+                image_url = self.temp_image_url
+                if current_node.crop_info is not None:
+                    image_url = self.crop_urls.get(tuple(current_node.crop_info['crop_bbox']))
+                if image_url is None:
+                    # The crop was made before the search was resumed from a checkpoint
+                    # and is gone, recreate this node's crop.
                     try:
-                        idid = self.data_idx.split('.')[0] if '.' in self.data_idx else self.data_idx
-                        temp_file = tempfile.NamedTemporaryFile(
-                            suffix='.jpg', 
-                            delete=False,
-                            dir=f'temp/{idid}'  # 指定目录
-                        )
-                        self.temp_image_path = temp_file.name
-                        temp_file.close()
-
-                        crop_info = zoom_in(image_path=self.image_path, bbox=bbox, output_path=self.temp_image_path)
-                        self.temp_image_url = process_image_path(self.image_server, self.temp_image_path)
+                        self.crop(current_node.crop_info['crop_bbox'])
                     except Exception as e:
-                        logging.error(f"Failed to crop image: {str(e)}")
-                        current_node.is_terminal = True
+                        logger.error(f"Failed to recreate cropped image: {str(e)}")
                         return None
-                    results = generate(image_url=self.temp_image_url, prompt=prompt)
-                case 'JudgeCausality':
-                    prompt = JudgeCausality_prompt.format(entity_pairs=candidate_pairs)
-                    current_node.state['candidate_pairs'] = []
-                    results = generate(image_url=self.temp_image_url, prompt=prompt)
-                case _:
-                    raise ValueError(f"Invalid action: {current_node.action}")
-                
-            if results is None:
-                logging.error(f"Failed to generate results for action {current_node.action}")
-                current_node.is_terminal = True
-                return None
-                
-            proposed_sub_nodes = []
-            for result in results:
-                if "END TRACE" in result:
-                    current_node.is_terminal = True
-                    return None
-                try:
-                    sub_node = TreeNode()
-                    sub_node.initialize_state(current_node, result, crop_info)
-                    proposed_sub_nodes.append(sub_node)
-                except Exception as e:
-                    logging.error(f"Failed to initialize sub_node: {str(e)}")
-                    continue
+                    image_url = self.temp_image_url
+                prompt = JudgeCausality_prompt.format(entity_pairs=candidate_pairs)
+            case _:
+                raise ValueError(f"Invalid action: {current_node.action}")
+        return current_node.action, image_url, prompt, crop_info
+
+    def build_children(self, current_node, query, results):
+        """Sub-nodes of ``current_node`` from the ``results`` of its ``query``."""
+        action, _, _, crop_info = query
+        if action == 'JudgeCausality':
+            current_node.state['candidate_pairs'] = []
+
+        if results is None:
+            if current_node.parent is None:
+                logger.error("Failed to generate results for root node")
+            else:
+                logger.error(f"Failed to generate results for action {action}")
+            current_node.is_terminal = True
+            # A call cut short by the deadline does not make the node a dead end
+            current_node.budget_stopped = self.budget_exhausted() is not None
+            return None
             
-            # 如果没有成功创建任何子节点，将当前节点标记为终端节点
-            if not proposed_sub_nodes:
+        proposed_sub_nodes = []
+        for result in results:
+            if current_node.parent is not None and "END TRACE" in result:
                 current_node.is_terminal = True
                 return None
-                
-            return proposed_sub_nodes
+            try:
+                sub_node = TreeNode()
+                sub_node.initialize_state(current_node, result, crop_info, self.image_transform)
+                proposed_sub_nodes.append(sub_node)
+            except Exception as e:
+                logger.error(f"Failed to initialize sub_node: {str(e)}")
+                continue
+        
+        # 如果没有成功创建任何子节点，将当前节点标记为终端节点
+        if not proposed_sub_nodes:
+            current_node.is_terminal = True
+            return None
+            
+        return proposed_sub_nodes
 
-    def reward(self, node):
-        """
-        Reward function.
-        """
-        entities, gt_pairs = get_gt_pairs(self.data)
+    def crop(self, bbox):
+        """Crop ``bbox`` out of the image into a temp file and serve it; returns the crop info."""
+        idid = self.data_idx.split('.')[0] if '.' in self.data_idx else self.data_idx
+        temp_file = tempfile.NamedTemporaryFile(
+            suffix='.jpg', 
+            delete=False,
+            dir=f'temp/{idid}'  # 指定目录
+        )
+        self.temp_image_path = temp_file.name
+        temp_file.close()
+
+        max_pixels, jpeg_quality = None, None
+        if self.image_cache is not None:
+            max_pixels, jpeg_quality = self.image_cache.max_pixels, self.image_cache.crop_jpeg_quality
+        crop_info = zoom_in(image_path=self.image_path, bbox=bbox, output_path=self.temp_image_path,
+                            max_pixels=max_pixels, jpeg_quality=jpeg_quality)
+        self.temp_image_url = process_image_path(self.image_server, self.temp_image_path)
+        self.temp_crop_bbox = crop_info['crop_bbox']
+        self.crop_urls[tuple(crop_info['crop_bbox'])] = self.temp_image_url
+        return crop_info
+
+    def generate(self, image_url, prompt, action, num_completions=1, temperature=0.0):
+        return generate(
+            image_url=image_url,
+            prompt=prompt,
+            num_completions=num_completions,
+            temperature=temperature,
+            sticky_key=self.image_path,
+            action=action,
+            timeout=self.call_timeout,
+            deadline=self.deadline,
+            usage=self.usage,
+        )
+
+    def start_deadline(self):
+        """Start the image's wall-clock limit, unless a prefetch already started it."""
+        if self.image_deadline is not None and self.deadline is None:
+            self.deadline = time.time() + self.image_deadline
+
+    def deadline_exceeded(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def budget_exhausted(self):
+        """Name of the exhausted per-image budget, or None."""
+        if self.deadline_exceeded():
+            return 'deadline'
+        if self.call_budget is not None and self.usage['calls'] >= self.call_budget:
+            return 'call_budget'
+        if self.token_budget is not None and self.usage['total_tokens'] >= self.token_budget:
+            return 'token_budget'
+        return None
+
+    def get_gt(self):
+        """(entities, gt_pairs) of the image, parsed from ``data`` once unless given."""
+        if self.gt is None:
+            self.gt = get_gt_pairs(self.data)
+        return self.gt
+
+    def reward_terms(self, node):
+        """(causal precision, causal recall, length reward, region reward) of ``node``'s state."""
+        entities, gt_pairs = self.get_gt()
         predicted_pairs = node.state['causal_pairs']
         
         # Handle case where gt_pairs is empty to prevent ZeroDivisionError
@@ -160,25 +417,66 @@ class MCTSTask:
             
         region_reward = len(node.state['explored_regions'])
         causal_P, causal_R, _, _, _, _, _ = evaluate(entities, gt_pairs, predicted_pairs)
-        causal_reward = 0.75 * causal_R + 0.25 * causal_P + 0.05 * length_reward + 0.005 * region_reward
-        return causal_reward
+        return causal_P, causal_R, length_reward, region_reward
+
+    @staticmethod
+    def combine_reward(causal_P, causal_R, length_reward, region_reward):
+        return 0.75 * causal_R + 0.25 * causal_P + 0.05 * length_reward + 0.005 * region_reward
+
+    def reward(self, node):
+        """
+        Reward function.
+        """
+        return self.combine_reward(*self.reward_terms(node))
 
     def run(self):
         """
-        Run MCTS search.
+        Run the search with ``search_engine`` (MCTS by default).
 
         Returns:
             TreeNode: Root node of the search tree
         """
+        self.start_deadline()
         try:
-            root_node, search_metric = mcts_entrance(self)
+            root_node = None
+            if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+                root_node, metadata = load_tree(self.checkpoint_path)
+                self.rounds = metadata.get('rounds', 0)
+                self.usage.update(metadata.get('usage', {}))
+                logger.info(f"Resuming search from {self.checkpoint_path} after {self.rounds} rounds")
+            if self.speculate_k > 0:
+                self.speculator = Speculator(self, k=self.speculate_k, max_wasted=self.speculate_max_waste)
+            try:
+                root_node, search_metric = get_search_engine(self.search_engine)(self, root_node)
+            finally:
+                if self.speculator is not None:
+                    self.speculation_stats = self.speculator.finish()
+                    self.speculator = None
+                if self._rollout_executor is not None:
+                    self._rollout_executor.shutdown()
+                    self._rollout_executor = None
             self.root_node = root_node  # Store for class-level access if needed
-            print(f"Search completed with {search_metric} seconds")
+            nodes, size = tree_stats(root_node)
+            self.note_tree_size(nodes, size)
+            self.tree_stats = {'nodes': nodes, 'bytes': size, 'peak_nodes': self.peak_tree_nodes,
+                               'peak_bytes': self.peak_tree_bytes, 'pruned_nodes': self.pruned_nodes}
+            if self.checkpoint_path is not None:
+                self.save_checkpoint(root_node)
+            logger.info(f"Search completed with {search_metric} seconds after {self.rounds} rounds, stop reason: {self.stop_reason}, "
+                        f"tree: {nodes} nodes, {size / 2**20:.2f} MB, {self.pruned_nodes} pruned")
             return root_node, search_metric
         except Exception as e:
-            logging.error(f"Error during MCTS search: {str(e)}")
+            logger.error(f"Error during MCTS search: {str(e)}")
             raise
 
+    def note_tree_size(self, nodes, size):
+        self.peak_tree_nodes = max(self.peak_tree_nodes, nodes)
+        self.peak_tree_bytes = max(self.peak_tree_bytes, size)
+
+    def save_checkpoint(self, root_node):
+        save_tree(root_node, self.checkpoint_path, image_id=self.data_idx, rounds=self.rounds,
+                  stop_reason=self.stop_reason, usage=self.usage)
+
     def get_best_path(self, node):
         """
         Get the leaf node with the highest value.
@@ -187,30 +485,23 @@ class MCTSTask:
             TreeNode: Leaf node with the highest value
         """
         while not node.is_terminal and node.children:
-            values = []
-            for child_node in node.children:
-                values.append(child_node.value)
-            
-            # Handle empty values list (shouldn't happen due to while condition, but safety check)
-            if not values:
+            values = node.child_values[:len(node.children)]
+            # Pruned nodes kept no trajectory, so the path never ends on one
+            pruned = np.array([child.is_pruned for child in node.children])
+            if pruned.all():
                 break
-                
-            best_value = max(values)
+            values = np.where(pruned, -np.inf, values)
+            best_value = values.max()
             
             # Use a small epsilon for floating-point comparison to avoid precision issues
             epsilon = 1e-10
-            best_child_nodes = [child_node for child_node in node.children 
-                              if abs(child_node.value - best_value) < epsilon]
-            
-            # Safety check: if no children found due to precision issues, fall back to direct comparison
-            if not best_child_nodes:
-                best_child_nodes = [child_node for child_node in node.children if child_node.value == best_value]
+            best_indices = np.flatnonzero(np.abs(values - best_value) < epsilon)
             
-            # Final safety check: if still no children, just pick the first one
-            if not best_child_nodes:
-                best_child_nodes = [node.children[0]]
+            # Safety check: if no children found due to precision issues, just pick the best one
+            if len(best_indices) == 0:
+                best_indices = [int(values.argmax())]
             
-            node = random.choice(best_child_nodes)
+            node = node.children[random.choice(best_indices)]
         return node
 
                 
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""
+Columnar, memory-mapped store of the VCG-32K ground truth.
+
+    python -m utils.annotation_store compile VCG-32K/COCO/annotations/train.jsonl --output VCG-32K/COCO/store/train
+
+compiles annotation jsonl files once into a directory of NumPy arrays:
+
+    boxes.npy           (E, 4) float64  entity boxes, already [x1, y1, x2, y2]
+    names.bin           utf-8 entity names, already stripped of their "#n" suffix
+    name_offsets.npy    (E + 1,) int64  byte offsets of each name in names.bin
+    entity_offsets.npy  (N + 1,) int64  entities of image i are rows [off[i], off[i + 1])
+    edges.npy           (R, 2) int32    causal pairs as 1-based entity indices, as in get_gt_pairs
+    edge_offsets.npy    (N + 1,) int64
+    images.json         image path of each row, as in the record's images[0].image
+    meta.json           format version, the size/mtime of the compiled sources and the
+                        image paths shared by several records
+
+``AnnotationStore`` maps the arrays read-only, so opening a store costs the
+same for 100 or 32,000 images, and a row's boxes and edges are views into the
+mapped files.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from .utils import convert_bbox_xywh_to_xyxy
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 2
+
+
+def _source_info(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def compile_annotations(annotation_paths, store_dir):
+    """Compile annotation jsonl files into a store at ``store_dir``; returns the number of images."""
+    image_paths, boxes, names, edges = [], [], [], []
+    entity_offsets, edge_offsets = [0], [0]
+    seen, duplicates = set(), set()
+    for annotation_path in annotation_paths:
+        with open(annotation_path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                try:
+                    image_path = data['images'][0]['image']
+                except (KeyError, IndexError, TypeError):
+                    logger.error(f"No image path in {annotation_path}:{line_number}, skipping")
+                    continue
+                if image_path in seen:
+                    # 同一张图的多条标注无法按路径区分，查询时交给各记录自己解析
+                    logger.warning(f"Duplicate image {image_path} in {annotation_path}:{line_number}, "
+                                   "its records will be parsed at run time")
+                    duplicates.add(image_path)
+                    continue
+                seen.add(image_path)
+                try:
+                    record_boxes = [convert_bbox_xywh_to_xyxy(entity['bbox']) for entity in data['entities']]
+                except ValueError as e:
+                    raise ValueError(f"Bad entity box in {annotation_path}:{line_number}: {str(e)}") from e
+                image_paths.append(image_path)
+                boxes.extend(record_boxes)
+                names.extend(entity['entity_name'].split('#')[0].strip() for entity in data['entities'])
+                for value in data['relations'].values():
+                    if value is not None:
+                        edges.extend((int(pair[0]), int(pair[1])) for pair in value)
+                entity_offsets.append(len(boxes))
+                edge_offsets.append(len(edges))
+
+    os.makedirs(store_dir, exist_ok=True)
+    encoded = [name.encode('utf-8') for name in names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    with open(os.path.join(store_dir, 'names.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(os.path.join(store_dir, 'name_offsets.npy'), name_offsets)
+    np.save(os.path.join(store_dir, 'boxes.npy'), np.asarray(boxes, dtype=np.float64).reshape(-1, 4))
+    np.save(os.path.join(store_dir, 'entity_offsets.npy'), np.asarray(entity_offsets, dtype=np.int64))
+    np.save(os.path.join(store_dir, 'edges.npy'), np.asarray(edges, dtype=np.int32).reshape(-1, 2))
+    np.save(os.path.join(store_dir, 'edge_offsets.npy'), np.asarray(edge_offsets, dtype=np.int64))
+    with open(os.path.join(store_dir, 'images.json'), 'w') as f:
+        json.dump(image_paths, f)
+    # Written last, so a store without meta.json is known to be incomplete
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': STORE_FORMAT_VERSION, 'images': len(image_paths), 'entities': len(boxes),
+                   'edges': len(edges), 'duplicates': sorted(duplicates), 'sources': [_source_info(path) for path in annotation_paths]}, f, indent=2)
+    logger.info(f"Compiled {len(image_paths)} images, {len(boxes)} entities and {len(edges)} causal pairs "
+                f"into {store_dir}")
+    return len(image_paths)
+
+
+class AnnotationStore:
+    """Read-only view of a compiled store, looked up by image path (``images[0].image``)."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != STORE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported annotation store version {self.meta.get('version')} in {store_dir}")
+        with open(os.path.join(store_dir, 'images.json'), 'r') as f:
+            self.image_paths = json.load(f)
+        self.rows = {image_path: row for row, image_path in enumerate(self.image_paths)}
+        self.duplicates = set(self.meta['duplicates'])
+
+        def load(name):
+            return np.load(os.path.join(store_dir, name), mmap_mode='r')
+
+        self.boxes = load('boxes.npy')
+        self.entity_offsets = load('entity_offsets.npy')
+        self.edges = load('edges.npy')
+        self.edge_offsets = load('edge_offsets.npy')
+        self.name_offsets = load('name_offsets.npy')
+        self.names = np.memmap(os.path.join(store_dir, 'names.bin'), dtype=np.uint8, mode='r') \
+            if self.name_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __contains__(self, image_path):
+        return image_path in self.rows
+
+    def is_stale(self):
+        """True if a compiled source changed or disappeared since the store was built."""
+        for source in self.meta['sources']:
+            try:
+                current = _source_info(source['path'])
+            except FileNotFoundError:
+                return True
+            if current['size'] != source['size'] or current['mtime'] != source['mtime']:
+                return True
+        return False
+
+    def arrays(self, image_path):
+        """(entity boxes, causal pair edges) of an image, as views of the mapped arrays."""
+        row = self.rows[image_path]
+        entity_start, entity_end = self.entity_offsets[row:row + 2].tolist()
+        edge_start, edge_end = self.edge_offsets[row:row + 2].tolist()
+        return self.boxes[entity_start:entity_end], self.edges[edge_start:edge_end]
+
+    def entity_names(self, image_path):
+        row = self.rows[image_path]
+        entity_start, entity_end = self.entity_offsets[row:row + 2].tolist()
+        offsets = self.name_offsets[entity_start:entity_end + 1].tolist()
+        # One read of the row's names, then slicing of plain bytes
+        raw = bytes(self.names[offsets[0]:offsets[-1]]) if offsets else b''
+        base = offsets[0] if offsets else 0
+        return [raw[start - base:end - base].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+
+    def lookup(self, data):
+        """``gt_pairs`` of an annotation record, or None if its image is not in the store.
+
+        Images with several records are None too, since the store cannot tell
+        which record ``data`` is; the caller then parses ``data`` itself.
+        """
+        try:
+            image_path = data['images'][0]['image']
+        except (KeyError, IndexError, TypeError):
+            return None
+        if image_path not in self.rows or image_path in self.duplicates:
+            return None
+        return self.gt_pairs(image_path)
+
+    def gt_pairs(self, image_path):
+        """(entities, gt_pairs) of an image in the format of ``utils.get_gt_pairs``."""
+        boxes, edges = self.arrays(image_path)
+        entities = [{name: box} for name, box in zip(self.entity_names(image_path), boxes.tolist())]
+        return entities, edges.tolist()
+
+
+def open_store(store_dir):
+    """Open a store, warning if its sources changed since it was compiled."""
+    store = AnnotationStore(store_dir)
+    if store.is_stale():
+        logger.warning(f"The annotations compiled into {store_dir} have changed since; recompile it with "
+                       "`python -m utils.annotation_store compile`")
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['compile'])
+    parser.add_argument('annotations', nargs='+', help="annotation jsonl files")
+    parser.add_argument('--output', required=True, help="store directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    compile_annotations(args.annotations, args.output)
+
+
+if __name__ == '__main__':
+    main()
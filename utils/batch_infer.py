@@ -0,0 +1,223 @@
+"""
+Offline batch files in the OpenAI batch format.
+
+Each input line is one chat completion request,
+
+    {"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+with the body built by ``vllm_infer.build_chat_request``, and each output line
+its response,
+
+    {"id": ..., "custom_id": ..., "response": {"status_code": 200, "body": {...}}, "error": null}
+
+in any order. Input files are run by a batch runner that takes vLLM's
+``run_batch`` arguments (``-i <input> -o <output> --model <model>``):
+
+    vllm      python -m vllm.entrypoints.openai.run_batch, which loads the model itself
+    server    python -m utils.batch_infer run, which sends the requests to the servers in
+              VLLM_API_BASES; a stand-in for testing the batch path against a running server
+    echo      python -m utils.batch_infer echo, which answers without any model: with the
+              canned responses of --responses, else with each request's own prompt; for
+              testing the batch path offline
+
+or any other command taking the same arguments.
+"""
+import argparse
+import base64
+import json
+import logging
+import mimetypes
+import os
+import shlex
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .vllm_infer import build_chat_request, generate, new_usage
+
+logger = logging.getLogger(__name__)
+
+# How images are put into the requests: inline as base64 data URLs, or
+# referenced as file:// URLs, which the runner must be allowed to read
+IMAGE_MODES = ('inline', 'file')
+
+RUNNERS = {
+    'vllm': [sys.executable, '-m', 'vllm.entrypoints.openai.run_batch'],
+    'server': [sys.executable, '-m', 'utils.batch_infer', 'run'],
+    'echo': [sys.executable, '-m', 'utils.batch_infer', 'echo'],
+}
+
+
+def image_payload_url(image_path, mode='inline'):
+    if mode == 'file':
+        return f"file://{os.path.abspath(image_path)}"
+    mime_type = mimetypes.guess_type(image_path)[0] or 'image/jpeg'
+    with open(image_path, 'rb') as f:
+        return f"data:{mime_type};base64,{base64.b64encode(f.read()).decode('utf-8')}"
+
+
+def batch_line(custom_id, image_url, model, prompt, num_completions=1, temperature=0.0):
+    return {'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+            'body': build_chat_request(image_url, model, prompt, num_completions, temperature)}
+
+
+def runner_command(runner, input_path, output_path, model, extra_args=()):
+    command = RUNNERS[runner] if runner in RUNNERS else shlex.split(runner)
+    return [*command, '-i', input_path, '-o', output_path, '--model', model, *extra_args]
+
+
+def run_batch_file(input_path, output_path, model, runner='vllm', extra_args=()):
+    """
+    Run ``input_path`` through ``runner`` into ``output_path``; returns the seconds
+    it took. The output is only moved into place once the runner succeeded, so an
+    existing output file is a complete one.
+    """
+    partial_path = f"{output_path}.partial"
+    command = runner_command(runner, input_path, partial_path, model, extra_args)
+    logger.info(f"Running batch {input_path}: {' '.join(command)}")
+    start_time = time.time()
+    subprocess.run(command, check=True)
+    os.replace(partial_path, output_path)
+    return time.time() - start_time
+
+
+def iter_batch_results(output_path):
+    """Yield (custom_id, completions, usage, error) per output line; completions is None on error."""
+    with open(output_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            body = response.get('body') or {}
+            error = record.get('error')
+            if error is None and response.get('status_code', 200) != 200:
+                error = body.get('error') or body or f"status {response.get('status_code')}"
+            if error is not None:
+                yield record['custom_id'], None, None, str(error)
+                continue
+            completions = [(choice.get('message') or {}).get('content') or "" for choice in body.get('choices', [])]
+            yield record['custom_id'], completions, body.get('usage'), None
+
+
+def _request_parts(body):
+    prompt, image_url = "", None
+    for message in body['messages']:
+        for part in message['content']:
+            if part['type'] == 'text':
+                prompt = part['text']
+            elif part['type'] == 'image_url':
+                image_url = part['image_url']['url']
+    return prompt, image_url
+
+
+def _response_body(request, completions):
+    body = request['body']
+    choices = [{'index': index, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}
+               for index, content in enumerate(completions)]
+    return {'model': body['model'], 'choices': choices}
+
+
+def _serve_line(request):
+    body = request['body']
+    prompt, image_url = _request_parts(body)
+    if image_url is not None and image_url.startswith('file://'):
+        # A server cannot be assumed to read this machine's files
+        image_url = image_payload_url(image_url[len('file://'):], 'inline')
+    usage = new_usage()
+    completions = generate(image_url=image_url, prompt=prompt, num_completions=body.get('n', 1),
+                           action='Batch', usage=usage, temperature=body.get('temperature', 0.0))
+    record = {'id': f"batch-{uuid.uuid4().hex}", 'custom_id': request['custom_id']}
+    if completions is None:
+        record.update(response=None, error="generation failed")
+        return record
+    usage.pop('calls')
+    record.update(response={'status_code': 200, 'body': {**_response_body(request, completions), 'usage': usage}},
+                  error=None)
+    return record
+
+
+def serve_batch(input_path, output_path, concurrency=16):
+    """Run a batch file against the servers in VLLM_API_BASES, writing the responses in input order."""
+    with open(input_path, 'r') as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open(output_path, 'w') as out:
+        for record in executor.map(_serve_line, requests):
+            out.write(json.dumps(record) + "\n")
+    return len(requests)
+
+
+def load_responses(path):
+    """
+    Canned responses for ``echo_batch``: a JSONL file of {"custom_id": ..., "content": ...}
+    lines (``content`` a string or a list of completions) or {"custom_id": ..., "error": ...}
+    lines. The custom_id "*" answers every request without a line of its own.
+    """
+    responses = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                responses[entry['custom_id']] = entry
+    return responses
+
+
+def _echo_line(request, responses):
+    body = request['body']
+    record = {'id': f"batch-{uuid.uuid4().hex}", 'custom_id': request['custom_id']}
+    prompt, _ = _request_parts(body)
+    entry = responses.get(request['custom_id'], responses.get('*'))
+    if entry is not None and entry.get('error') is not None:
+        record.update(response=None, error=entry['error'])
+        return record
+    if entry is None:
+        completions = [prompt] * body.get('n', 1)
+    else:
+        content = entry.get('content', "")
+        completions = content if isinstance(content, list) else [content] * body.get('n', 1)
+    # Whitespace-separated words stand in for tokens
+    prompt_tokens = len(prompt.split())
+    completion_tokens = sum(len(content.split()) for content in completions)
+    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+             'total_tokens': prompt_tokens + completion_tokens}
+    record.update(response={'status_code': 200, 'body': {**_response_body(request, completions), 'usage': usage}},
+                  error=None)
+    return record
+
+
+def echo_batch(input_path, output_path, responses_path=None):
+    """Answer a batch file without any model, writing the responses in input order."""
+    responses = load_responses(responses_path) if responses_path is not None else {}
+    count = 0
+    with open(input_path, 'r') as f, open(output_path, 'w') as out:
+        for line in f:
+            if line.strip():
+                out.write(json.dumps(_echo_line(json.loads(line), responses)) + "\n")
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['run', 'echo'])
+    parser.add_argument('-i', '--input-file', required=True)
+    parser.add_argument('-o', '--output-file', required=True)
+    parser.add_argument('--model', default=None, help="ignored; the servers' model answers")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--responses', default=None, help="canned responses of echo (see load_responses)")
+    # vLLM engine arguments (--trust-remote-code, --max-model-len, ...) are accepted and ignored
+    args, ignored = parser.parse_known_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    if ignored:
+        logger.info(f"Ignoring engine arguments: {' '.join(ignored)}")
+    if args.command == 'echo':
+        count = echo_batch(args.input_file, args.output_file, args.responses)
+    else:
+        count = serve_batch(args.input_file, args.output_file, args.concurrency)
+    logger.info(f"Ran {count} requests from {args.input_file} into {args.output_file}")
+
+
+if __name__ == '__main__':
+    main()
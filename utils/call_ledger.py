@@ -0,0 +1,214 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency and time-to-first-token histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense, plus the raw sum and count."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile (None if empty or past the last bucket)."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class ActionStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.busy_seconds = 0.0
+        self.finish_reasons = defaultdict(int)
+        self.latency = Histogram()
+        self.ttft = Histogram()
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'retry_rate': self.retries / self.requests if self.requests else 0.0,
+            'cache_hits': self.cache_hits,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'completion_tokens_per_sec': self.completion_tokens / self.busy_seconds if self.busy_seconds else 0.0,
+            'finish_reasons': dict(self.finish_reasons),
+            'latency_seconds': self.latency.to_dict(),
+            'ttft_seconds': self.ttft.to_dict(),
+        }
+
+
+class CallLedger:
+    """
+    One record per model request (action, endpoint, tokens, latency, time to
+    first token, retries, cached prompt tokens, finish reasons, error), folded
+    into per-action counters and histograms. Records can also be appended to a
+    jsonl file with ``open_log``; ``summary`` and ``prometheus_text`` expose the
+    aggregates.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._actions = defaultdict(ActionStats)
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def open_log(self, path, **writer_kwargs):
+        from .result_writer import ResultWriter
+        self._writer = ResultWriter(path, **writer_kwargs)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def record(self, action, endpoint, latency, retries=0, prompt_tokens=0, completion_tokens=0,
+               cached_tokens=0, ttft=None, finish_reasons=(), error=None):
+        action = action or 'unknown'
+        with self._lock:
+            stats = self._actions[action]
+            stats.requests += 1
+            stats.retries += retries
+            stats.latency.observe(latency)
+            if error is not None:
+                stats.errors += 1
+            else:
+                stats.busy_seconds += latency
+                stats.prompt_tokens += prompt_tokens
+                stats.completion_tokens += completion_tokens
+                stats.cached_tokens += cached_tokens
+                stats.cache_hits += cached_tokens > 0
+                for reason in finish_reasons:
+                    stats.finish_reasons[reason or 'unknown'] += 1
+                if ttft is not None:
+                    stats.ttft.observe(ttft)
+        if self._writer is not None:
+            self._writer.write({
+                'time': time.time(), 'action': action, 'endpoint': endpoint, 'latency': latency, 'ttft': ttft,
+                'retries': retries, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'cached_tokens': cached_tokens, 'finish_reasons': list(finish_reasons),
+                'error': str(error) if error is not None else None,
+            })
+
+    def summary(self):
+        """{'elapsed_seconds', 'actions': {action: stats}, 'total': stats} of everything recorded so far."""
+        with self._lock:
+            actions = {action: stats.to_dict() for action, stats in self._actions.items()}
+        total = {key: sum(a[key] for a in actions.values())
+                 for key in ('requests', 'errors', 'retries', 'cache_hits', 'prompt_tokens',
+                             'completion_tokens', 'cached_tokens')}
+        elapsed = time.time() - self.started_at
+        total['completion_tokens_per_sec'] = total['completion_tokens'] / elapsed if elapsed > 0 else 0.0
+        return {'elapsed_seconds': elapsed, 'actions': actions, 'total': total}
+
+    def save_summary(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(temp_path, path)
+
+    def prometheus_text(self, prefix='llm_client'):
+        """The aggregates in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            actions = list(self._actions.items())
+
+            def counter(name, help_text, values):
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {prefix}_{name} counter")
+                for labels, value in values:
+                    lines.append(f"{prefix}_{name}{{{labels}}} {value}")
+
+            counter('requests_total', 'Model requests.', [(f'action="{a}"', s.requests) for a, s in actions])
+            counter('errors_total', 'Failed model requests.', [(f'action="{a}"', s.errors) for a, s in actions])
+            counter('retries_total', 'Retried attempts.', [(f'action="{a}"', s.retries) for a, s in actions])
+            counter('cache_hits_total', 'Requests with cached prompt tokens.',
+                    [(f'action="{a}"', s.cache_hits) for a, s in actions])
+            for kind in ('prompt', 'completion', 'cached'):
+                counter(f'{kind}_tokens_total', f'{kind.capitalize()} tokens.',
+                        [(f'action="{a}"', getattr(s, f'{kind}_tokens')) for a, s in actions])
+            counter('finish_reason_total', 'Choices by finish reason.',
+                    [(f'action="{a}",reason="{r}"', n) for a, s in actions for r, n in s.finish_reasons.items()])
+
+            for name, attr, help_text in (('request_latency_seconds', 'latency', 'Request latency.'),
+                                          ('ttft_seconds', 'ttft', 'Time to first token of streamed requests.')):
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                for action, stats in actions:
+                    histogram = getattr(stats, attr)
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{prefix}_{name}_bucket{{action="{action}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{prefix}_{name}_sum{{action="{action}"}} {histogram.sum}')
+                    lines.append(f'{prefix}_{name}_count{{action="{action}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(ledger, port, host="127.0.0.1"):
+    """Serve ``ledger.prometheus_text()`` at http://host:port/metrics from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = ledger.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    logger.info(f"Serving LLM call metrics at http://{host}:{server.server_port}/metrics")
+    return server
@@ -2,11 +2,13 @@ from .utils import match_detections_to_gt
 from .vllm_infer import generate
 from .prompt import *
 from .img_server import process_image_path
-from .utils import get_gt_pairs, extract_content
+from .utils import get_gt_pairs, extract_content, model_bbox_to_original, map_pair_bboxes, map_tagged_pairs
 import ast
 import json
 import logging
 
+logger = logging.getLogger(__name__)
+
 def evaluate(entities, gt_pairs, predicted_pairs):
     """
     评估预测的因果关系对的准确性
@@ -20,15 +22,15 @@ def evaluate(entities, gt_pairs, predicted_pairs):
         tuple: (accuracy, f1, reward)
     """
     if not predicted_pairs:
-        logging.warning("No predicted pairs provided")
+        logger.warning("No predicted pairs provided")
         return 0, 0, 0, 0, 0, 0, 0
         
     if not entities:
-        logging.warning("No entities provided")
+        logger.warning("No entities provided")
         return 0, 0, 0, 0, 0, 0, 0
         
     if not gt_pairs:
-        logging.warning("No ground truth pairs provided")
+        logger.warning("No ground truth pairs provided")
         return 0, 0, 0, 0, 0, 0, 0
 
     predicted_entities = []
@@ -39,13 +41,13 @@ def evaluate(entities, gt_pairs, predicted_pairs):
                 if e not in predicted_entities:
                     predicted_entities.append(e)
         except (AttributeError, TypeError) as e:
-            logging.error(f"Invalid pair format: {pair}")
+            logger.error(f"Invalid pair format: {pair}")
             continue
 
     try:
         matches, detection_P, detection_R, mean_giou = match_detections_to_gt(predicted_entities, entities)
     except Exception as e:
-        logging.error(f"Error matching detections to ground truth: {str(e)}")
+        logger.error(f"Error matching detections to ground truth: {str(e)}")
         return 0, 0, 0, 0, 0, 0, 0
 
     table = []
@@ -61,7 +63,7 @@ def evaluate(entities, gt_pairs, predicted_pairs):
                 'giou': match['giou']
             })
         except (KeyError, ValueError, IndexError) as e:
-            logging.error(f"Error processing match: {match}, Error: {str(e)}")
+            logger.error(f"Error processing match: {match}, Error: {str(e)}")
             continue
 
     predicted_relations = []
@@ -76,13 +78,13 @@ def evaluate(entities, gt_pairs, predicted_pairs):
                 except StopIteration:
                     continue
                 except (KeyError, TypeError) as e:
-                    logging.error(f"Error processing relation for pair {pair}: {str(e)}")
+                    logger.error(f"Error processing relation for pair {pair}: {str(e)}")
                     continue
 
             if len(relation) == 2:    
                 predicted_relations.append(relation)
         except (AttributeError, TypeError) as e:
-            logging.error(f"Invalid pair format: {pair}")
+            logger.error(f"Invalid pair format: {pair}")
             continue
 
     # count = 0
@@ -93,7 +95,7 @@ def evaluate(entities, gt_pairs, predicted_pairs):
     #         if [r1, r2] in gt_pairs:
     #             count += 1
     #     except (IndexError, KeyError) as e:
-    #         logging.error(f"Error checking relation {relation}: {str(e)}")
+    #         logger.error(f"Error checking relation {relation}: {str(e)}")
     #         continue
 
     unique_relations = set()
@@ -102,7 +104,7 @@ def evaluate(entities, gt_pairs, predicted_pairs):
             r1, r2 = relation[0]['index'], relation[1]['index']
             unique_relations.add((r1, r2))  # set 会自动去重
         except (IndexError, KeyError) as e:
-            logging.error(f"Error checking relation {relation}: {str(e)}")
+            logger.error(f"Error checking relation {relation}: {str(e)}")
             continue
 
     count = sum(1 for (r1, r2) in unique_relations if [r1, r2] in gt_pairs)
@@ -120,7 +122,7 @@ def evaluate(entities, gt_pairs, predicted_pairs):
             predicted_id.add(r1)
             predicted_id.add(r2)
         except (IndexError, KeyError) as e:
-            logging.error(f"Error checking relation {ele}: {str(e)}")
+            logger.error(f"Error checking relation {ele}: {str(e)}")
             continue
 
     reachable_count = 0
@@ -130,7 +132,7 @@ def evaluate(entities, gt_pairs, predicted_pairs):
             if r1 in predicted_id and r2 in predicted_id:
                 reachable_count += 1
         except (IndexError, KeyError) as e:
-            logging.error(f"Error checking relation {ele}: {str(e)}")
+            logger.error(f"Error checking relation {ele}: {str(e)}")
             continue
     
     ideal_P = reachable_count / len(predicted_pairs)
@@ -138,34 +140,50 @@ def evaluate(entities, gt_pairs, predicted_pairs):
     
     return causal_P, causal_R, detection_P, detection_R, mean_giou, ideal_P, ideal_R
 
-def vanilla_inference(image_path, image_server, data):
-    image_url_result = process_image_path(image_server, image_path)
+def vanilla_inference(image_path, image_server, data, image_cache=None, usage=None, gt=None):
+    # With an image cache the model sees a resized copy; its bboxes are mapped
+    # back to original coordinates before scoring.
+    image_transform = None
+    model_image_path = image_path
+    if image_cache is not None:
+        model_image_path, image_transform = image_cache.prepare(image_path)
+    image_url_result = process_image_path(image_server, model_image_path)
     
     # Ensure we have a single URL string
     if isinstance(image_url_result, list):
         if len(image_url_result) > 0:
             image_url = image_url_result[0]  # Take first URL if it's a list
         else:
-            print("No image URLs returned")
+            logger.warning("No image URLs returned")
             return 0, 0, 0, 0, 0, 0, 0, "No image URLs returned"
     else:
         image_url = image_url_result
 
-    gt_entities, gt_pairs = get_gt_pairs(data)
-
-    result = generate(image_url=image_url, prompt=General_prompt)
+    result = generate(image_url=image_url, prompt=General_prompt, sticky_key=image_path, action='General', usage=usage)
     
     # Handle case where generate returns None
     if result is None or len(result) == 0:
-        print("Generate function returned None or empty result")
+        logger.warning("Generate function returned None or empty result")
         return 0, 0, 0, 0, 0, 0, 0, "No result generated"
 
-    causal_pairs_text = extract_content(mark="causal pairs", text=result[0])
+    return score_vanilla_result(result[0], data, image_transform, gt)
+
+
+def score_vanilla_result(text, data, image_transform=None, gt=None):
+    """
+    Parse a ``General_prompt`` answer and evaluate its causal pairs against the
+    record's ground truth; shared by ``vanilla_inference`` and batch-file runs.
+    The returned answer has its causal pairs in original-image coordinates.
+    """
+    # gt: (entities, gt_pairs) from an annotation store, to skip parsing the record
+    gt_entities, gt_pairs = gt if gt is not None else get_gt_pairs(data)
+
+    causal_pairs_text = extract_content(mark="causal pairs", text=text)
     
     # Handle case where extract_content returns None
     if causal_pairs_text is None:
         causal_pairs = []
-        print(f"No causal pairs found in text: {result[0][:200]}...")
+        logger.warning(f"No causal pairs found in text: {text[:200]}...")
     else:
         try:
             causal_pairs = ast.literal_eval(causal_pairs_text)
@@ -174,8 +192,10 @@ def vanilla_inference(image_path, image_server, data):
                 causal_pairs = json.loads(causal_pairs_text)
             except json.JSONDecodeError:
                 causal_pairs = []
-                print(f"Failed to parse causal pairs: {causal_pairs_text}")
+                logger.warning(f"Failed to parse causal pairs: {causal_pairs_text}")
 
+    causal_pairs = map_pair_bboxes(causal_pairs, model_bbox_to_original, image_transform)
     causal_P, causal_R, detection_P, detection_R, mean_giou, ideal_P, ideal_R = evaluate(gt_entities, gt_pairs, causal_pairs)
 
-    return causal_P, causal_R, detection_P, detection_R, mean_giou, ideal_P, ideal_R, result[0]
\ No newline at end of file
+    text = map_tagged_pairs(text, "causal pairs", model_bbox_to_original, image_transform)
+    return causal_P, causal_R, detection_P, detection_R, mean_giou, ideal_P, ideal_R, text
\ No newline at end of file
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import math
+import os
+import threading
+
+from PIL import Image
+
+# Qwen2.5-VL resizes images to multiples of the vision patch size (14) times the
+# spatial merge size (2); sending images already on that grid avoids a second resize.
+SIZE_FACTOR = 28
+
+
+def resize_to_budget(image, max_pixels, size_factor=SIZE_FACTOR):
+    """
+    Downscale ``image`` so that width * height <= ``max_pixels``, keeping the aspect
+    ratio and snapping both sides to multiples of ``size_factor``. Images already
+    within the budget are returned unchanged.
+    """
+    width, height = image.size
+    if max_pixels is None or width * height <= max_pixels:
+        return image
+    scale = math.sqrt(max_pixels / (width * height))
+    new_width = max(size_factor, math.floor(width * scale / size_factor) * size_factor)
+    new_height = max(size_factor, math.floor(height * scale / size_factor) * size_factor)
+    return image.resize((new_width, new_height), Image.Resampling.BICUBIC)
+
+
+def save_image(image, output_path, jpeg_quality=None):
+    if jpeg_quality is not None and output_path.lower().endswith(('.jpg', '.jpeg')):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output_path, quality=jpeg_quality)
+    else:
+        image.save(output_path)
+
+
+class ImageCache:
+    """
+    Resize each image once to the model's pixel budget and keep the result on disk.
+
+    ``prepare`` returns the path to send to the model and a transform
+    ``{'original_size': [w, h], 'model_size': [w, h]}`` that maps the model's
+    bounding boxes back to original-image coordinates (see
+    ``utils.utils.model_bbox_to_original``). Entries are keyed by the source
+    file's path, size and mtime plus the resize settings, so several workers can
+    share one cache directory.
+    """
+
+    def __init__(self, cache_dir="cache/images", max_pixels=None, jpeg_quality=95, crop_jpeg_quality=None):
+        self.cache_dir = cache_dir
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.crop_jpeg_quality = crop_jpeg_quality if crop_jpeg_quality is not None else jpeg_quality
+        self._entries = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, image_path):
+        abs_path = os.path.abspath(image_path)
+        stat = os.stat(abs_path)
+        raw = f"{abs_path}|{stat.st_size}|{stat.st_mtime_ns}|{self.max_pixels}|{self.jpeg_quality}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def prepare(self, image_path):
+        """Return (path to send to the model, coordinate transform) for ``image_path``."""
+        key = self._key(image_path)
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+
+        meta_path = os.path.join(self.cache_dir, f"{key}.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['path'] is None or os.path.exists(meta['path']):
+                entry = (meta['path'] or image_path, meta['transform'])
+                with self._lock:
+                    self._entries[key] = entry
+                return entry
+
+        with Image.open(image_path) as image:
+            original_size = list(image.size)
+            resized = resize_to_budget(image, self.max_pixels)
+            cached_path = None
+            if resized is not image:
+                cached_path = os.path.join(self.cache_dir, f"{key}.jpg")
+                temp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp.jpg"
+                save_image(resized, temp_path, self.jpeg_quality)
+                os.replace(temp_path, cached_path)
+            transform = {'original_size': original_size, 'model_size': list(resized.size)}
+
+        temp_meta_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_meta_path, 'w') as f:
+            json.dump({'source': os.path.abspath(image_path), 'path': cached_path, 'transform': transform}, f)
+        os.replace(temp_meta_path, meta_path)
+
+        entry = (cached_path or image_path, transform)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
@@ -0,0 +1,77 @@
+"""
+Check that importing the package's entry points stays cheap.
+
+    python -m utils.import_budget            # check the default budgets
+    python -m utils.import_budget task=300   # override or add a module budget (ms)
+
+Each module is imported in a fresh interpreter with ``-X importtime``; the
+cumulative time of the best of ``--repeat`` runs must stay within its budget,
+and none of the lazily imported heavy dependencies may be pulled in.
+"""
+import argparse
+import subprocess
+import sys
+
+# Cumulative import time budgets in milliseconds, with headroom for slower machines
+DEFAULT_BUDGETS = {
+    'utils.sft': 20,
+    'utils.metrics': 50,
+    'utils.result_writer': 80,
+    'utils.vllm_infer': 100,
+    'build_sft': 150,
+    'utils.evaluate': 400,
+    'task': 400,
+    'run_inference': 400,
+    'run': 450,
+}
+# Only imported once they are used: by the model client, the matcher, plots
+DEFERRED_MODULES = ('openai', 'requests', 'scipy', 'pandas', 'matplotlib')
+
+
+def measure(module):
+    """(cumulative import time in ms, set of top-level packages imported) for ``module``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    total_us = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        imported.add(name.strip().split('.')[0])
+        if name.strip() == module:
+            total_us = int(cumulative)
+    return total_us / 1000, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('budgets', nargs='*', help="module=milliseconds")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    budgets = dict(DEFAULT_BUDGETS)
+    for item in args.budgets:
+        module, ms = item.split('=')
+        budgets[module] = float(ms)
+
+    failed = False
+    for module, budget in budgets.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        ms = min(run[0] for run in runs)
+        deferred = sorted(set(DEFERRED_MODULES) & runs[0][1])
+        ok = ms <= budget and not deferred
+        failed |= not ok
+        line = f"{'ok  ' if ok else 'FAIL'} {module:<22} {ms:7.1f} ms (budget {budget:.0f} ms)"
+        if deferred:
+            line += f", imports {', '.join(deferred)}"
+        print(line)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import atexit
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+# Image whose search or evaluation is running in the current thread/context
+current_image = contextvars.ContextVar("current_image", default=None)
+
+_listener = None
+
+
+@contextlib.contextmanager
+def image_context(image_id):
+    """Tag every record logged inside the block with ``image_id``."""
+    token = current_image.set(image_id)
+    try:
+        yield
+    finally:
+        current_image.reset(token)
+
+
+def run_in_image_context(image_id, fn, *args, **kwargs):
+    """Run ``fn`` under ``image_context``, e.g. as the target of an executor."""
+    with image_context(image_id):
+        return fn(*args, **kwargs)
+
+
+class ImageTagFilter(logging.Filter):
+    """Copy the current image id onto the record while still in the logging thread."""
+
+    def filter(self, record):
+        record.image_id = current_image.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most ``burst`` records per call site every ``interval``
+    seconds, for records at ``level``; other levels always pass, so INFO
+    progress lines and errors are never dropped. The first record after a
+    quiet period reports how many were suppressed.
+    """
+
+    def __init__(self, interval=60.0, burst=5, level=logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno != self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            count += 1
+            if count > self.burst:
+                self._windows[key] = (start, count, suppressed + 1)
+                return False
+            self._windows[key] = (start, count, 0)
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages)"
+        return True
+
+
+class ImageFileHandler(logging.Handler):
+    """Append records tagged with an image id to ``<log_dir>/<image id>.log``."""
+
+    def __init__(self, log_dir, max_open=16):
+        super().__init__()
+        self.log_dir = log_dir
+        self.max_open = max_open
+        self._files = OrderedDict()
+        os.makedirs(log_dir, exist_ok=True)
+
+    def emit(self, record):
+        image_id = getattr(record, 'image_id', None)
+        if image_id is None:
+            return
+        try:
+            f = self._files.pop(image_id, None)
+            if f is None:
+                if len(self._files) >= self.max_open:
+                    _, oldest = self._files.popitem(last=False)
+                    oldest.close()
+                name = str(image_id).replace(os.sep, '_')
+                f = open(os.path.join(self.log_dir, f"{name}.log"), 'a', encoding='utf-8')
+            self._files[image_id] = f
+            f.write(self.format(record) + "\n")
+            f.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        super().close()
+
+
+def parse_module_levels(spec):
+    """'search=DEBUG,utils.vllm_infer=WARNING' -> {'search': 'DEBUG', 'utils.vllm_infer': 'WARNING'}"""
+    levels = {}
+    for item in (spec or "").split(","):
+        if item.strip():
+            name, level = item.split("=")
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(log_file=None, level="INFO", module_levels=None, image_log_dir=None,
+                  rate_limit_interval=60.0, rate_limit_burst=5):
+    """
+    Route all logging through a queue: callers only format and enqueue the
+    record, a listener thread writes it to stderr, ``log_file`` and, when
+    ``image_log_dir`` is set, one file per image (see ``image_context``).
+
+    ``module_levels`` maps logger names to levels, e.g. {'search': 'DEBUG'}.
+    Repeated warnings from the same line are rate limited.
+    """
+    global _listener
+    stop_logging()
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file))
+    if image_log_dir is not None:
+        handlers.append(ImageFileHandler(image_log_dir))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ImageTagFilter())
+    if rate_limit_burst is not None:
+        queue_handler.addFilter(RateLimitFilter(rate_limit_interval, rate_limit_burst))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Flush the queue and close the handlers of the listener started by ``setup_logging``."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
@@ -0,0 +1,227 @@
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Below this many detection x ground-truth pairs the dense path is cheaper
+# than building the spatial index.
+SPARSE_MIN_PAIRS = 256
+# Boxes covering more grid cells than this are checked against every box
+# instead of being inserted cell by cell.
+MAX_CELLS_PER_BOX = 64
+
+
+def boxes_to_array(boxes, kind="detection"):
+    """(K, 4) float array of [x1, y1, x2, y2] boxes and a mask of the boxes that parsed."""
+    array = np.zeros((len(boxes), 4), dtype=np.float64)
+    valid = np.ones(len(boxes), dtype=bool)
+    for i, box in enumerate(boxes):
+        try:
+            array[i] = [float(x) for x in box]
+        except (ValueError, TypeError):
+            logger.error(f"Invalid {kind} box coordinates: {box}")
+            valid[i] = False
+    return array, valid
+
+
+def giou_of_pairs(det_boxes, gt_boxes):
+    """
+    GIoU of aligned box arrays (row i of ``det_boxes`` with row i of ``gt_boxes``),
+    using the same operations in the same order as ``utils.calculate_giou``.
+    """
+    x1 = np.maximum(det_boxes[:, 0], gt_boxes[:, 0])
+    y1 = np.maximum(det_boxes[:, 1], gt_boxes[:, 1])
+    x2 = np.minimum(det_boxes[:, 2], gt_boxes[:, 2])
+    y2 = np.minimum(det_boxes[:, 3], gt_boxes[:, 3])
+    intersection = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+
+    area1 = (det_boxes[:, 2] - det_boxes[:, 0]) * (det_boxes[:, 3] - det_boxes[:, 1])
+    area2 = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
+    union = area1 + area2 - intersection
+
+    cx1 = np.minimum(det_boxes[:, 0], gt_boxes[:, 0])
+    cy1 = np.minimum(det_boxes[:, 1], gt_boxes[:, 1])
+    cx2 = np.maximum(det_boxes[:, 2], gt_boxes[:, 2])
+    cy2 = np.maximum(det_boxes[:, 3], gt_boxes[:, 3])
+    convex_area = (cx2 - cx1) * (cy2 - cy1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = intersection / union
+        giou = iou - ((convex_area - union) / convex_area)
+    # calculate_giou returns 0 for an empty union and fails on an empty hull,
+    # which the scorer counted as the maximum cost
+    return np.where((union == 0) | (convex_area == 0), 0.0, giou)
+
+
+def dense_giou_matrix(det_boxes, gt_boxes):
+    rows, cols = np.meshgrid(np.arange(len(det_boxes)), np.arange(len(gt_boxes)), indexing='ij')
+    return giou_of_pairs(det_boxes[rows.ravel()], gt_boxes[cols.ravel()]).reshape(len(det_boxes), len(gt_boxes))
+
+
+def overlapping_pairs(det_boxes, gt_boxes, det_valid, gt_valid):
+    """
+    (det index, gt index) pairs whose boxes intersect with positive area, found
+    with a uniform grid over the ground-truth boxes instead of testing all pairs.
+    """
+    gt_indices = np.flatnonzero(gt_valid)
+    if len(gt_indices) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    sizes = np.concatenate([gt_boxes[gt_indices, 2] - gt_boxes[gt_indices, 0],
+                            gt_boxes[gt_indices, 3] - gt_boxes[gt_indices, 1]])
+    cell = max(float(np.median(sizes)), 1e-6)
+
+    def cell_range(box):
+        return (math.floor(box[0] / cell), math.floor(box[1] / cell),
+                math.floor(box[2] / cell), math.floor(box[3] / cell))
+
+    grid = {}
+    large = []
+    for j in gt_indices:
+        cx1, cy1, cx2, cy2 = cell_range(gt_boxes[j])
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > MAX_CELLS_PER_BOX:
+            large.append(j)
+            continue
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                grid.setdefault((cx, cy), []).append(j)
+
+    rows, cols = [], []
+    for i in np.flatnonzero(det_valid):
+        cx1, cy1, cx2, cy2 = cell_range(det_boxes[i])
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > MAX_CELLS_PER_BOX:
+            candidates = gt_indices
+        else:
+            candidates = set(large)
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    candidates.update(grid.get((cx, cy), ()))
+            candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        if len(candidates) == 0:
+            continue
+        box = det_boxes[i]
+        overlap = ((np.minimum(box[2], gt_boxes[candidates, 2]) - np.maximum(box[0], gt_boxes[candidates, 0]) > 0)
+                   & (np.minimum(box[3], gt_boxes[candidates, 3]) - np.maximum(box[1], gt_boxes[candidates, 1]) > 0))
+        rows.extend([i] * int(overlap.sum()))
+        cols.extend(candidates[overlap].tolist())
+    return np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+
+
+def assign_dense(det_boxes, gt_boxes, det_valid, gt_valid, giou_threshold):
+    """
+    Optimal assignment over the full (1 - GIoU) cost matrix, kept below
+    ``giou_threshold`` afterwards, exactly as ``match_detections_to_gt`` always
+    scored: pairs below the threshold still take part in the assignment.
+    """
+    from scipy.optimize import linear_sum_assignment
+    # Unparsable boxes take no part; their zero-cost rows used to read as a GIoU of 1
+    det_indices, gt_indices = np.flatnonzero(det_valid), np.flatnonzero(gt_valid)
+    if len(det_indices) == 0 or len(gt_indices) == 0:
+        return []
+    cost_matrix = 1 - dense_giou_matrix(det_boxes[det_indices], gt_boxes[gt_indices])
+    row_ind, col_ind = linear_sum_assignment(cost_matrix)
+    matches = []
+    for i, j in zip(row_ind, col_ind):
+        giou = 1 - cost_matrix[i, j]
+        if giou >= giou_threshold:
+            matches.append((int(det_indices[i]), int(gt_indices[j]), float(giou)))
+    return matches
+
+
+def assign_sparse(det_boxes, gt_boxes, det_valid, gt_valid, giou_threshold):
+    """
+    Same result as ``assign_dense`` for ``giou_threshold`` > 0. Only overlapping
+    boxes can reach a positive GIoU, so a spatial grid finds whether any pair can
+    be kept at all; if none can, the assignment is skipped. Otherwise the full
+    matrix is solved: pairs below the threshold take part in the assignment
+    with their own GIoU, which ties boxes in different overlap groups together,
+    so solving the groups separately would not give the same matches.
+    """
+    rows, cols = overlapping_pairs(det_boxes, gt_boxes, det_valid, gt_valid)
+    if len(rows) == 0 or not (giou_of_pairs(det_boxes[rows], gt_boxes[cols]) >= giou_threshold).any():
+        return []
+    return assign_dense(det_boxes, gt_boxes, det_valid, gt_valid, giou_threshold)
+
+
+def assign(det_boxes, gt_boxes, giou_threshold=0.5, engine='auto'):
+    """
+    Optimal one-to-one matching of detection boxes to ground-truth boxes that
+    minimizes the total (1 - GIoU) cost, keeping the pairs with GIoU >= ``giou_threshold``.
+
+    ``engine`` is 'dense', 'sparse' or 'auto' (sparse for large inputs when the
+    threshold is positive). Returns (det index, gt index, giou) sorted by det index.
+    """
+    det_array, det_valid = boxes_to_array(det_boxes, "detection")
+    gt_array, gt_valid = boxes_to_array(gt_boxes, "ground truth")
+    if engine == 'auto':
+        sparse = giou_threshold > 0 and len(det_boxes) * len(gt_boxes) >= SPARSE_MIN_PAIRS
+        engine = 'sparse' if sparse else 'dense'
+    if engine == 'sparse':
+        if giou_threshold <= 0:
+            raise ValueError("The sparse engine needs a positive GIoU threshold")
+        return assign_sparse(det_array, gt_array, det_valid, gt_valid, giou_threshold)
+    if engine == 'dense':
+        return assign_dense(det_array, gt_array, det_valid, gt_valid, giou_threshold)
+    raise ValueError(f"Unknown matching engine: {engine}")
+
+
+def _reference_assign(det_boxes, gt_boxes, giou_threshold):
+    """
+    The scorer's original pair-by-pair cost matrix and assignment, for
+    ``check_engines``; its boxes all parse.
+    """
+    from scipy.optimize import linear_sum_assignment
+    from .utils import calculate_giou
+    cost_matrix = np.zeros((len(det_boxes), len(gt_boxes)))
+    for i, d_box in enumerate(det_boxes):
+        for j, gt_box in enumerate(gt_boxes):
+            try:
+                cost_matrix[i, j] = 1 - calculate_giou(d_box, gt_box)
+            except Exception:
+                cost_matrix[i, j] = 1
+    row_ind, col_ind = linear_sum_assignment(cost_matrix)
+    return [(int(i), int(j), float(1 - cost_matrix[i, j])) for i, j in zip(row_ind, col_ind)
+            if 1 - cost_matrix[i, j] >= giou_threshold]
+
+
+def check_engines(cases=2000, seed=0, giou_threshold=0.5):
+    """
+    Run the original scorer and both engines on random boxes with many exact
+    ties (duplicated boxes, boxes on a coarse grid) and raise AssertionError on
+    the first difference.
+    """
+    rng = np.random.default_rng(seed)
+    for case in range(cases):
+        det_count, gt_count = rng.integers(1, 30, size=2)
+        # A coarse grid makes equal GIoU values common even without duplicates
+        gt = rng.integers(0, 8, size=(gt_count, 2)) * 10
+        gt = np.concatenate([gt, gt + rng.integers(1, 4, size=(gt_count, 2)) * 10], axis=1).astype(float)
+        det = gt[rng.integers(0, gt_count, size=det_count)] + rng.integers(-1, 2, size=(det_count, 4)) * 5
+        if case % 2 == 0:
+            det = np.concatenate([det, det[:rng.integers(1, det_count + 1)]])
+            gt = np.concatenate([gt, gt[:rng.integers(1, gt_count + 1)]])
+        if case % 3 == 0:
+            # Boxes away from everything else still take part in the assignment
+            far = rng.integers(100, 200, size=2)
+            det = np.concatenate([det, [[*far, *(far + 5)]]])
+        det_valid, gt_valid = np.ones(len(det), dtype=bool), np.ones(len(gt), dtype=bool)
+        reference = _reference_assign(det.tolist(), gt.tolist(), giou_threshold)
+        dense = assign_dense(det, gt, det_valid, gt_valid, giou_threshold)
+        sparse = assign_sparse(det, gt, det_valid, gt_valid, giou_threshold)
+        assert dense == reference, f"Dense engine differs from the scorer on case {case}:\n{det.tolist()}\n{gt.tolist()}"
+        assert sparse == dense, f"Engines differ on case {case}:\n{det.tolist()}\n{gt.tolist()}"
+        # An unparsable box changes nothing but its own (absent) matches
+        det_valid[rng.integers(0, len(det))] = False
+        kept = np.flatnonzero(det_valid)
+        expected = [(int(kept[i]), j, giou) for i, j, giou in
+                    _reference_assign(det[kept].tolist(), gt.tolist(), giou_threshold)]
+        for engine in (assign_dense, assign_sparse):
+            assert engine(det, gt, det_valid, gt_valid, giou_threshold) == expected, \
+                f"Unparsable box changed the matches on case {case}"
+    return cases
+
+
+if __name__ == '__main__':
+    # python -m utils.matching checks that both engines give the scorer's matches
+    print(f"{check_engines()} cases matched identically by the scorer and the dense and sparse engines")
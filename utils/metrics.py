@@ -0,0 +1,170 @@
+import json
+import math
+import os
+import time
+import uuid
+
+
+class RunningStats:
+    """Streaming count, mean and (population) std of one metric, using Welford's algorithm."""
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """Combine with statistics gathered elsewhere (Chan et al. parallel update)."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count > 0 else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['count'], state['mean'], state['m2'])
+
+
+class MetricAggregator:
+    """
+    Running mean/std of per-image metrics, overall and per dataset subset, plus
+    throughput and ETA. State can be saved and loaded so a resumed run keeps its
+    totals, and aggregators from several workers can be merged. ``run_id``
+    identifies the evaluation across resumes, e.g. to tell its results apart
+    from earlier runs appended to the same file.
+    """
+
+    def __init__(self, metric_names, total=None, run_id=None):
+        self.metric_names = list(metric_names)
+        self.total = total
+        self.run_id = run_id or uuid.uuid4().hex
+        self.stats = {}
+        self.images = 0
+        self.tokens = 0
+        self.done = set()
+        # Counters of the current session only, so throughput ignores resumed totals
+        self._session_start = time.time()
+        self._session_images = 0
+        self._session_tokens = 0
+
+    def _subset_stats(self, subset):
+        if subset not in self.stats:
+            self.stats[subset] = {name: RunningStats() for name in self.metric_names}
+        return self.stats[subset]
+
+    def update(self, metrics, subset=None, tokens=0, key=None):
+        """Add one image's metrics; ``key`` marks the image as done for resuming."""
+        for group in ('all', subset) if subset is not None else ('all',):
+            stats = self._subset_stats(group)
+            for name in self.metric_names:
+                stats[name].update(metrics[name])
+        self.images += 1
+        self.tokens += tokens
+        self._session_images += 1
+        self._session_tokens += tokens
+        if key is not None:
+            self.done.add(key)
+
+    def merge(self, other):
+        for subset, other_stats in other.stats.items():
+            stats = self._subset_stats(subset)
+            for name in self.metric_names:
+                stats[name].merge(other_stats[name])
+        self.images += other.images
+        self.tokens += other.tokens
+        self.done |= other.done
+
+    def mean(self, name, subset='all'):
+        return self._subset_stats(subset)[name].mean
+
+    def std(self, name, subset='all'):
+        return self._subset_stats(subset)[name].std
+
+    def progress(self):
+        """One line with progress, throughput, ETA and running means."""
+        elapsed = max(time.time() - self._session_start, 1e-9)
+        images_per_sec = self._session_images / elapsed
+        tokens_per_sec = self._session_tokens / elapsed
+        line = f"[{self.images}"
+        if self.total is not None:
+            line += f"/{self.total}"
+        line += f" images] {images_per_sec:.2f} images/s, {tokens_per_sec:.0f} tokens/s"
+        if self.total is not None and images_per_sec > 0:
+            eta = (self.total - self.images) / images_per_sec
+            line += f", ETA {int(eta // 3600)}h{int(eta % 3600 // 60):02d}m{int(eta % 60):02d}s"
+        means = ", ".join(f"{name}: {self.mean(name):.4f}" for name in self.metric_names)
+        return f"{line} | {means}"
+
+    def summary(self):
+        """{subset: {metric: {'mean', 'std', 'count'}}} including the 'all' subset."""
+        return {
+            subset: {name: {'mean': s.mean, 'std': s.std, 'count': s.count} for name, s in stats.items()}
+            for subset, stats in self.stats.items()
+        }
+
+    def state_dict(self):
+        return {
+            'run_id': self.run_id,
+            'metric_names': self.metric_names,
+            'images': self.images,
+            'tokens': self.tokens,
+            'done': sorted(self.done),
+            'stats': {
+                subset: {name: s.to_dict() for name, s in stats.items()}
+                for subset, stats in self.stats.items()
+            },
+        }
+
+    @classmethod
+    def from_state_dict(cls, state, total=None):
+        aggregator = cls(state['metric_names'], total=total, run_id=state.get('run_id'))
+        aggregator.images = state['images']
+        aggregator.tokens = state['tokens']
+        aggregator.done = set(state['done'])
+        aggregator.stats = {
+            subset: {name: RunningStats.from_dict(s) for name, s in stats.items()}
+            for subset, stats in state['stats'].items()
+        }
+        return aggregator
+
+    def save(self, path):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.state_dict(), f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, total=None):
+        with open(path, 'r') as f:
+            return cls.from_state_dict(json.load(f), total=total)
+
+
+def merge_aggregators(paths, total=None):
+    """Merge the saved states of several workers into one aggregator."""
+    merged = None
+    for path in paths:
+        aggregator = MetricAggregator.load(path, total=total)
+        if merged is None:
+            merged = aggregator
+        else:
+            merged.merge(aggregator)
+    return merged
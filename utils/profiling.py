@@ -0,0 +1,336 @@
+"""
+Per-image CPU profiles of the drivers, aggregated into a hot-function report by stage.
+
+``ImageProfiler.image(image_id)`` profiles one image, with either
+
+    cprofile  cProfile over the thread processing the image, timed with its CPU time
+    sample    a sampler over every thread, weighting each stack by the CPU time its
+              thread used since the previous sample; it also sees the rollout,
+              speculation and prefetch threads, including work for upcoming images
+
+and writes ``<dir>/images/<image id>.pstats``. ``ImageProfiler.report`` merges
+them into ``<dir>/all.pstats`` and writes ``report.txt`` / ``report.json``:
+the CPU seconds of each stage and its hottest functions by self time.
+
+    python -m utils.profiling report profile/ --baseline profile-before/
+
+rebuilds the report from the pstats files, with the change of every stage
+against an earlier profile.
+"""
+import argparse
+import contextlib
+import cProfile
+import glob
+import json
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stages, first match wins. A function matches by (repo-relative file, name),
+# by name anywhere, or by file; functions that match nothing (builtins, other
+# libraries, helpers in utils/utils.py) are charged to the stages of their callers.
+STAGE_FUNCTIONS = {
+    'initialize_state': {('node.py', 'initialize_state')},
+    'cropping': {('task.py', 'crop'), ('utils/utils.py', 'zoom_in'), ('utils/utils.py', 'restore_bbox')},
+    'scoring': {('task.py', 'reward'), ('task.py', 'reward_terms'), ('task.py', 'combine_reward'),
+                ('task.py', 'get_gt'), ('utils/utils.py', 'get_gt_pairs'), ('search.py', 'reward_value'),
+                ('search.py', 'extrapolated_value')},
+}
+STAGE_FILES = {
+    'cropping': ('utils/image_cache.py',),
+    'scoring': ('utils/evaluate.py', 'utils/matching.py', 'utils/annotation_store.py'),
+    'client': ('utils/vllm_infer.py', 'utils/call_ledger.py', 'utils/batch_infer.py', 'utils/img_server.py'),
+    'search': ('search.py', 'node.py', 'task.py', 'utils/speculation.py'),
+}
+# Third-party packages and stdlib modules whose time is client overhead
+CLIENT_PACKAGES = ('openai', 'httpx', 'httpcore', 'h11', 'anyio', 'requests', 'urllib3', 'pydantic')
+CLIENT_MODULES = ('ssl.py', 'socket.py', 'http/client.py', 'http/server.py', 'socketserver.py')
+STAGES = ('search', 'initialize_state', 'cropping', 'scoring', 'client', 'other')
+
+
+def _relative(filename):
+    if filename.startswith(REPO_ROOT + os.sep):
+        return os.path.relpath(filename, REPO_ROOT).replace(os.sep, '/')
+    return None
+
+
+def classify(func):
+    """Stage of a pstats function key (file, line, name), or None if it is charged to its callers."""
+    filename, _, name = func
+    relative = _relative(filename)
+    for stage, functions in STAGE_FUNCTIONS.items():
+        if (relative, name) in functions:
+            return stage
+    if relative is not None:
+        for stage, files in STAGE_FILES.items():
+            if relative in files:
+                return stage
+        return None
+    path = filename.replace(os.sep, '/')
+    if any(f"/{package}/" in path for package in CLIENT_PACKAGES) or path.endswith(CLIENT_MODULES):
+        return 'client'
+    return None
+
+
+def stage_shares(stats):
+    """{function: {stage: share of its self time}}, following unclassified functions up their callers."""
+    shares = {}
+
+    def resolve(func, visiting):
+        if func in shares:
+            return shares[func]
+        stage = classify(func)
+        if stage is not None:
+            shares[func] = {stage: 1.0}
+            return shares[func]
+        callers = stats[func][4] if func in stats else {}
+        weights = {caller: edge[2] for caller, edge in callers.items() if caller not in visiting}
+        total = sum(weights.values())
+        if total <= 0:
+            # No self time through any caller; fall back to the time spent below them
+            weights = {caller: edge[3] for caller, edge in callers.items() if caller not in visiting}
+            total = sum(weights.values())
+        if total <= 0 or len(visiting) > 200:
+            result = {'other': 1.0}
+        else:
+            result = defaultdict(float)
+            visiting.add(func)
+            for caller, weight in weights.items():
+                for stage, share in resolve(caller, visiting).items():
+                    result[stage] += share * weight / total
+            visiting.discard(func)
+            result = dict(result)
+        # Within a cycle of unclassified callers this ignores the edge back; close enough
+        shares[func] = result
+        return result
+
+    for func in stats:
+        resolve(func, set())
+    return shares
+
+
+class SamplingProfiler:
+    """
+    Stack sampler producing pstats-compatible statistics; call counts are
+    sample counts. Where the platform has per-thread CPU clocks, a stack is
+    weighted by the CPU time of its thread since the last sample, so blocked
+    threads cost nothing; elsewhere by the sampling interval.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._entries = {}
+        self._cpu = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {}
+
+    def _thread_cpu(self, ident):
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return None
+
+    def _weight(self, ident):
+        cpu = self._thread_cpu(ident)
+        if cpu is None:
+            return self.interval
+        last = self._cpu.get(ident, cpu)
+        self._cpu[ident] = cpu
+        return cpu - last
+
+    def _add_stack(self, frame, weight):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        seen = set()
+        for depth, func in enumerate(stack):
+            entry = self._entries.setdefault(func, [0, 0, 0.0, 0.0, {}])
+            leaf = depth == 0
+            if leaf:
+                entry[2] += weight
+            if func not in seen:
+                # A recursive function is on the stack once as far as its inclusive time goes
+                seen.add(func)
+                entry[0] += 1
+                entry[1] += 1
+                entry[3] += weight
+            if depth + 1 < len(stack):
+                edge = entry[4].setdefault(stack[depth + 1], [0, 0, 0.0, 0.0])
+                edge[0] += 1
+                edge[1] += 1
+                edge[2] += weight if leaf else 0.0
+                edge[3] += weight
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                weight = self._weight(ident)
+                if weight > 0:
+                    self._add_stack(frame, weight)
+
+    def enable(self):
+        for ident in sys._current_frames():
+            self._weight(ident)
+        self._thread = threading.Thread(target=self._run, daemon=True, name="profile-sampler")
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def create_stats(self):
+        self.stats = {func: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers.items()})
+                      for func, (cc, nc, tt, ct, callers) in self._entries.items()}
+
+    def dump_stats(self, path):
+        self.create_stats()
+        with open(path, 'wb') as f:
+            marshal.dump(self.stats, f)
+
+
+def _safe_name(image_id):
+    return str(image_id).replace(os.sep, '_').replace('/', '_')
+
+
+def _format_func(func):
+    filename, line, name = func
+    relative = _relative(filename)
+    if relative is None:
+        relative = os.path.basename(filename) if filename != '~' else ''
+    return f"{relative}:{line}({name})" if relative else name
+
+
+def summarize_stats(stats, top=15):
+    """{'total', 'stages': {stage: seconds}, 'top': {stage: [(function, seconds, calls)]}} of a pstats.Stats."""
+    shares = stage_shares(stats.stats)
+    stage_seconds = defaultdict(float)
+    functions = defaultdict(list)
+    for func, (_, nc, tt, _, _) in stats.stats.items():
+        if tt <= 0:
+            continue
+        for stage, share in shares[func].items():
+            stage_seconds[stage] += tt * share
+            functions[stage].append((_format_func(func), tt * share, nc))
+    return {
+        'total': sum(stage_seconds.values()),
+        'stages': {stage: stage_seconds.get(stage, 0.0) for stage in STAGES},
+        'top': {stage: sorted(functions[stage], key=lambda item: -item[1])[:top] for stage in STAGES
+                if functions[stage]},
+    }
+
+
+def format_report(summary, images, mode, baseline=None):
+    lines = [f"CPU profile of {images} images ({mode}): {summary['total']:.2f} s"]
+    header = f"{'stage':<18} {'seconds':>9} {'share':>7}"
+    if baseline is not None:
+        header += f" {'baseline':>9} {'change':>8}"
+    lines.append(header)
+    for stage, seconds in summary['stages'].items():
+        line = f"{stage:<18} {seconds:9.3f} {seconds / max(summary['total'], 1e-12):7.1%}"
+        if baseline is not None:
+            before = baseline['stages'].get(stage, 0.0)
+            if before > 0:
+                change = f"{seconds / before - 1:+8.1%}"
+            else:
+                change = f"{'new' if seconds > 0 else '-':>8}"
+            line += f" {before:9.3f} {change}"
+        lines.append(line)
+    for stage, functions in summary['top'].items():
+        lines.append("")
+        lines.append(f"[{stage}] {'self s':>9} {'calls':>8}  function")
+        for name, seconds, calls in functions:
+            lines.append(f"{'':<{len(stage) + 2}} {seconds:9.4f} {calls:8d}  {name}")
+    return "\n".join(lines)
+
+
+def write_report(profile_dir, top=15, baseline_dir=None):
+    """Merge ``<profile_dir>/images/*.pstats`` and write the reports; returns the text report."""
+    paths = sorted(glob.glob(os.path.join(profile_dir, 'images', '*.pstats')))
+    stats = None
+    for path in paths:
+        with open(path, 'rb') as f:
+            if not marshal.load(f):
+                # An image too quick for the sampler to catch
+                continue
+        if stats is None:
+            stats = pstats.Stats(path)
+        else:
+            stats.add(path)
+    if stats is None:
+        return f"No profiles in {profile_dir}"
+    stats.dump_stats(os.path.join(profile_dir, 'all.pstats'))
+    mode = 'unknown'
+    if os.path.exists(os.path.join(profile_dir, 'mode')):
+        with open(os.path.join(profile_dir, 'mode'), 'r') as f:
+            mode = f.read().strip()
+
+    summary = summarize_stats(stats, top)
+    baseline = None
+    if baseline_dir is not None:
+        with open(os.path.join(baseline_dir, 'report.json'), 'r') as f:
+            baseline = json.load(f)
+    text = format_report(summary, len(paths), mode, baseline)
+    with open(os.path.join(profile_dir, 'report.txt'), 'w') as f:
+        f.write(text + "\n")
+    with open(os.path.join(profile_dir, 'report.json'), 'w') as f:
+        json.dump({'images': len(paths), 'mode': mode, **summary}, f, indent=2)
+    return text
+
+
+class ImageProfiler:
+    def __init__(self, profile_dir, mode='cprofile', interval=0.005):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode}, expected one of {', '.join(PROFILE_MODES)}")
+        self.profile_dir = profile_dir
+        self.mode = mode
+        self.interval = interval
+        os.makedirs(os.path.join(profile_dir, 'images'), exist_ok=True)
+        with open(os.path.join(profile_dir, 'mode'), 'w') as f:
+            f.write(mode)
+
+    def _new_profiler(self):
+        if self.mode == 'cprofile':
+            return cProfile.Profile(time.thread_time)
+        return SamplingProfiler(self.interval)
+
+    @contextlib.contextmanager
+    def image(self, image_id):
+        """Profile the block and save it as ``images/<image id>.pstats``."""
+        profiler = self._new_profiler()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, 'images', f"{_safe_name(image_id)}.pstats"))
+
+    def report(self, top=15):
+        return write_report(self.profile_dir, top)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['report'])
+    parser.add_argument('profile_dir')
+    parser.add_argument('--top', type=int, default=15, help="functions listed per stage")
+    parser.add_argument('--baseline', default=None, help="profile directory to compare the stages against")
+    args = parser.parse_args()
+    print(write_report(args.profile_dir, args.top, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
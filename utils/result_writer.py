@@ -0,0 +1,253 @@
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+FSYNC_POLICIES = ('never', 'close', 'always')
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _open_compressed(path, mode, compression):
+    """Open ``path`` as a text stream, (de)compressing with gzip or zstd."""
+    if compression is None:
+        return open(path, mode + 't', encoding='utf-8')
+    if compression == 'gzip':
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("zstd compression requires the 'zstandard' package") from e
+        raw = open(path, mode + 'b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _compression_of(path):
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+class ResultWriter:
+    """
+    Append JSON records to a jsonl output from a background thread.
+
+    ``write`` only serializes the record and queues it; the flush thread writes
+    queued records in batches of up to ``batch_size`` lines, at least every
+    ``flush_interval`` seconds. ``fsync`` is one of 'never', 'close' (when a
+    shard is closed) or 'always' (after every batch).
+
+    Without ``shard_size`` and ``compression`` records are appended to ``path``
+    itself, as before, one ``O_APPEND`` write per batch so that several processes
+    appending to the same file do not interleave their lines. Otherwise they go to shards named
+    ``<stem>-<tag>-<index>.jsonl[.gz|.zst]`` next to ``path``. A new shard starts
+    once the current one holds ``shard_size`` bytes of uncompressed JSON. Each
+    writer keeps a ``<stem>-<tag>.manifest.json`` listing its shards. ``tag``
+    defaults to host and pid, so several workers can share one output prefix.
+    Use ``iter_records`` to stream everything back.
+    """
+
+    def __init__(self, path, shard_size=None, compression=None, fsync='close', batch_size=64,
+                 flush_interval=1.0, tag=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync}")
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"compression must be one of {list(COMPRESSION_EXTENSIONS)}, got {compression}")
+        self.path = path
+        self.shard_size = shard_size
+        self.compression = compression
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sharded = shard_size is not None or compression is not None
+        self.tag = tag or f"{socket.gethostname()}-{os.getpid()}"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._stem = path[:-len('.jsonl')] if path.endswith('.jsonl') else path
+        self._shards = []
+        self._file = None
+        self._queue = queue.Queue()
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"result-writer-{os.path.basename(path)}")
+        self._thread.start()
+
+    @property
+    def manifest_path(self):
+        return f"{self._stem}-{self.tag}.manifest.json"
+
+    def write(self, record):
+        if self._error is not None:
+            raise RuntimeError(f"Result writer for {self.path} failed") from self._error
+        if self._closed:
+            raise RuntimeError(f"Result writer for {self.path} is closed")
+        self._queue.put(json.dumps(record) + "\n")
+
+    def flush(self):
+        """Block until every record written so far is in the output (and synced if fsync='always')."""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(0.1):
+            if self._error is not None or not self._thread.is_alive():
+                break
+        if self._error is not None:
+            raise RuntimeError(f"Result writer for {self.path} failed") from self._error
+
+    def close(self):
+        """Flush everything still queued, close the current shard and wait for the thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError(f"Result writer for {self.path} failed") from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            lines = []
+            flushed = None
+            deadline = time.time() + self.flush_interval
+            while len(lines) < self.batch_size:
+                try:
+                    line = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if line is None:
+                    stopping = True
+                    break
+                if isinstance(line, threading.Event):
+                    # flush(): write what came before it now
+                    flushed = line
+                    break
+                lines.append(line)
+            try:
+                if lines:
+                    self._write_batch(lines)
+                if stopping:
+                    self._close_shard()
+                if flushed is not None:
+                    flushed.set()
+            except Exception as e:
+                logging.error(f"Failed to write results to {self.path}: {str(e)}")
+                self._error = e
+                return
+
+    def _open_shard(self):
+        if not self.sharded:
+            self._file = open(self.path, 'ab', buffering=0)
+            return
+        name = f"{os.path.basename(self._stem)}-{self.tag}-{len(self._shards):05d}.jsonl"
+        name += COMPRESSION_EXTENSIONS[self.compression]
+        shard_path = os.path.join(os.path.dirname(self.path), name)
+        self._file = _open_compressed(shard_path, 'w', self.compression)
+        self._shards.append({'path': name, 'records': 0, 'bytes': 0, 'closed': False})
+
+    def _write_batch(self, lines):
+        if self._file is None:
+            self._open_shard()
+        data = "".join(lines)
+        if not self.sharded:
+            encoded = data.encode('utf-8')
+            while encoded:
+                written = self._file.write(encoded)
+                encoded = encoded[written:]
+            if self.fsync == 'always':
+                self._sync()
+            return
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync == 'always':
+            self._sync()
+        shard = self._shards[-1]
+        shard['records'] += len(lines)
+        shard['bytes'] += len(data.encode('utf-8'))
+        if self.shard_size is not None and shard['bytes'] >= self.shard_size:
+            self._close_shard()
+        else:
+            self._write_manifest()
+
+    def _sync(self):
+        raw = self._file
+        # Reach the underlying file through the text and compression wrappers
+        for attr in ('buffer', 'fileobj', 'raw'):
+            raw = getattr(raw, attr, raw)
+        try:
+            os.fsync(raw.fileno())
+        except (AttributeError, OSError, io.UnsupportedOperation) as e:
+            logging.warning(f"Could not fsync {self.path}: {str(e)}")
+
+    def _close_shard(self):
+        if self._file is None:
+            return
+        if self.fsync != 'never':
+            self._file.flush()
+            self._sync()
+        self._file.close()
+        self._file = None
+        if self.sharded:
+            self._shards[-1]['closed'] = True
+            self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = {
+            'output': os.path.basename(self.path),
+            'compression': self.compression,
+            'shards': self._shards,
+        }
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+
+def iter_records(path, include_open=False):
+    """
+    Stream the records written to ``path`` by one or more ResultWriters.
+
+    ``path`` may be the plain jsonl output, the output prefix of sharded writers
+    (every ``<stem>-*.manifest.json`` next to it is read), or a single shard.
+    Shards still being written are skipped unless ``include_open`` is set, since
+    a compressed shard is not readable until it is closed.
+    """
+    stem = path[:-len('.jsonl')] if path.endswith('.jsonl') else path
+    shard_paths = []
+    for manifest_path in sorted(glob.glob(f"{glob.escape(stem)}-*.manifest.json")):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for shard in manifest['shards']:
+            if shard['closed'] or include_open:
+                shard_paths.append(os.path.join(os.path.dirname(manifest_path), shard['path']))
+    if os.path.exists(path):
+        shard_paths.insert(0, path)
+
+    for shard_path in shard_paths:
+        with _open_compressed(shard_path, 'r', _compression_of(shard_path)) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
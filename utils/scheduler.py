@@ -0,0 +1,142 @@
+import heapq
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+from PIL import Image
+
+from .result_writer import iter_records
+
+FEATURE_NAMES = ['bias', 'entities', 'relations', 'megapixels']
+# Rough relative cost of one image before any telemetry is available: every
+# entity and relation lengthens the generations, more pixels mean more vision tokens.
+DEFAULT_WEIGHTS = np.array([1.0, 0.15, 0.3, 0.5])
+
+
+def get_cost_features(data, image_path=None):
+    """[1, entity count, relation count, megapixels] of one annotation record."""
+    entities = len(data.get('entities') or [])
+    relations = sum(len(value) for value in (data.get('relations') or {}).values() if value is not None)
+    image_info = data['images'][0] if data.get('images') else {}
+    width, height = image_info.get('width'), image_info.get('height')
+    if (width is None or height is None) and image_path is not None:
+        try:
+            # Only the header is read, the pixels are not decoded
+            with Image.open(image_path) as image:
+                width, height = image.size
+        except OSError as e:
+            logging.warning(f"Could not read the size of {image_path}: {str(e)}")
+    megapixels = (width or 0) * (height or 0) / 1e6
+    return np.array([1.0, entities, relations, megapixels])
+
+
+def load_cost_history(paths, key='image_path', cost_field='search_metric'):
+    """{image key: seconds} from earlier runs' outputs, e.g. raw_sft_data.jsonl."""
+    history = {}
+    for path in paths:
+        for record in iter_records(path):
+            if record.get(key) is not None and record.get(cost_field) is not None:
+                history[record[key]] = float(record[cost_field])
+    return history
+
+
+class CostModel:
+    """
+    Linear per-image cost estimate over ``FEATURE_NAMES``. ``fit`` replaces the
+    default weights with a least-squares fit to measured costs; images whose
+    cost was measured before are estimated by that measurement.
+    """
+
+    def __init__(self, weights=DEFAULT_WEIGHTS, history=None):
+        self.weights = np.asarray(weights, dtype=float)
+        self.history = history or {}
+
+    def fit(self, features, costs, min_samples=len(FEATURE_NAMES) * 4):
+        if len(costs) < min_samples:
+            logging.info(f"Only {len(costs)} cost samples, keeping the default cost weights")
+            return self
+        weights, _, _, _ = np.linalg.lstsq(np.asarray(features), np.asarray(costs), rcond=None)
+        # A negative weight would rank heavier images as cheaper
+        self.weights = np.maximum(weights, 0.0)
+        logging.info(f"Fitted cost weights: {dict(zip(FEATURE_NAMES, self.weights.round(4)))}")
+        return self
+
+    def estimate(self, features, key=None):
+        if key is not None and key in self.history:
+            return self.history[key]
+        return max(float(features @ self.weights), 1e-6)
+
+
+def build_cost_model(items, history):
+    """
+    Cost model for ``items`` (tuples whose first element is the annotation record
+    and last is the image path), fitted on the items that appear in ``history``.
+    Returns the model and each item's features.
+    """
+    features = [get_cost_features(item[0], item[-1]) for item in items]
+    known = [(f, history[item[-1]]) for f, item in zip(features, items) if item[-1] in history]
+    model = CostModel(history=history)
+    if known:
+        model.fit([f for f, _ in known], [cost for _, cost in known])
+    return model, features
+
+
+def schedule(items, num_workers, history=None):
+    """
+    Split ``items`` across ``num_workers`` workers by longest-processing-time-first
+    bin packing, so every worker ends up with a similar estimated total cost.
+    Each worker's list is ordered heaviest first. Returns one list per worker.
+    """
+    model, features = build_cost_model(items, history or {})
+    costs = [model.estimate(f, item[-1]) for f, item in zip(features, items)]
+    order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+
+    bins = [[] for _ in range(num_workers)]
+    loads = [(0.0, worker) for worker in range(num_workers)]
+    heapq.heapify(loads)
+    for i in order:
+        load, worker = heapq.heappop(loads)
+        bins[worker].append(items[i])
+        heapq.heappush(loads, (load + costs[i], worker))
+    logging.info("Estimated worker loads: " + ", ".join(f"{load:.1f}" for load, _ in sorted(loads, key=lambda x: x[1])))
+    return bins
+
+
+def shared_schedule(items, num_workers, assignment_path, history=None):
+    """
+    ``schedule`` computed once and shared by every worker through
+    ``assignment_path``: the first worker to get there publishes its partition
+    (by image path) and every worker, itself included, reads the published one.
+    Workers that start later, with other cost history at hand, therefore still
+    split the images the same way. Delete the file to re-plan.
+    """
+    if not os.path.exists(assignment_path):
+        bins = schedule(items, num_workers, history)
+        directory = os.path.dirname(assignment_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{assignment_path}.tmp-{uuid.uuid4().hex}"
+        with open(temp_path, 'w') as f:
+            json.dump({'num_workers': num_workers, 'workers': [[item[-1] for item in bin] for bin in bins]}, f)
+        try:
+            # link fails if the file exists, so exactly one worker's partition is published
+            os.link(temp_path, assignment_path)
+            logging.info(f"Wrote the assignment of {len(items)} images to {num_workers} workers to {assignment_path}")
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+
+    with open(assignment_path, 'r') as f:
+        assignment = json.load(f)
+    if assignment['num_workers'] != num_workers:
+        raise ValueError(f"{assignment_path} assigns the images to {assignment['num_workers']} workers, not "
+                         f"{num_workers}; delete it to re-plan")
+    by_key = {item[-1]: item for item in items}
+    assigned = {key for keys in assignment['workers'] for key in keys}
+    if assigned != set(by_key):
+        logging.warning(f"{assignment_path} assigns {len(assigned)} images, this worker was given {len(by_key)}; "
+                        f"{len(set(by_key) - assigned)} of them are in no worker's share")
+    return [[by_key[key] for key in keys if key in by_key] for keys in assignment['workers']]
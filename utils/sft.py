@@ -0,0 +1,51 @@
+DEFAULT_TEMPLATE = "{trajectory}<'causal pairs'>\n{causal_pairs}\n</causal pairs>"
+
+
+def f1_score(precision, recall):
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def select_source(record, rule='recall', min_score=0.0):
+    """
+    Which trajectory of a raw search record becomes the SFT sample: 'vanilla',
+    'mcts' or None to drop the image.
+
+    'recall' is the original rule: keep the image if either recall is non-zero
+    and prefer the vanilla answer when its recall is at least the search's.
+    'f1' does the same on F1. 'mcts' always takes the search trajectory.
+    Images whose chosen score is below ``min_score`` are dropped.
+    """
+    if rule == 'recall':
+        score, vanilla_score = record['recall'], record['vanilla_recall']
+    elif rule == 'f1':
+        score = f1_score(record['precision'], record['recall'])
+        vanilla_score = f1_score(record['vanilla_precision'], record['vanilla_recall'])
+    elif rule == 'mcts':
+        return 'mcts' if record['recall'] > 0 and record['recall'] >= min_score else None
+    else:
+        raise ValueError(f"Unknown SFT selection rule: {rule}")
+
+    if score == 0 and vanilla_score == 0:
+        return None
+    if vanilla_score >= score:
+        return 'vanilla' if vanilla_score >= min_score else None
+    return 'mcts' if score >= min_score else None
+
+
+def format_trajectory(record, source, template=DEFAULT_TEMPLATE):
+    if source == 'vanilla':
+        return record['vanilla_result']
+    return template.format(trajectory=record['trajectory'], causal_pairs=str(record['causal_pairs']))
+
+
+def build_sft_record(record, rule='recall', min_score=0.0, template=DEFAULT_TEMPLATE):
+    """(SFT record or None, source) for one raw search record."""
+    source = select_source(record, rule, min_score)
+    if source is None:
+        return None, None
+    sft = {
+        "image_id": record['image_id'],
+        "image_path": record['image_path'],
+        "trajectory": format_trajectory(record, source, template)
+    }
+    return sft, source
@@ -0,0 +1,80 @@
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Speculator:
+    """
+    Runs the model calls of the nodes a search is likely to expand next in the
+    background, while the search itself waits on its current rollout.
+
+    ``speculate`` is given the predicted frontier (best first) and keeps up to
+    ``k`` calls in flight for it; ``take`` hands a node's query and results to
+    ``step`` when selection reaches that node. Calls whose node drops out of the
+    predicted frontier, or is never reached before the search ends, are wasted;
+    once ``max_wasted`` calls have been (or could still be) wasted, no new ones
+    are started. The calls' tokens count towards the task's usage either way.
+    """
+
+    def __init__(self, task, k=2, max_wasted=8):
+        self.task = task
+        self.k = k
+        self.max_wasted = max_wasted
+        self._executor = ThreadPoolExecutor(max_workers=k, thread_name_prefix="speculate")
+        # id(node) -> (node, query, future)
+        self._pending = {}
+        self.stats = {'submitted': 0, 'hits': 0, 'wasted': 0, 'failed': 0}
+
+    def speculate(self, frontier):
+        frontier_ids = {id(node) for node in frontier}
+        for key in [key for key in self._pending if key not in frontier_ids]:
+            self._waste(self._pending.pop(key))
+
+        if self.task.budget_exhausted() is not None:
+            return
+        for node in frontier:
+            if len(self._pending) >= self.k or self.stats['wasted'] + len(self._pending) >= self.max_wasted:
+                break
+            if id(node) in self._pending or node.is_terminal:
+                continue
+            query = self.task.prepare_query(node)
+            if query is None:
+                continue
+            action, image_url, prompt, _ = query
+            # Keep the caller's log context (image id) in the worker thread
+            future = self._executor.submit(contextvars.copy_context().run, self.task.generate, image_url, prompt, action)
+            self._pending[id(node)] = (node, query, future)
+            self.stats['submitted'] += 1
+
+    def take(self, node):
+        """(query, results) of a speculative call for ``node``, or None. Results are None if the call failed."""
+        entry = self._pending.pop(id(node), None)
+        if entry is None or entry[0] is not node:
+            return None
+        _, query, future = entry
+        results = future.result()
+        if results is None:
+            self.stats['failed'] += 1
+        else:
+            self.stats['hits'] += 1
+        return query, results
+
+    def _waste(self, entry):
+        entry[2].cancel()
+        self.stats['wasted'] += 1
+
+    def finish(self):
+        """
+        Drop the calls that were never used and return the stats, including the
+        hit rate. Calls already running are waited for, so the task's usage is
+        complete once this returns.
+        """
+        for entry in self._pending.values():
+            self._waste(entry)
+        self._pending.clear()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        stats = dict(self.stats)
+        stats['hit_rate'] = stats['hits'] / stats['submitted'] if stats['submitted'] else 0.0
+        return stats
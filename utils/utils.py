@@ -4,9 +4,13 @@ from PIL import Image
 import ast
 
 import numpy as np
-from scipy.optimize import linear_sum_assignment
 import logging
 
+from .image_cache import resize_to_budget, save_image
+from .matching import assign
+
+logger = logging.getLogger(__name__)
+
 def extract_content(mark,text):
     # 提取 <mark></mark> 中间的内容
     pattern = f'<{mark}>(.*?)</{mark}>'
@@ -20,18 +24,8 @@ def extract_content(mark,text):
     
 
 
-def zoom_in(image_path: str, bbox: str, output_path: str):
-    """
-    根据 bounding box 裁剪图像
-    
-    Args:
-        image_path (str): 输入图像路径
-        bbox (list or str): [x1, y1, x2, y2] 格式的边界框坐标
-        output_path (str, optional): 输出图像路径，如果为 None 则不保存
-    
-    Returns:
-        dict: 裁剪区域信息，用于后续坐标还原
-    """
+def parse_bbox(bbox):
+    """将字符串或列表形式的 bbox 解析为 [x1, y1, x2, y2] 浮点数列表"""
     if isinstance(bbox, str):
         try:
             bbox = ast.literal_eval(bbox)
@@ -45,10 +39,103 @@ def zoom_in(image_path: str, bbox: str, output_path: str):
         raise ValueError(f"bbox 必须是包含4个数字的列表或元组: {bbox}")
     
     try:
-        x1, y1, x2, y2 = map(float, bbox)
+        return [float(x) for x in bbox]
     except (ValueError, TypeError) as e:
         raise ValueError(f"bbox 坐标必须是数字: {bbox}") from e
 
+
+def scale_bbox(bbox, from_size, to_size):
+    """把 bbox 从尺寸为 from_size 的图像坐标缩放到尺寸为 to_size 的图像坐标"""
+    x1, y1, x2, y2 = parse_bbox(bbox)
+    sx = to_size[0] / from_size[0]
+    sy = to_size[1] / from_size[1]
+    return [x1 * sx, y1 * sy, x2 * sx, y2 * sy]
+
+
+def model_bbox_to_original(bbox, transform):
+    """
+    Map a bbox the model produced on a resized image back to original-image
+    coordinates, using the transform returned by ``ImageCache.prepare``.
+    A ``None`` transform means the model saw the original image.
+    """
+    if transform is None or transform['model_size'] == transform['original_size']:
+        return bbox
+    return scale_bbox(bbox, transform['model_size'], transform['original_size'])
+
+
+def original_bbox_to_model(bbox, transform):
+    """Inverse of ``model_bbox_to_original``."""
+    if transform is None or transform['model_size'] == transform['original_size']:
+        return bbox
+    return scale_bbox(bbox, transform['original_size'], transform['model_size'])
+
+
+def map_pair_bboxes(pairs, bbox_fn, transform):
+    """Apply ``bbox_fn(bbox, transform)`` to every bbox of a list of {entity: bbox} pairs."""
+    if transform is None:
+        return pairs
+    mapped = []
+    for pair in pairs:
+        try:
+            mapped.append({key: bbox_fn(value, transform) for key, value in pair.items()})
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning(f"Skipping malformed pair {pair}: {str(e)}")
+    return mapped
+
+
+def map_bbox_text(bbox, bbox_fn, transform):
+    """
+    ``bbox_fn`` applied to a bbox as the model writes it (e.g. "[10, 20, 30, 40]"),
+    written back in the same form with whole-pixel coordinates. Unparsable text
+    is returned unchanged.
+    """
+    if transform is None or transform['model_size'] == transform['original_size']:
+        return bbox
+    try:
+        return str([round(value) for value in bbox_fn(bbox, transform)])
+    except ValueError as e:
+        logger.warning(f"Keeping unparsable bbox {bbox!r}: {str(e)}")
+        return bbox
+
+
+def map_tagged_pairs(text, mark, bbox_fn, transform):
+    """
+    ``text`` with the pair list inside its first ``<mark>...</mark>`` mapped by
+    ``map_pair_bboxes``, e.g. to move a model answer to original-image coordinates.
+    """
+    if transform is None or transform['model_size'] == transform['original_size']:
+        return text
+    content = extract_content(mark, text)
+    if content is None:
+        return text
+    try:
+        pairs = ast.literal_eval(content)
+    except (ValueError, SyntaxError):
+        try:
+            pairs = json.loads(content)
+        except json.JSONDecodeError:
+            return text
+    start = text.index(f'<{mark}>') + len(f'<{mark}>')
+    end = text.index(f'</{mark}>', start)
+    return f"{text[:start]}{map_pair_bboxes(pairs, bbox_fn, transform)}{text[end:]}"
+
+
+def zoom_in(image_path: str, bbox: str, output_path: str, max_pixels=None, jpeg_quality=None):
+    """
+    根据 bounding box 裁剪图像
+    
+    Args:
+        image_path (str): 输入图像路径
+        bbox (list or str): [x1, y1, x2, y2] 格式的边界框坐标
+        output_path (str, optional): 输出图像路径，如果为 None 则不保存
+        max_pixels (int, optional): 保存前把裁剪图缩放到该像素预算以内
+        jpeg_quality (int, optional): 保存 JPEG 时使用的质量
+    
+    Returns:
+        dict: 裁剪区域信息，用于后续坐标还原
+    """
+    x1, y1, x2, y2 = parse_bbox(bbox)
+
     image = Image.open(image_path)
     
     width, height = image.size
@@ -61,11 +148,12 @@ def zoom_in(image_path: str, bbox: str, output_path: str):
         raise ValueError(f"无效的 bbox 坐标: {bbox}")
     
     cropped_image = image.crop((x1, y1, x2, y2))
+    model_image = resize_to_budget(cropped_image, max_pixels)
     
     if output_path:
         try:
-            cropped_image.save(output_path)
-            print(f"裁剪后的图像已保存到: {output_path}")
+            save_image(model_image, output_path, jpeg_quality)
+            logger.debug(f"裁剪后的图像已保存到: {output_path}")
         except Exception as e:
             raise IOError(f"保存裁剪后的图像失败: {str(e)}") from e
     
@@ -74,6 +162,9 @@ def zoom_in(image_path: str, bbox: str, output_path: str):
         'original_size': [width, height],
         'cropped_size': [x2-x1, y2-y1]
     }
+    if model_image is not cropped_image:
+        # 裁剪图被缩放后才发送给模型，模型给出的坐标需先缩放回裁剪图尺寸
+        crop_info['model_size'] = list(model_image.size)
     
     return crop_info
 
@@ -93,6 +184,10 @@ def restore_bbox(cropped_bbox, crop_info):
     # 如果是字符串，先解析为列表
     if isinstance(cropped_bbox, str):
         cropped_bbox = ast.literal_eval(cropped_bbox)
+
+    # 模型看到的是缩放后的裁剪图，先把坐标缩放回裁剪图尺寸
+    if 'model_size' in crop_info:
+        cropped_bbox = scale_bbox(cropped_bbox, crop_info['model_size'], crop_info['cropped_size'])
     
     # 获取原始裁剪区域的偏移量
     crop_x1, crop_y1, crop_x2, crop_y2 = crop_info['crop_bbox']
@@ -236,7 +331,7 @@ def calculate_giou(box1, box2):
     giou = iou - ((convex_area - union) / convex_area)
     return giou
 
-def match_detections_to_gt(detections, gt_boxes, giou_threshold=0.5):
+def match_detections_to_gt(detections, gt_boxes, giou_threshold=0.5, engine='auto'):
     """
     Match detected objects to GT using Hungarian algorithm with GIoU
     
@@ -244,6 +339,8 @@ def match_detections_to_gt(detections, gt_boxes, giou_threshold=0.5):
         detections: List of {'label': [x1,y1,x2,y2]} dicts
         gt_boxes: List of {'label': [x1,y1,x2,y2]} dicts
         giou_threshold: Minimum GIoU for valid matches
+        engine: 'dense', 'sparse' (skips the assignment when no pair can reach the
+            threshold) or 'auto', see utils.matching.assign. Both engines give the same matches.
         
     Returns:
         List of tuples (detection, matched_gt, giou_score) for valid matches
@@ -256,48 +353,20 @@ def match_detections_to_gt(detections, gt_boxes, giou_threshold=0.5):
     if not det_list or not gt_list:
         return [], 0, 0, 0
     
-    # Cost matrix (1 - GIoU)
-    cost_matrix = np.zeros((len(det_list), len(gt_list)))
-    for i, (_, d_box) in enumerate(det_list):
-        try:
-            d_box = [float(x) for x in d_box]
-        except (ValueError, TypeError) as e:
-            logging.error(f"Invalid detection box coordinates: {d_box}")
-            continue
-            
-        for j, (_, gt_box) in enumerate(gt_list):
-            try:
-                gt_box = [float(x) for x in gt_box]
-            except (ValueError, TypeError) as e:
-                logging.error(f"Invalid ground truth box coordinates: {gt_box}")
-                continue
-                
-            try:
-                giou = calculate_giou(d_box, gt_box)
-                cost_matrix[i,j] = 1 - giou  # Convert to cost
-            except Exception as e:
-                logging.error(f"Error calculating GIoU for boxes {d_box} and {gt_box}: {str(e)}")
-                cost_matrix[i,j] = 1  # Set maximum cost for invalid pairs
-            
-    # Hungarian algorithm for optimal assignment
-    row_ind, col_ind = linear_sum_assignment(cost_matrix)
+    # Hungarian algorithm over the (1 - GIoU) cost of every pair, filtered by the threshold
+    assignment = assign([box for _, box in det_list], [box for _, box in gt_list],
+                        giou_threshold=giou_threshold, engine=engine)
     
-    # Filter matches by GIoU threshold
     matches = []
-    for i, j in zip(row_ind, col_ind):
-        giou = 1 - cost_matrix[i,j]
-        if giou >= giou_threshold:
-            matches.append({
-                'detection': det_list[i],
-                'matched_gt': gt_list[j],
-                'giou': giou
-            })
+    for i, j, giou in assignment:
+        matches.append({
+            'detection': det_list[i],
+            'matched_gt': gt_list[j],
+            'giou': giou
+        })
 
     detection_P = len(matches) / len(det_list)
     detection_R = len(matches) / len(gt_list)
     mean_giou = np.mean([match['giou'] for match in matches])
     
     return matches, detection_P, detection_R, mean_giou
-
-
-        
\ No newline at end of file
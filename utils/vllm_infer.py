@@ -1,29 +1,346 @@
 import base64
+import contextvars
+import hashlib
+import os
 import random
+import threading
 import time
 import logging
-from typing import List, Optional
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-import requests
-from openai import OpenAI
-from openai import APIConnectionError, APIError, InternalServerError
-from openai.pagination import SyncPage
-from openai.types.model import Model
+from .call_ledger import CallLedger
 
-openai_api_key = "EMPTY"
-openai_api_base = "http://localhost:8000/v1"
+# openai and requests take most of a second to import, so they are imported
+# where they are first needed and importing this module stays cheap.
+if TYPE_CHECKING:
+    from openai import OpenAI
+    from openai.pagination import SyncPage
+    from openai.types.model import Model
+
+logger = logging.getLogger(__name__)
 
-client = OpenAI(
-    api_key=openai_api_key,
-    base_url=openai_api_base,
-)
+openai_api_key = "EMPTY"
+# Comma separated list of vLLM replicas, e.g.
+# VLLM_API_BASES=http://localhost:8000/v1,http://localhost:8001/v1
+openai_api_bases = [
+    base.strip()
+    for base in os.environ.get("VLLM_API_BASES", "http://localhost:8000/v1").split(",")
+    if base.strip()
+]
+openai_api_base = openai_api_bases[0]
 
 MAX_RETRIES = 3
 INITIAL_RETRY_DELAY = 1
 MAX_RETRY_DELAY = 15
 
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 5
+# A sticky replica may carry this many more in-flight requests than the least
+# loaded one before requests for its images spill over to other replicas.
+STICKY_SLACK = 2
+
+# Per-attempt request timeout in seconds; a hung request is abandoned and retried.
+REQUEST_TIMEOUT = float(os.environ.get("VLLM_REQUEST_TIMEOUT", 300))
+# Send a duplicate request to another replica once a call has been running longer
+# than this percentile of recent latencies for the same action (0 disables hedging).
+HEDGE_PERCENTILE = float(os.environ.get("VLLM_HEDGE_PERCENTILE", 0))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+
+# Consecutive failures after which an endpoint's circuit opens, and how long it
+# stays open before a single probe request is let through.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# Stream completions so the ledger can record the time to first token.
+STREAM_COMPLETIONS = os.environ.get("VLLM_STREAM", "0") == "1"
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after ``failure_threshold`` consecutive failures. While open,
+    calls fail fast; after ``reset_timeout`` one probe is let through (half-open)
+    and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """Whether a call could be let through now, without claiming the probe."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return time.time() - self.opened_at >= self.reset_timeout
+            return False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(f"Circuit opened after {self.failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.time()
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies, kept per action."""
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, action: Optional[str], latency: float):
+        with self._lock:
+            self._latencies[action].append(latency)
+
+    def percentile(self, action: Optional[str], q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies[action])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * q / 100))
+        return samples[index]
+
+
+class Endpoint:
+    """One vLLM replica plus its routing state and counters."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+        self.model = None
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_error = None
+
+    @property
+    def client(self) -> "OpenAI":
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    # Retries are handled in run_single_image, so the SDK's own are disabled.
+                    self._client = OpenAI(api_key=openai_api_key, base_url=self.base_url,
+                                          timeout=REQUEST_TIMEOUT, max_retries=0)
+        return self._client
+
+    def stats(self) -> Dict:
+        completed = self.requests - self.outstanding
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "circuit": self.breaker.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "mean_latency": self.total_latency / completed if completed > 0 else 0.0,
+            "max_latency": self.max_latency,
+            "last_error": self.last_error,
+        }
+
+
+class EndpointPool:
+    """
+    Least-outstanding-requests router over several vLLM replicas.
+
+    Requests carrying the same sticky key (the image being searched) prefer the
+    same replica, chosen by rendezvous hashing over the healthy replicas, so its
+    prefix and multimodal caches stay warm. A background thread periodically
+    probes every replica, ejecting the ones that fail and re-admitting the ones
+    that recover.
+    """
+
+    def __init__(self, base_urls: List[str], health_check_interval: float = HEALTH_CHECK_INTERVAL,
+                 sticky_slack: int = STICKY_SLACK):
+        if not base_urls:
+            raise ValueError("At least one vLLM endpoint is required")
+        self.endpoints = [Endpoint(url) for url in base_urls]
+        self.health_check_interval = health_check_interval
+        self.sticky_slack = sticky_slack
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def _sticky_endpoint(self, sticky_key: str, candidates: List[Endpoint]) -> Endpoint:
+        def weight(endpoint):
+            digest = hashlib.md5(f"{endpoint.base_url}|{sticky_key}".encode("utf-8")).digest()
+            return int.from_bytes(digest[:8], "big")
+        return max(candidates, key=weight)
+
+    def acquire(self, sticky_key: Optional[str] = None, exclude: Optional[Endpoint] = None) -> Endpoint:
+        """Pick a replica for one request and count it as outstanding."""
+        self.start_health_checks()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.breaker.available()]
+            if not candidates:
+                raise CircuitOpenError("Circuit is open for every vLLM endpoint")
+            if exclude is not None and len(candidates) > 1:
+                candidates = [endpoint for endpoint in candidates if endpoint is not exclude]
+            if any(endpoint.healthy for endpoint in candidates):
+                candidates = [endpoint for endpoint in candidates if endpoint.healthy]
+            least = min(endpoint.outstanding for endpoint in candidates)
+            chosen = None
+            if sticky_key is not None:
+                preferred = self._sticky_endpoint(sticky_key, candidates)
+                if preferred.outstanding <= least + self.sticky_slack:
+                    chosen = preferred
+            if chosen is None:
+                chosen = random.choice([endpoint for endpoint in candidates if endpoint.outstanding == least])
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen
+
+    def release(self, endpoint: Endpoint, latency: float, error: Optional[Exception] = None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.total_latency += latency
+            endpoint.max_latency = max(endpoint.max_latency, latency)
+            if error is not None:
+                endpoint.errors += 1
+                endpoint.last_error = str(error)
+                from openai import APIConnectionError
+                unreachable = isinstance(error, APIConnectionError) or isinstance(error.__cause__, APIConnectionError)
+                if unreachable and len(self.endpoints) > 1:
+                    # The replica is unreachable; the health checker re-admits it once it answers again.
+                    endpoint.healthy = False
+
+    def get_model(self, endpoint: Endpoint) -> str:
+        if endpoint.model is None:
+            endpoint.model = get_first_model(endpoint.client)
+        return endpoint.model
+
+    def check_health(self):
+        """Probe every replica once, ejecting or re-admitting it."""
+        for endpoint in self.endpoints:
+            try:
+                models = endpoint.client.with_options(timeout=HEALTH_CHECK_TIMEOUT, max_retries=0).models.list()
+                healthy = len(models.data) > 0
+                if healthy:
+                    endpoint.model = models.data[0].id
+            except Exception as e:
+                healthy = False
+                endpoint.last_error = str(e)
+            if healthy != endpoint.healthy:
+                if healthy:
+                    logger.info(f"vLLM endpoint {endpoint.base_url} is healthy again, re-admitting it")
+                else:
+                    logger.warning(f"vLLM endpoint {endpoint.base_url} failed its health check, ejecting it")
+            endpoint.healthy = healthy
+
+    def start_health_checks(self):
+        if self._health_thread is not None or len(self.endpoints) < 2:
+            return
+        with self._lock:
+            if self._health_thread is not None:
+                return
+
+            def run():
+                while not self._stop.wait(self.health_check_interval):
+                    self.check_health()
+
+            self._health_thread = threading.Thread(target=run, daemon=True)
+            self._health_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+
+latency_tracker = LatencyTracker()
+# Per-request record of tokens, latency and retries, see get_call_summary
+ledger = CallLedger()
+_pool = None
+_pool_lock = threading.Lock()
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def get_pool() -> EndpointPool:
+    """The process-wide pool over ``VLLM_API_BASES``, created on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = EndpointPool(openai_api_bases)
+    return _pool
+
+
+def get_client() -> "OpenAI":
+    """Client of the first replica, for callers that do not go through the pool."""
+    return get_pool().endpoints[0].client
+
+
+def __getattr__(name):
+    # ``pool`` and ``client`` used to be built at import time; keep them reachable
+    if name == "pool":
+        return get_pool()
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+        return _hedge_executor
+
+
+def get_call_summary() -> Dict:
+    """Per-action request, token, retry, finish reason and latency aggregates of this process."""
+    return ledger.summary()
+
+
+def get_endpoint_stats() -> List[Dict]:
+    """Per-replica request, error and latency counters."""
+    return get_pool().stats()
+
 def encode_base64_content_from_url(content_url: str) -> str:
     """Encode a content retrieved from a remote url to base64 format."""
+    import requests
     try:
         with requests.get(content_url) as response:
             response.raise_for_status()
@@ -32,10 +349,11 @@ def encode_base64_content_from_url(content_url: str) -> str:
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"Failed to fetch content from URL {content_url}: {str(e)}") from e
 
-def get_first_model(client: OpenAI) -> str:
+def get_first_model(client: "OpenAI") -> str:
     """
     Get the first model from the vLLM server.
     """
+    from openai import APIConnectionError
     for attempt in range(MAX_RETRIES):
         try:
             models: SyncPage[Model] = client.models.list()
@@ -52,7 +370,7 @@ def get_first_model(client: OpenAI) -> str:
                     "3. the API key is correct"
                 ) from e
             delay = min(INITIAL_RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
-            logging.warning(f"Failed to get models, retrying in {delay} seconds...")
+            logger.warning(f"Failed to get models, retrying in {delay} seconds...")
             time.sleep(delay)
 
         except Exception as e:
@@ -60,55 +378,261 @@ def get_first_model(client: OpenAI) -> str:
 
     raise RuntimeError("Failed to get models after all retry attempts") 
 
-def run_single_image(image_url: str, model: str, prompt: str, num_completions: int = 1) -> List[str]:
-    """Run inference on a single image with retries."""
-    for attempt in range(MAX_RETRIES):
-        try:
-            chat_completion = client.chat.completions.create(
-                messages=[
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline exceeded before the request could complete")
+    return remaining
+
+
+def _is_server_failure(error: Exception) -> bool:
+    """Failures that say the server is down or overloaded, as opposed to a bad request."""
+    from openai import APIConnectionError, InternalServerError
+    if isinstance(error, (APIConnectionError, InternalServerError)):
+        return True
+    return getattr(error, "status_code", None) is not None and error.status_code >= 500
+
+
+def new_usage() -> Dict:
+    """Counter of model calls and tokens, filled in by ``generate(usage=...)``."""
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+_usage_lock = threading.Lock()
+
+
+def add_usage(usage: Dict, completion_usage) -> None:
+    with _usage_lock:
+        usage["calls"] += 1
+        if completion_usage is not None:
+            usage["prompt_tokens"] += completion_usage.prompt_tokens or 0
+            usage["completion_tokens"] += completion_usage.completion_tokens or 0
+            usage["total_tokens"] += completion_usage.total_tokens or 0
+
+
+def _stream_completion(client: "OpenAI", **kwargs):
+    """
+    Streamed chat completion: (texts, usage, finish reasons, time to first token).
+    """
+    start_time = time.time()
+    ttft = None
+    texts, finish_reasons = {}, {}
+    usage = None
+    stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        for choice in chunk.choices:
+            if choice.delta is not None and choice.delta.content:
+                if ttft is None:
+                    ttft = time.time() - start_time
+                texts[choice.index] = texts.get(choice.index, "") + choice.delta.content
+            if choice.finish_reason is not None:
+                finish_reasons[choice.index] = choice.finish_reason
+    indices = sorted(set(texts) | set(finish_reasons))
+    return [texts.get(i, "") for i in indices], usage, [finish_reasons.get(i) for i in indices], ttft
+
+
+def _record_call(action, endpoint_url, start_time, attempt, completion_usage=None, finish_reasons=(), ttft=None,
+                 error=None):
+    prompt_tokens = completion_tokens = cached_tokens = 0
+    if completion_usage is not None:
+        prompt_tokens = completion_usage.prompt_tokens or 0
+        completion_tokens = completion_usage.completion_tokens or 0
+        details = getattr(completion_usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+    ledger.record(action, endpoint_url, time.time() - start_time, retries=attempt, prompt_tokens=prompt_tokens,
+                  completion_tokens=completion_tokens, cached_tokens=cached_tokens, ttft=ttft,
+                  finish_reasons=finish_reasons, error=error)
+
+
+def build_chat_request(image_url: str, model: str, prompt: str, num_completions: int = 1,
+                       temperature: float = 0.0) -> Dict:
+    """Body of the chat completion request for one image, as sent by ``run_single_image`` and batch files."""
+    return dict(
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
                     {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": image_url},
-                            },
-                        ],
-                    }
+                        "type": "image_url",
+                        "image_url": {"url": image_url},
+                    },
                 ],
-                model=model,
-                max_completion_tokens=4096,
-                temperature=0.0,
-                n=num_completions,
-            )
-            results = []
-            for choice in chat_completion.choices:
-                if choice.message.content is not None:
-                    results.append(choice.message.content)
-                else:
-                    results.append("")
+            }
+        ],
+        model=model,
+        max_completion_tokens=4096,
+        temperature=temperature,
+        n=num_completions,
+    )
+
+
+def run_single_image(image_url: str, model: str, prompt: str, num_completions: int = 1,
+                     client: Optional["OpenAI"] = None, timeout: Optional[float] = None,
+                     deadline: Optional[float] = None, breaker: Optional[CircuitBreaker] = None,
+                     usage: Optional[Dict] = None, action: Optional[str] = None,
+                     temperature: float = 0.0) -> List[str]:
+    """
+    Run inference on a single image with retries.
+
+    ``timeout`` bounds each attempt and ``deadline`` (an absolute ``time.time()``)
+    bounds the whole call including backoff. When ``breaker`` opens, the remaining
+    retries are abandoned instead of sleeping through their backoff. Token counts
+    of the response are added to ``usage`` when given. Every call is recorded in
+    ``ledger`` under ``action``; with STREAM_COMPLETIONS the time to first token is too.
+    """
+    from openai import APIError, InternalServerError
+    if client is None:
+        client = get_client()
+    endpoint_url = str(client.base_url)
+    start_time = time.time()
+    for attempt in range(MAX_RETRIES):
+        if breaker is not None and not breaker.allow():
+            error = CircuitOpenError("Circuit is open, not sending the request")
+            _record_call(action, endpoint_url, start_time, attempt, error=error)
+            raise error
+        attempt_timeout = timeout if timeout is not None else REQUEST_TIMEOUT
+        remaining = _remaining(deadline)
+        if remaining is not None:
+            attempt_timeout = min(attempt_timeout, remaining)
+        try:
+            request = dict(build_chat_request(image_url, model, prompt, num_completions, temperature),
+                           timeout=attempt_timeout)
+            ttft = None
+            if STREAM_COMPLETIONS:
+                results, completion_usage, finish_reasons, ttft = _stream_completion(client, **request)
+            else:
+                chat_completion = client.chat.completions.create(**request)
+                completion_usage = chat_completion.usage
+                results, finish_reasons = [], []
+                for choice in chat_completion.choices:
+                    if choice.message.content is not None:
+                        results.append(choice.message.content)
+                    else:
+                        results.append("")
+                    finish_reasons.append(choice.finish_reason)
+            if breaker is not None:
+                breaker.record_success()
+            if usage is not None:
+                add_usage(usage, completion_usage)
+            _record_call(action, endpoint_url, start_time, attempt, completion_usage, finish_reasons, ttft)
             return results
         except (APIError, InternalServerError) as e:
+            if breaker is not None and _is_server_failure(e):
+                breaker.record_failure()
             if attempt == MAX_RETRIES - 1:
-                logging.error(f"Failed to run inference after {MAX_RETRIES} attempts: {str(e)}")
+                _record_call(action, endpoint_url, start_time, attempt, error=e)
+                logger.error(f"Failed to run inference after {MAX_RETRIES} attempts: {str(e)}")
                 raise RuntimeError(f"Failed to run inference after {MAX_RETRIES} attempts: {str(e)}") from e
+            if breaker is not None and not breaker.available():
+                _record_call(action, endpoint_url, start_time, attempt, error=e)
+                raise CircuitOpenError(f"Circuit opened, giving up after {attempt + 1} attempts: {str(e)}") from e
             delay = min(INITIAL_RETRY_DELAY * (2 ** attempt), MAX_RETRY_DELAY)
-            logging.warning(f"API error occurred, retrying in {delay} seconds...")
+            remaining = _remaining(deadline)
+            if remaining is not None and remaining <= delay:
+                _record_call(action, endpoint_url, start_time, attempt, error=e)
+                raise DeadlineExceeded(f"Deadline leaves no time to retry after: {str(e)}") from e
+            logger.warning(f"API error occurred, retrying in {delay} seconds...")
             time.sleep(delay)
         except Exception as e:
-            logging.error(f"Unexpected error during inference: {str(e)}")
+            _record_call(action, endpoint_url, start_time, attempt, error=e)
+            logger.error(f"Unexpected error during inference: {str(e)}")
             raise RuntimeError(f"Unexpected error during inference: {str(e)}") from e
 
     raise RuntimeError("Failed to run inference after all retry attempts")
 
-def generate(image_url: str, prompt: str, num_completions: int = 1) -> Optional[List[str]]:
-    """Generate completions with error handling."""
+
+def _call_endpoint(endpoint: Endpoint, image_url: str, prompt: str, num_completions: int,
+                   action: Optional[str], timeout: Optional[float], deadline: Optional[float],
+                   usage: Optional[Dict] = None, temperature: float = 0.0) -> List[str]:
+    """Run one request on an already acquired endpoint and release it afterwards."""
+    start_time = time.time()
+    error = None
+    try:
+        try:
+            model = get_pool().get_model(endpoint)
+        except Exception:
+            endpoint.breaker.record_failure()
+            raise
+        results = run_single_image(image_url, model, prompt, num_completions, client=endpoint.client,
+                                   timeout=timeout, deadline=deadline, breaker=endpoint.breaker, usage=usage,
+                                   action=action, temperature=temperature)
+        latency_tracker.record(action, time.time() - start_time)
+        return results
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        get_pool().release(endpoint, time.time() - start_time, error)
+
+
+def _hedged_call(endpoint: Endpoint, hedge_after: float, image_url: str, prompt: str, num_completions: int,
+                 action: Optional[str], timeout: Optional[float], deadline: Optional[float],
+                 usage: Optional[Dict] = None, temperature: float = 0.0) -> List[str]:
+    """
+    Start the request on ``endpoint``; if it is still running after ``hedge_after``
+    seconds, send a duplicate to another replica and return whichever succeeds first.
+    The slower request is left to finish in the background and its result dropped.
+    """
+    executor = _get_hedge_executor()
+    args = (image_url, prompt, num_completions, action, timeout, deadline, usage, temperature)
+    # Copy the caller's context so the attempts' log records keep its image tag
+    pending = {executor.submit(contextvars.copy_context().run, _call_endpoint, endpoint, *args)}
+    done, pending = wait(pending, timeout=hedge_after)
+    if not done:
+        try:
+            hedge_endpoint = get_pool().acquire(exclude=endpoint)
+            pending.add(executor.submit(contextvars.copy_context().run, _call_endpoint, hedge_endpoint, *args))
+            logger.info(f"Hedging {action} request after {hedge_after:.1f}s on {hedge_endpoint.base_url}")
+        except CircuitOpenError:
+            pass
+    last_error = None
+    while True:
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            last_error = future.exception()
+        if not pending:
+            raise last_error
+        done, pending = wait(pending, timeout=_remaining(deadline), return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded("Deadline exceeded while waiting for a hedged request")
+
+
+def generate(image_url: str, prompt: str, num_completions: int = 1,
+             sticky_key: Optional[str] = None, action: Optional[str] = None,
+             timeout: Optional[float] = None, deadline: Optional[float] = None,
+             usage: Optional[Dict] = None, temperature: float = 0.0) -> Optional[List[str]]:
+    """
+    Generate completions with error handling.
+
+    The request is routed to one of the configured replicas; requests sharing a
+    ``sticky_key`` (defaults to the image url) prefer the same replica. ``timeout``
+    bounds each attempt and ``deadline`` is an absolute ``time.time()`` by which
+    the call must finish. When HEDGE_PERCENTILE is set, a call slower than that
+    percentile of recent ``action`` latencies is duplicated on another replica.
+    Calls and token counts are accumulated into ``usage`` (see ``new_usage``).
+    Completions are greedy unless a sampling ``temperature`` is given.
+    Returns None on failure, including an expired deadline or an open circuit.
+    """
     try:
-        model = get_first_model(client)
-        return run_single_image(image_url, model, prompt, num_completions)
+        _remaining(deadline)
+        pool = get_pool()
+        endpoint = pool.acquire(sticky_key if sticky_key is not None else image_url)
+        hedge_after = None
+        if HEDGE_PERCENTILE > 0 and len(pool.endpoints) > 1:
+            hedge_after = latency_tracker.percentile(action, HEDGE_PERCENTILE)
+        if hedge_after is None:
+            return _call_endpoint(endpoint, image_url, prompt, num_completions, action, timeout, deadline, usage,
+                                  temperature)
+        return _hedged_call(endpoint, hedge_after, image_url, prompt, num_completions, action, timeout, deadline,
+                            usage, temperature)
     except Exception as e:
-        logging.error(f"Failed to generate completions: {str(e)}")
+        logger.error(f"Failed to generate completions: {str(e)}")
         return None
 
 if __name__ == "__main__":
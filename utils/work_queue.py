@@ -0,0 +1,314 @@
+"""
+Coordinator-free work queue on a shared filesystem.
+
+    <queue dir>/plan.json              batches of image ids, written once by the first worker
+    <queue dir>/leases/<batch>.lease   {worker, expires} of the worker processing a batch
+    <queue dir>/results/<batch>/       the batch's committed outputs; its existence marks the batch done
+
+Workers lease a batch by creating its lease file exclusively and renew it
+while they work. A lease whose expiry has passed (its worker crashed or lost
+the filesystem) is reclaimed by the next worker looking for work. Outputs are
+written to a staging directory and renamed into ``results/`` on commit, so a
+batch is either committed whole or not at all; should two workers end up
+processing the same batch, the first commit wins and the other is dropped.
+
+    python -m utils.work_queue status <queue dir>
+    python -m utils.work_queue merge <queue dir> --output-dir ToCT
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from .result_writer import ResultWriter, iter_records
+
+logger = logging.getLogger(__name__)
+
+# Outputs run.py writes per batch, merged into files of the same name
+OUTPUT_NAMES = ('raw_sft_data.jsonl', 'sft_data.jsonl')
+
+
+def _write_json_atomic(path, payload):
+    temp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(temp_path, 'w') as f:
+        json.dump(payload, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError:
+        # Only a torn write by a non-atomic filesystem; treat as missing
+        return None
+
+
+class Lease:
+    """
+    One leased batch. While the lease is open a thread renews it every
+    ``lease_seconds / 3``; ``commit`` publishes what was written to
+    ``staging_dir``. Leaving the ``with`` block without committing releases the
+    batch for other workers.
+    """
+
+    def __init__(self, queue, batch_id, image_ids):
+        self.queue = queue
+        self.batch_id = batch_id
+        self.image_ids = image_ids
+        self.staging_dir = os.path.join(queue.results_dir, f".staging-{batch_id}-{queue.worker}")
+        self.committed = False
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        os.makedirs(self.staging_dir)
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True, name=f"lease-{self.batch_id}")
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        if not self.committed:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+        self.queue._release(self.batch_id)
+
+    def _heartbeat(self):
+        interval = self.queue.lease_seconds / 3
+        while not self._stop.wait(interval):
+            if not self.queue._renew(self.batch_id):
+                # Another worker reclaimed the batch; finish anyway, the first commit wins
+                logger.warning(f"Lost the lease of batch {self.batch_id}")
+                self.lost = True
+                return
+
+    def commit(self):
+        """Atomically publish the staging directory as the batch's results. False if it was already committed."""
+        target = os.path.join(self.queue.results_dir, self.batch_id)
+        try:
+            os.rename(self.staging_dir, target)
+        except OSError:
+            if not os.path.isdir(target):
+                raise
+            logger.warning(f"Batch {self.batch_id} was already committed by another worker, dropping this copy")
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            return False
+        self.committed = True
+        return True
+
+
+class WorkQueue:
+    def __init__(self, queue_dir, worker=None, lease_seconds=600, poll_interval=None):
+        self.queue_dir = queue_dir
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval if poll_interval is not None else min(30.0, lease_seconds / 4)
+        self.plan_path = os.path.join(queue_dir, 'plan.json')
+        self.leases_dir = os.path.join(queue_dir, 'leases')
+        self.results_dir = os.path.join(queue_dir, 'results')
+        os.makedirs(self.leases_dir, exist_ok=True)
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.batches = None
+
+    def initialize(self, image_ids, batch_size=8):
+        """
+        Split ``image_ids`` into batches, unless another worker already did: the
+        first plan written wins and every worker uses it.
+        """
+        if not os.path.exists(self.plan_path):
+            batches = {f"{index:06d}": list(image_ids[start:start + batch_size])
+                       for index, start in enumerate(range(0, len(image_ids), batch_size))}
+            temp_path = f"{self.plan_path}.tmp-{uuid.uuid4().hex}"
+            with open(temp_path, 'w') as f:
+                json.dump({'batch_size': batch_size, 'batches': batches}, f)
+            try:
+                # link fails if the plan exists, so exactly one worker's plan is published
+                os.link(temp_path, self.plan_path)
+                logger.info(f"Created work queue {self.queue_dir} with {len(batches)} batches")
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(temp_path)
+        self.batches = self.load_plan()
+        planned = {image_id for ids in self.batches.values() for image_id in ids}
+        if planned != set(image_ids):
+            logger.warning(f"The queue's plan has {len(planned)} images, this worker was given {len(image_ids)}; "
+                           "using the plan")
+        return self.batches
+
+    def load_plan(self):
+        with open(self.plan_path, 'r') as f:
+            return json.load(f)['batches']
+
+    def _lease_path(self, batch_id):
+        return os.path.join(self.leases_dir, f"{batch_id}.lease")
+
+    def is_done(self, batch_id):
+        return os.path.isdir(os.path.join(self.results_dir, batch_id))
+
+    def _lease_record(self, batch_id):
+        return {'worker': self.worker, 'batch': batch_id, 'expires': time.time() + self.lease_seconds}
+
+    def _create_lease(self, batch_id):
+        try:
+            fd = os.open(self._lease_path(batch_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._lease_record(batch_id), f)
+        return True
+
+    def _renew(self, batch_id):
+        path = self._lease_path(batch_id)
+        lease = _read_json(path)
+        if lease is None or lease['worker'] != self.worker:
+            return False
+        _write_json_atomic(path, self._lease_record(batch_id))
+        return True
+
+    def _release(self, batch_id):
+        path = self._lease_path(batch_id)
+        lease = _read_json(path)
+        if lease is not None and lease['worker'] == self.worker:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _reclaim(self, batch_id):
+        """Take over the batch if its lease has expired."""
+        path = self._lease_path(batch_id)
+        lease = _read_json(path)
+        if lease is None or lease['expires'] > time.time():
+            return False
+        # Only one of the workers racing for the lease gets to move it aside
+        stale_path = f"{path}.stale-{self.worker}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return False
+        moved = _read_json(stale_path)
+        if moved is not None and moved['expires'] > time.time():
+            # Renewed or re-leased since it was read; put it back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.unlink(stale_path)
+            return False
+        os.unlink(stale_path)
+        if not self._create_lease(batch_id):
+            return False
+        logger.warning(f"Reclaimed batch {batch_id} from {lease['worker']}, whose lease expired "
+                       f"{time.time() - lease['expires']:.0f} seconds ago")
+        return True
+
+    def acquire(self, wait=True):
+        """
+        Lease the next batch that is neither done nor leased by a live worker.
+        Returns a ``Lease``, or None once every batch is done. With ``wait``,
+        batches leased by others are waited on (and reclaimed if their lease
+        expires) instead of returning None while they are outstanding.
+        """
+        if self.batches is None:
+            self.batches = self.load_plan()
+        while True:
+            outstanding = False
+            for batch_id, image_ids in self.batches.items():
+                if self.is_done(batch_id):
+                    continue
+                if self._create_lease(batch_id) or self._reclaim(batch_id):
+                    if self.is_done(batch_id):
+                        # Committed between the check and the lease
+                        self._release(batch_id)
+                        continue
+                    return Lease(self, batch_id, image_ids)
+                outstanding = True
+            if not outstanding or not wait:
+                return None
+            time.sleep(self.poll_interval)
+
+    def status(self):
+        """{'done', 'leased', 'expired', 'pending'} batch counts."""
+        if self.batches is None:
+            self.batches = self.load_plan()
+        counts = {'done': 0, 'leased': 0, 'expired': 0, 'pending': 0}
+        now = time.time()
+        for batch_id in self.batches:
+            if self.is_done(batch_id):
+                counts['done'] += 1
+                continue
+            lease = _read_json(self._lease_path(batch_id))
+            if lease is None:
+                counts['pending'] += 1
+            elif lease['expires'] > now:
+                counts['leased'] += 1
+            else:
+                counts['expired'] += 1
+        return counts
+
+    def merge(self, output_dir, names=OUTPUT_NAMES, **writer_kwargs):
+        """
+        Concatenate the committed outputs of every batch, in plan order, into
+        ``<output_dir>/<name>``. Returns the ids of the batches not done yet.
+        """
+        if self.batches is None:
+            self.batches = self.load_plan()
+        missing = [batch_id for batch_id in self.batches if not self.is_done(batch_id)]
+        for name in names:
+            output_path = os.path.join(output_dir, name)
+            if os.path.exists(output_path):
+                # A plain output is appended to; start it over instead
+                os.remove(output_path)
+            count = 0
+            with ResultWriter(output_path, tag='merged', **writer_kwargs) as writer:
+                for batch_id in self.batches:
+                    if batch_id in missing:
+                        continue
+                    for record in iter_records(os.path.join(self.results_dir, batch_id, name)):
+                        writer.write(record)
+                        count += 1
+            logger.info(f"Merged {count} records into {output_path}")
+        return missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['status', 'merge'])
+    parser.add_argument('queue_dir')
+    parser.add_argument('--output-dir', default='ToCT', help="where merge writes the final outputs")
+    parser.add_argument('--allow-partial', action='store_true',
+                        help="merge even if some batches are not done yet")
+    parser.add_argument('--shard-size-mb', type=float, default=None)
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+
+    work_queue = WorkQueue(args.queue_dir)
+    status = work_queue.status()
+    print(f"{len(work_queue.batches)} batches: " + ", ".join(f"{count} {state}" for state, count in status.items()))
+    if args.command == 'merge':
+        if status['done'] < len(work_queue.batches) and not args.allow_partial:
+            print("Not all batches are done; wait for the workers or pass --allow-partial")
+            sys.exit(1)
+        shard_size = int(args.shard_size_mb * 2**20) if args.shard_size_mb is not None else None
+        missing = work_queue.merge(args.output_dir, shard_size=shard_size, compression=args.compression)
+        if missing:
+            print(f"Skipped {len(missing)} unfinished batches: {', '.join(missing)}")
+
+
+if __name__ == '__main__':
+    main()